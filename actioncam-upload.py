@@ -4,11 +4,33 @@ import sys
 import argparse
 import os
 import logging
-import glob
 import ffprobe
+import probe_cache
+import sequence_index
+import upload_ledger
+import camera_detection
+import discovery
+import fingerprint
+import encode_cache
+import encode_planner
+import upload_budget
+import encoder_profiles
+import dead_spans
+import workspace
+import watch
+import pipeline
+import ffmpeg_progress
+from clips import Clip
+from clips import Sequence
+from clips import Job
 import tempfile
 import shutil
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import heapq
+import re
+import time
+import threading
 import subprocess as sp
 
 from youtube import VALID_PRIVACY_STATUSES
@@ -17,7 +39,16 @@ from youtube import yt_get_authenticated_service
 from youtube import yt_get_my_uploads_list
 from youtube import yt_list_my_uploaded_videos
 from youtube import yt_initialize_upload
+from youtube import StreamingMediaUpload
 
+# Minimum duration of the segments of the files split with --split-segments
+MIN_SEGMENT_SECONDS = 30
+# Reduce the resolution by 4 (1/2h 1/2w) and reduce framerate to 25 images/second
+DEFAULT_COMPRESS_OPTIONS = encoder_profiles.profile_options(encoder_profiles.PROFILES[encoder_profiles.DEFAULT_PROFILE])
+# Size of the compressed files relative to the original files (half resolution, 25 images/second), to estimate the space they need
+COMPRESSED_SIZE_RATIO = 0.5
+SEQUENCE_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+SEQUENCE_TIMESTAMP_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
 
 
 
@@ -25,11 +56,14 @@ from youtube import yt_initialize_upload
 
 
 
-def upload_sequence(file_to_upload, sequence_title, youtube, args):
+
+def upload_sequence(file_to_upload, sequence_title, youtube, args, media_body=None, description_note=None):
     logging.debug("Preparing to upload file \"%s\"." % file_to_upload)
 
     try:
-        yt_initialize_upload(file_to_upload, sequence_title, youtube, args)
+        response = yt_initialize_upload(file_to_upload, sequence_title, youtube, args, media_body, description_note)
+        record_upload(response, args)
+        return response
     except HttpError as e:
         logging.error('An HTTP error %d occurred:\n%s' % (e.resp.status, e.content))
         logging.critical("Exiting...")
@@ -37,43 +71,108 @@ def upload_sequence(file_to_upload, sequence_title, youtube, args):
     except KeyboardInterrupt as e:
         logging.warning("Aborting upload (KeyboardInterrupt)")
 
-def merge_sequence(seq, dry_run, logging_level):
+def start_ffmpeg_command(command, logging_level):
+    # Start an FFmpeg command, writing its progress to its standard output
+    # Show FFmpeg output only if in DEBUG mode
+    stderr = None if "DEBUG" == logging_level else sp.DEVNULL
+    return sp.Popen(ffmpeg_progress.progress_command(command), stdout=sp.PIPE, stderr=stderr)
+
+def wait_ffmpeg_command(pipe, command, progress=None):
+    # Report the progress of an FFmpeg command until it exits, return its exit code
+    # progress: dict of the optional label, duration (of the input), stall_seconds and stats_file
+    progress = progress or {}
+    label = progress.get("label") or os.path.split(command[-1])[1]
+    try:
+        (status, elapsed) = ffmpeg_progress.monitor(pipe, label, progress.get("duration"), progress.get("stall_seconds") or ffmpeg_progress.STALL_SECONDS)
+    finally:
+        pipe.stdout.close()
+    if 0 == pipe.returncode and status and progress.get("stats_file"):
+        try:
+            ffmpeg_progress.write_stats(progress["stats_file"], command, status, progress.get("duration"), elapsed)
+        except (IOError, OSError) as e:
+            logging.warning("Unable to write the encode stats file '%s': %s" % (progress["stats_file"], e))
+    return pipe.returncode
+
+def run_ffmpeg_command(command, logging_level, progress=None):
+    # Run an FFmpeg command, return its exit code
+    pipe = start_ffmpeg_command(command, logging_level)
+    return wait_ffmpeg_command(pipe, command, progress)
+
+def get_progress_options(args):
+    # Options of the progress reports of the FFmpeg commands, completed with the label and duration of each command
+    return {"stall_seconds": args.stall_seconds,
+            "stats_file": args.encode_stats}
+
+def get_sequence_duration(seq):
+    # Total duration of the files of a sequence, None if unknown
+    if any(f.duration is None for f in seq):
+        return None
+    return seq.duration
+
+def with_duration(progress, duration, label=None):
+    # Progress options of an FFmpeg command, with the duration of its input (for the ETA)
+    progress = dict(progress or {}, duration=duration)
+    if label:
+        progress["label"] = label
+    return progress
+
+def write_concat_list(file_paths, list_file, spans=None):
+    # List of the files to concatenate, in the format of the FFmpeg concat demuxer
+    # spans: for each file, the (start, end) spans to keep (None to keep the entire file)
+    with open(list_file, 'w') as f:
+        for (file_path, file_spans) in zip(file_paths, spans or [None] * len(file_paths)):
+            for (start, end) in file_spans or [(None, None)]:
+                # Single quotes are escaped as '\''
+                print("file '%s'" % file_path.replace("'", "'\\''"), file=f)
+                if start is not None:
+                    print("inpoint %.3f" % start, file=f)
+                    print("outpoint %.3f" % end, file=f)
+
+def get_kept_spans(clip):
+    # Spans of a file left once its static and black spans are removed (None to keep the entire file)
+    if not clip.dead_spans:
+        return None
+    return dead_spans.kept_spans(clip.dead_spans, clip.duration)
+
+def get_concat_command(list_file, output_options):
+    # Read the files listed in list_file one after the other, through the concat demuxer
+    return ["ffmpeg",
+            "-nostdin",
+            "-y",
+            "-f", "concat",
+            "-safe", "0",
+            "-i", list_file] + output_options
+
+def get_join_command(list_file, output_file):
+    # Join the files listed in list_file without re-encoding
+    #ffmpeg -f concat -safe 0 -i actioncam-upload-files.txt -c copy output.mov
+    return get_concat_command(list_file, ["-c", "copy", output_file])
+
+def merge_sequence(seq, dry_run, logging_level, progress=None, tempdir=None):
     concat_string = None
     file_path = None
-    temp_file_ffmpeg = "/tmp/actioncam-upload-files.txt"
+    # Folder of its own (in the temporary folder of the sequence, or in the workspace), several sequences can be merged at the same time
+    # and the merged file has the name of the first (compressed) file
+    merge_folder = tempfile.mkdtemp(prefix="merge-", dir=tempdir or workspace.current)
+    temp_file_ffmpeg = os.path.join(merge_folder, "actioncam-upload-files.txt")
     logging.debug("Preparing to merge %d files." % len(seq))
     logging.debug(seq)
 
     # Output the list of video files to a temporary file, used as input by FFmpeg to concatenate
-    file_paths = [f["file_path"] for f in seq]
-    with open(temp_file_ffmpeg, 'w') as f:
-        print("file '%s'" % "'\nfile '".join(file_paths), file=f)
+    write_concat_list([f.file_path for f in seq], temp_file_ffmpeg, [get_kept_spans(f) for f in seq])
 
-    output_file = "/tmp/%s" % os.path.split(seq[0]["file_path"])[1] #Use the filename of the first file in this sequence
+    output_file = os.path.join(merge_folder, os.path.split(seq[0].file_path)[1]) #Use the filename of the first file in this sequence
 
-    #ffmpeg -f concat -safe 0 -i /tmp/actioncam-upload-files.txt -c copy /tmp/output.mov
-    command = ["ffmpeg",
-               "-y",
-               "-f", "concat",
-               "-safe", "0",
-               "-i", "/tmp/actioncam-upload-files.txt",
-               "-c", "copy",
-               output_file
-              ]
+    command = get_join_command(temp_file_ffmpeg, output_file)
     logging.debug("Running FFmpeg concat command...")
     logging.debug(" ".join(command))
 
     if dry_run:
         logging.info("Not executing the FFmpeg concat command due to --dry-run parameter.")
     else:
-        # Show FFmpeg output only if in INFO or DEBUG mode
-        if "DEBUG" == logging_level:
-            pipe = sp.Popen(command)
-        else:
-            pipe = sp.Popen(command, stdout=sp.PIPE, stderr=sp.STDOUT)
-        out, err = pipe.communicate()
-        if 0 != pipe.returncode:
-            logging.error("The FFmpeg concat command returned a non-zero code: %d" % pipe.returncode)
+        returncode = run_ffmpeg_command(command, logging_level, with_duration(progress, get_sequence_duration(seq)))
+        if 0 != returncode:
+            logging.error("The FFmpeg concat command returned a non-zero code: %d" % returncode)
             logging.critical("Exiting...")
             sys.exit(17)
         logging.debug("FFmpeg concat command done.")
@@ -85,104 +184,625 @@ def merge_sequence(seq, dry_run, logging_level):
 
     return output_file
 
-def compress_sequence(seq, tempdir, dry_run, logging_level, id_sequence, num_sequences):
+def run_compress_command(command, logging_level, running, progress=None):
+    # Run one FFmpeg compress command, return its exit code (None if the compression got cancelled)
+    with running["lock"]:
+        if running["cancelled"]:
+            return None
+        pipe = start_ffmpeg_command(command, logging_level)
+        running["processes"].add(pipe)
+    try:
+        wait_ffmpeg_command(pipe, command, progress)
+    finally:
+        with running["lock"]:
+            running["processes"].discard(pipe)
+    return pipe.returncode
+
+def compress_file(command, logging_level, running, progress=None):
+    # Compress one file, a failure cancels the files not started yet
+    if running["cancelled"]:
+        return None
+    returncode = run_compress_command(command, logging_level, running, progress)
+    if returncode:
+        running["cancelled"] = True
+    return returncode
+
+def cancel_compress_commands(running, futures):
+    # Stop the FFmpeg compress commands in progress, and the ones not started yet
+    with running["lock"]:
+        running["cancelled"] = True
+        for pipe in running["processes"]:
+            pipe.terminate()
+    for future in futures:
+        future.cancel()
+
+def check_sequence_files(seq):
+    # Exit if an input file doesn't exist (could happen if the actioncam got unplugged)
+    for f in seq:
+        if not os.path.isfile(f.file_path):
+            logging.error("The file doesn't exist (actioncam disconnected?): '%s'" % f.file_path)
+            logging.critical("Exiting...")
+            sys.exit(15)
+
+def get_encode_options(options=None, encode_threads=0):
+    # FFmpeg options of an encode, by default reduce the resolution by 4 (1/2h 1/2w) and reduce framerate to 25 images/second
+    options = list(options or DEFAULT_COMPRESS_OPTIONS)
+    if encode_threads:
+        # Share of the --encode-threads budget of this encode
+        options += ["-threads", str(encode_threads)]
+    return options
+
+def get_compress_command(input_file, compressed_file, encode_threads=0, options=None):
+    # Compress with the options of the encode plan, by default reduce the resolution by 4 (1/2h 1/2w) and reduce framerate to 25 images/second
+    #ffmpeg -i 20190121_085007.MOV -vf "scale=iw/2:ih/2" -r 25 20190121_085007-div2-r25.mov
+    command = ["ffmpeg",
+               "-nostdin",
+               "-i", input_file] + get_encode_options(options, encode_threads) + [compressed_file]
+    return command
+
+def get_num_segments(duration, split_segments):
+    # Number of segments to split a file into, each segment lasting at least MIN_SEGMENT_SECONDS
+    if split_segments < 2 or not duration:
+        return 1
+    return max(1, min(split_segments, int(duration // MIN_SEGMENT_SECONDS)))
+
+def get_split_command(input_file, segments_folder, segment_seconds):
+    # Split a file into segments without re-encoding, each segment starts at a keyframe
+    #ffmpeg -i GOPR0001.MP4 -c copy -f segment -segment_time 600 -reset_timestamps 1 segments/%03d.MP4
+    return ["ffmpeg",
+            "-nostdin",
+            "-i", input_file,
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_time", "%.3f" % segment_seconds,
+            "-reset_timestamps", "1",
+            os.path.join(segments_folder, "%03d" + os.path.splitext(input_file)[1])]
+
+def run_compress_commands(commands, encode_workers, logging_level, progress=None):
+    # Run the FFmpeg compress commands (list of (command, duration of its input)), encode_workers at a time
+    # Returns the exit code of the first failed command, the other ones get cancelled as soon as it fails (None if they all succeeded)
+    running = {"lock": threading.Lock(), "processes": set(), "cancelled": False}
+    with ThreadPoolExecutor(max_workers=encode_workers) as executor:
+        futures = [executor.submit(compress_file, command, logging_level, running, with_duration(progress, duration))
+                   for (command, duration) in commands]
+        try:
+            for future in as_completed(futures):
+                returncode = future.result()
+                if returncode:
+                    cancel_compress_commands(running, futures)
+                    return returncode
+                logging.debug("FFmpeg compress command %d/%d done." % (futures.index(future) + 1, len(commands)))
+        except BaseException:
+            # e.g. KeyboardInterrupt, don't leave FFmpeg processes behind
+            cancel_compress_commands(running, futures)
+            raise
+    return None
+
+def compress_sequence(seq, tempdir, dry_run, logging_level, id_sequence, num_sequences, encode_workers=1, encode_threads=0, split_segments=1, progress=None, options=None):
     logging.debug("Preparing to compress files into temporary directory '%s'." % tempdir)
     logging.debug(seq)
 
+    check_sequence_files(seq)
+    commands = []
+    compressed_files = []
+    # Long files get split at keyframes, their segments are compressed in parallel
+    split_files = []
     for idx, f in enumerate(seq):
-        compressed_file = "%s/%s" % (tempdir, os.path.split(f["file_path"])[1])
+        compressed_file = "%s/%s" % (tempdir, os.path.split(f.file_path)[1])
+        compressed_files.append(compressed_file)
+
+        kept_spans = get_kept_spans(f)
+        num_segments = get_num_segments(f.duration, split_segments)
+        if num_segments > 1 and not kept_spans:
+            segments_folder = "%s-segments" % compressed_file
+            split_command = get_split_command(f.file_path, segments_folder, f.duration / num_segments)
+            logging.debug(" ".join(split_command))
+            split_files.append((compressed_file, segments_folder, split_command, f.duration, num_segments))
+        else:
+            file_options = options
+            if kept_spans:
+                # Drop the static and black spans
+                file_options = dead_spans.exclude_options(options or DEFAULT_COMPRESS_OPTIONS, kept_spans)
+            command = get_compress_command(f.file_path, compressed_file, encode_threads, file_options)
+            logging.debug(" ".join(command))
+            commands.append((command, f.duration))
 
-        # Exit if input file doesn't exist (could happen if the actioncam got unplugged)
-        if not os.path.isfile(f["file_path"]):
-            logging.error("The file doesn't exist (actioncam disconnected?): '%s'" % f["file_path"])
+    if dry_run:
+        logging.info("Not executing the FFmpeg compress commands due to --dry-run parameter.")
+        return seq
+
+    segments = []
+    for (compressed_file, segments_folder, split_command, duration, num_segments) in split_files:
+        logging.info("Splitting file '%s' of sequence %d/%d into segments..." % (os.path.split(compressed_file)[1], id_sequence, num_sequences))
+        os.mkdir(segments_folder)
+        returncode = run_ffmpeg_command(split_command, logging_level, with_duration(progress, duration, os.path.split(compressed_file)[1]))
+        if 0 != returncode:
+            logging.error("The FFmpeg split command returned a non-zero code: %d" % returncode)
             logging.critical("Exiting...")
-            sys.exit(15)
+            sys.exit(16)
+        segment_files = [os.path.join(segments_folder, name) for name in sorted(os.listdir(segments_folder))]
+        compressed_segments = [os.path.join(segments_folder, "compressed-%s" % os.path.split(segment_file)[1]) for segment_file in segment_files]
+        # The segments are about as long as each other
+        commands += [(get_compress_command(segment_file, compressed_segment, encode_threads, options), duration / len(segment_files))
+                     for (segment_file, compressed_segment) in zip(segment_files, compressed_segments)]
+        segments.append((compressed_file, segments_folder, compressed_segments, duration))
+
+    logging.info("Running %d FFmpeg compress commands for the %d files of sequence %d/%d, %d at a time..." % (len(commands), len(seq), id_sequence, num_sequences, encode_workers))
+    failure = run_compress_commands(commands, encode_workers, logging_level, progress)
+    if failure:
+        logging.error("The FFmpeg compress command returned a non-zero code: %d" % failure)
+        logging.critical("Exiting...")
+        sys.exit(16)
 
-        # Reduce the resolution by 4 (1/2h 1/2w) and reduce framerate to 25 images/second
-        #ffmpeg -i 20190121_085007.MOV -vf "scale=iw/2:ih/2" -r 25 20190121_085007-div2-r25.mov
-        command = ["ffmpeg",
-                   "-i", f["file_path"],
-                   "-vf", "scale=iw/2:ih/2",
-                   "-r", "25",
-                   compressed_file
-                  ]
-        logging.info("Running FFmpeg compress command for file %d/%d of sequence %d/%d..." % (idx + 1, len(seq), id_sequence, num_sequences))
+    for (compressed_file, segments_folder, compressed_segments, duration) in segments:
+        # Join the compressed segments, without re-encoding
+        list_file = os.path.join(segments_folder, "segments.txt")
+        write_concat_list(compressed_segments, list_file)
+        command = get_join_command(list_file, compressed_file)
         logging.debug(" ".join(command))
+        returncode = run_ffmpeg_command(command, logging_level, with_duration(progress, duration))
+        if 0 != returncode:
+            logging.error("The FFmpeg concat command returned a non-zero code: %d" % returncode)
+            logging.critical("Exiting...")
+            sys.exit(20)
+        shutil.rmtree(segments_folder)
+    logging.info("FFmpeg compress commands done for sequence %d/%d." % (id_sequence, num_sequences))
+
+    # Update the sequence information with the paths to the new compressed files, in the order of the sequence
+    for (f, compressed_file) in zip(seq, compressed_files):
+        f.file_path = compressed_file
+        # The compressed file doesn't contain the static and black spans anymore
+        f.dead_spans = None
+    logging.debug("Updated sequence with paths to the temporary compressed files:")
+    logging.debug(seq)
+    return seq
 
-        if dry_run:
-            logging.info("Not executing the FFmpeg compress command due to --dry-run parameter.")
-        else:
-            # Show FFmpeg output only if in INFO or DEBUG mode
-            if "DEBUG" == logging_level:
-                pipe = sp.Popen(command)
-            else:
-                pipe = sp.Popen(command, stdout=sp.PIPE, stderr=sp.STDOUT)
+def merge_and_compress_sequence(seq, tempdir, dry_run, logging_level, id_sequence, num_sequences, encode_threads=0, progress=None, options=None):
+    # Compress and merge the original files in a single FFmpeg pass, through the concat demuxer
+    # Returns the path of the file to upload, the only file written to the temporary folder
+    logging.debug("Preparing to compress and merge %d files into temporary directory '%s'." % (len(seq), tempdir))
+    logging.debug(seq)
+
+    check_sequence_files(seq)
+    list_file = os.path.join(tempdir, "actioncam-upload-files.txt")
+    write_concat_list([f.file_path for f in seq], list_file, [get_kept_spans(f) for f in seq])
+    output_file = os.path.join(tempdir, os.path.split(seq[0].file_path)[1])
+
+    #ffmpeg -f concat -safe 0 -i files.txt -vf "scale=iw/2:ih/2" -r 25 20190121_085007.MOV
+    command = get_concat_command(list_file, get_encode_options(options, encode_threads) + [output_file])
+    logging.info("Running FFmpeg compress and merge command for the %d files of sequence %d/%d..." % (len(seq), id_sequence, num_sequences))
+    logging.debug(" ".join(command))
+
+    if dry_run:
+        logging.info("Not executing the FFmpeg compress and merge command due to --dry-run parameter.")
+    else:
+        returncode = run_ffmpeg_command(command, logging_level, with_duration(progress, get_sequence_duration(seq)))
+        if 0 != returncode:
+            logging.error("The FFmpeg compress and merge command returned a non-zero code: %d" % returncode)
+            logging.critical("Exiting...")
+            sys.exit(16)
+        logging.debug("FFmpeg compress and merge command done.")
+    os.remove(list_file)
+    return output_file
+
+def get_streaming_command(list_file, args, plan=None, bitrate=None):
+    # FFmpeg command writing the (compressed) sequence to its standard output
+    if args.no_compression or (plan and "copy" == plan["mode"]):
+        options = ["-c", "copy"]
+    else:
+        options = get_encode_options(get_compress_options(plan, bitrate, get_encoder_profile(args)), get_encode_threads(args))
+    # Fragmented MP4 doesn't need to seek back to the beginning of the file, it can be written to a pipe
+    options += ["-f", "mp4",
+                "-movflags", "frag_keyframe+empty_moov",
+                "pipe:1"]
+    return get_concat_command(list_file, options)
+
+def stream_sequence(job, num_sequences, youtube, args):
+    # Compress, merge and upload a sequence at once, FFmpeg writing to a pipe read by the upload
+    # Nothing but the list of files is written to the disk
+    (seq, idx) = (job.seq, job.idx)
+    check_sequence_files(seq)
+
+    detect_dead_spans(job, num_sequences, args)
+    job.tempdir = workspace.make_dir()
+    list_file = os.path.join(job.tempdir, "actioncam-upload-files.txt")
+    write_concat_list([f.file_path for f in seq], list_file, [get_kept_spans(f) for f in seq])
+    command = get_streaming_command(list_file, args, job.plan, job.bitrate)
+    logging.debug(" ".join(command))
+
+    if args.no_net:
+        logging.info("Not streaming sequence %d/%d due to --no-net parameter." % (idx + 1, num_sequences))
+        return job
+    if args.dry_run:
+        logging.info("Not streaming sequence %d/%d due to --dry-run parameter." % (idx + 1, num_sequences))
+        return job
+
+    logging.info("Streaming sequence %d/%d, which contains %d files." % (idx + 1, num_sequences, len(seq)))
+    # Show FFmpeg output only if in DEBUG mode, otherwise keep it to report errors
+    stderr = None if "DEBUG" == args.logging_level else tempfile.TemporaryFile(dir=job.tempdir)
+    pipe = sp.Popen(command, stdout=sp.PIPE, stderr=stderr)
+
+    def check_ffmpeg_end():
+        # Abort the upload before sending its last chunk if FFmpeg failed, instead of publishing a truncated video
+        pipe.wait()
+        if 0 != pipe.returncode:
+            if stderr:
+                stderr.seek(0)
+                logging.error(stderr.read().decode("utf-8", "replace")[-2000:])
+            logging.error("The FFmpeg streaming command returned a non-zero code: %d" % pipe.returncode)
+            logging.critical("Exiting...")
+            sys.exit(16)
+
+    media_body = StreamingMediaUpload(pipe.stdout, "video/mp4", check_end=check_ffmpeg_end)
+    sequence_title = get_sequence_title(seq.creation_time, seq.device)
+    try:
+        job.response = upload_sequence(None, sequence_title, youtube, args, media_body, job.description_note)
+    finally:
+        if pipe.poll() is None:
+            # The upload was aborted
+            pipe.kill()
+        pipe.wait()
+        pipe.stdout.close()
+        if stderr:
+            stderr.close()
+    return job
+
+def upload_streamed_sequence(job, num_sequences, pre_copy_folders, youtube, args):
+    # Stream a sequence, then delete its temporary folders and files
+    try:
+        stream_sequence(job, num_sequences, youtube, args)
+    finally:
+        delete_temporary_files([], None, job.idx, num_sequences, args, job.tempdir, pre_copy_folders)
+        release_space(job)
+        job.done = True
+    return job
+
+def get_encoder_profile(args):
+    # Settings of the --encoder-profile
+    return encoder_profiles.PROFILES[args.encoder_profile]
+
+def get_encode_threads(args):
+    # Number of threads of each FFmpeg encode, splitting the --encode-threads budget across the --encode-workers (0: FFmpeg default)
+    encode_threads = args.encode_threads
+    if encode_threads is None and get_encoder_profile(args)["threads"]:
+        # Number of threads of each encode set by the profile
+        return get_encoder_profile(args)["threads"]
+    if encode_threads is None:
+        # Without an explicit budget, a single encode uses all the cores, parallel encodes share them
+        encode_threads = (os.cpu_count() or 1) if args.encode_workers > 1 else 0
+    if not encode_threads:
+        return 0
+    return max(1, encode_threads // args.encode_workers)
+
+def get_encode_settings(args):
+    # Description of the encode settings, part of the key of the encode cache
+    if args.no_compression:
+        return "copy"
+    profile = get_encoder_profile(args)
+    if args.adaptive_encoding:
+        # The plan only depends on the clips (part of the key) and on the targets
+        settings = "adaptive height=%d fps=%g bitrate=%dk" % (args.target_height, args.target_fps, args.target_bitrate)
+    else:
+        settings = " ".join(encoder_profiles.filter_options(profile))
+    return " ".join([settings] + encoder_profiles.codec_options(profile))
+
+def get_compress_options(plan=None, bitrate=None, profile=None):
+    # FFmpeg compress options of a sequence: the scaling and frame rate of its encode plan (or of the encoder profile), with the encoder of the profile, capped to its share of the upload budget
+    profile = profile or encoder_profiles.PROFILES[encoder_profiles.DEFAULT_PROFILE]
+    options = (plan["options"] if plan else encoder_profiles.filter_options(profile)) + encoder_profiles.codec_options(profile)
+    if bitrate:
+        options = upload_budget.cap_bitrate(options, bitrate)
+    return options
+
+def get_encode_cache_key(seq, args, plan=None, bitrate=None):
+    # Key of the compressed and merged file of a sequence in the encode cache, None if not cached
+    if not args.encode_cache or args.stream or args.dry_run:
+        return None
+    if (args.no_compression or (plan and "copy" == plan["mode"])) and len(seq) == 1:
+        # The original file gets uploaded as is
+        return None
+    if get_sequence_fingerprint(seq) is None:
+        return None
+    settings = get_encode_settings(args)
+    if bitrate:
+        settings += " maxrate=%dk" % bitrate
+    if args.drop_dead_spans:
+        settings += " dead>=%gs" % args.dead_span_seconds
+    return encode_cache.get_cache_key([clip.fingerprint for clip in seq], settings)
+
+def detect_dead_spans(job, num_sequences, args):
+    # Find the static and black spans of the files of a sequence, to drop them (--drop-dead-spans)
+    # Sets the note listing them in the description of the video
+    (seq, idx) = (job.seq, job.idx)
+    if not args.drop_dead_spans:
+        return job
+    if args.dry_run:
+        logging.info("Not detecting the static and black spans of sequence %d/%d due to --dry-run parameter." % (idx + 1, num_sequences))
+        return job
+    logging.info("Detecting the static and black spans of sequence %d/%d, which contains %d files." % (idx + 1, num_sequences, len(seq)))
+    removed = []
+    offset = 0.0
+    for f in seq:
+        if f.dead_spans is None:
+            command = dead_spans.get_detect_command(f.file_path, args.dead_span_seconds)
+            logging.debug(" ".join(command))
+            pipe = sp.Popen(command, stdout=sp.DEVNULL, stderr=sp.PIPE)
             out, err = pipe.communicate()
             if 0 != pipe.returncode:
-                logging.error("The FFmpeg compress command returned a non-zero code: %d" % pipe.returncode)
-                logging.critical("Exiting...")
-                sys.exit(16)
-            logging.debug("FFmpeg compress command done.")
-            # Update the sequence information with the path to the new compressed file
-            f["file_path"] = compressed_file
-
-    if not dry_run:
-        logging.debug("Updated sequence with paths to the temporary compressed files:")
-        logging.debug(seq)
-    return seq
-
-def compress_merge_and_upload_sequences(new_sequences, pre_copy_folders, youtube, args):
-    tempdir = None
+                logging.warning("Unable to detect the static and black spans of '%s', keeping all of it (FFmpeg returned %d)." % (f.file_path, pipe.returncode))
+                f.dead_spans = []
+            else:
+                f.dead_spans = dead_spans.parse_spans(err.decode("utf-8", "replace"), f.duration, args.dead_span_seconds)
+        # Position of the spans in the sequence
+        removed += [(offset + start, offset + end) for (start, end) in f.dead_spans]
+        offset += f.duration or 0
+    if removed:
+        job.description_note = dead_spans.describe(removed)
+        logging.info("Sequence %d/%d: %s" % (idx + 1, num_sequences, job.description_note))
+    return job
+
+def prepare_sequence(job, num_sequences, args, cache_in_use=None):
+    # Compress and merge the files of a sequence (or get them from the encode cache), sets the file to upload
+    cache_key = get_encode_cache_key(job.seq, args, job.plan, job.bitrate)
+    if cache_key:
+        cached_file = encode_cache.lookup(args.encode_cache, cache_key)
+        if cached_file:
+            logging.info("Sequence %d/%d found in the encode cache, no need to compress and merge it." % (job.idx + 1, num_sequences))
+            (job.file_to_upload, job.cache_key) = (cached_file, cache_key)
+            cache_in_use.add(cache_key)
+            note = encode_cache.lookup_note(args.encode_cache, cache_key)
+            if note is None:
+                # Cached without its description note, find the static and black spans again
+                detect_dead_spans(job, num_sequences, args)
+            elif note:
+                job.description_note = note
+            return job
+
+    detect_dead_spans(job, num_sequences, args)
+    encode_sequence(job, num_sequences, args)
+
+    if cache_key:
+        # Keep the file until the sequence is uploaded, even if this run gets aborted
+        max_size = int(args.encode_cache_size * 1024 * 1024 * 1024)
+        cached_file = encode_cache.store(args.encode_cache, cache_key, job.file_to_upload, max_size, cache_in_use)
+        if cached_file != job.file_to_upload:
+            (job.file_to_upload, job.cache_key) = (cached_file, cache_key)
+            cache_in_use.add(cache_key)
+            encode_cache.store_note(args.encode_cache, cache_key, job.description_note or "")
+    return job
+
+def get_encode_space(seq, args, plan=None):
+    # Estimated space needed in the workspace to compress and merge a sequence, in bytes
+    size = seq.size
+    merged = len(seq) > 1 or any(get_kept_spans(f) for f in seq)
+    if args.no_compression or (plan and "copy" == plan["mode"]):
+        return size if merged else 0
+    compressed = plan["estimated_size"] if plan else int(size * COMPRESSED_SIZE_RATIO)
+    if args.single_pass:
+        return compressed
+    space = 2 * compressed if merged else compressed
+    if args.split_segments > 1:
+        # The segments of the original files, and their compressed versions
+        space += size + compressed
+    return space
+
+def reserve_space(job, size, num_sequences, args, action):
+    # Reserve the space needed by a sequence in the workspace, exit if there isn't enough free space
+    min_free = int(args.scratch_reserve * 1024 * 1024 * 1024)
+    if not workspace.reserve(size, min_free):
+        logging.error("Not enough free space in the workspace to %s sequence %d/%d: %.1f MB needed, %.1f MB free, keeping at least %.1f MB free (see --scratch-dir and --scratch-reserve)."
+                      % (action, job.idx + 1, num_sequences, size / 1000000.0, workspace.available_space() / 1000000.0, min_free / 1000000.0))
+        logging.critical("Exiting...")
+        sys.exit(22)
+    job.reserved += size
+
+def release_space(job):
+    # The temporary files of a sequence have been deleted
+    workspace.release(job.reserved)
+    job.reserved = 0
+
+def encode_sequence(job, num_sequences, args):
+    # Compress and merge the files of a sequence, sets the file to upload
+    (seq, idx) = (job.seq, job.idx)
+    plan = job.plan
+    options = get_compress_options(plan, job.bitrate, get_encoder_profile(args))
+    copy = plan is not None and "copy" == plan["mode"]
+    if not args.dry_run:
+        reserve_space(job, get_encode_space(seq, args, plan), num_sequences, args, "compress and merge")
+    if args.single_pass and not args.no_compression and not copy:
+        # Compress and merge at once, only the file to upload gets written to the temporary folder
+        job.tempdir = workspace.make_dir()
+        logging.info("Compressing and merging sequence %d/%d, which contains %d files." % (idx + 1, num_sequences, len(seq)))
+        job.file_to_upload = merge_and_compress_sequence(seq, job.tempdir, args.dry_run, args.logging_level, idx + 1, num_sequences, get_encode_threads(args), get_progress_options(args), options)
+        return job
+
+    if args.no_compression:
+        logging.info("Not compressing sequence %d/%d due to --no-compression parameter." % (idx + 1, num_sequences))
+    elif copy:
+        logging.info("Not compressing sequence %d/%d, its files already meet the encode targets." % (idx + 1, num_sequences))
+    else:
+        # Create a temporary folder to hold the compressed files
+        # Do create (and delete) a new folder for each sequence, to save disk space
+        job.tempdir = workspace.make_dir()
+        # Reduce resolution and framerate
+        logging.info("Compressing sequence %d/%d, which contains %d files." % (idx + 1, num_sequences, len(seq)))
+        seq = compress_sequence(seq, job.tempdir, args.dry_run, args.logging_level, idx + 1, num_sequences, args.encode_workers, get_encode_threads(args), args.split_segments, get_progress_options(args), options)
+        # seq[] now contains the paths to the temporary compressed files
+
+    if len(seq) > 1 or get_kept_spans(seq[0]):
+        # Combine this sequence into an individual file (or drop the static and black spans of its only file)
+        logging.info("Merging sequence %d/%d, which contains %d files." % (idx + 1, num_sequences, len(seq)))
+        if not job.tempdir:
+            job.tempdir = workspace.make_dir()
+        job.file_to_upload = merge_sequence(seq, args.dry_run, args.logging_level, get_progress_options(args), job.tempdir)
+    else:
+        # No need to merge, as there is only one file
+        logging.info("Sequence %d/%d has only one file, no need to merge files." % (idx + 1, num_sequences))
+        job.file_to_upload = seq[0].file_path
+    return job
+
+def delete_job_temporary_files(job, num_sequences, args, pre_copy_folders):
+    # The files of the encode cache are kept until the sequence is uploaded
+    file_to_upload = None if job.cache_key else job.file_to_upload
+    delete_temporary_files(job.seq, file_to_upload, job.idx, num_sequences, args, job.tempdir, pre_copy_folders)
+    release_space(job)
+    job.done = True
+
+def upload_prepared_sequence(job, num_sequences, pre_copy_folders, youtube, args, cache_in_use=None):
+    # Upload the file of a sequence, then delete its temporary folders and files
+    (seq, idx, file_to_upload) = (job.seq, job.idx, job.file_to_upload)
+    if args.no_net:
+        logging.info("Not uploading sequence %d/%d due to --no-net parameter." % (idx + 1, num_sequences))
+    elif args.dry_run:
+        logging.info("Not uploading sequence %d/%d due to --dry-run parameter." % (idx + 1, num_sequences))
+    else:
+        # Upload the merged sequence
+        logging.info("Uploading sequence %d/%d." % (idx + 1, num_sequences))
+        sequence_title = get_sequence_title(seq.creation_time, seq.device)
+        start = time.time()
+        try:
+            job.response = upload_sequence(file_to_upload, sequence_title, youtube, args, description_note=job.description_note)
+        except BaseException as e:
+            # Delete the temporary folders and files, since the program execution stops here
+            delete_job_temporary_files(job, num_sequences, args, pre_copy_folders)
+            raise
+        if job.response:
+            record_uplink_rate(args, os.path.getsize(file_to_upload), time.time() - start)
+        if job.cache_key and job.response:
+            # Uploaded, no need to keep the file in the encode cache anymore
+            encode_cache.remove(args.encode_cache, job.cache_key)
+    if job.cache_key:
+        cache_in_use.discard(job.cache_key)
+    # Delete the temporary folders and files
+    delete_job_temporary_files(job, num_sequences, args, pre_copy_folders)
+    return job
+
+def plan_sequence_encode(seq, args):
+    # Encode plan of a sequence, from the video streams of its original files (read when they were probed)
+    clip_plans = []
+    for f in seq:
+        clip_plans.append(encode_planner.plan_clip(f.video, f.size, f.duration, args.target_height, args.target_fps, args.target_bitrate))
+        logging.debug("Encode plan of '%s': %s." % (f.original_path, clip_plans[-1]["mode"]))
+    return encode_planner.plan_sequence(clip_plans, args.target_height, args.target_fps, args.target_bitrate)
+
+def plan_encodes(jobs, args):
+    # Plan the encodes of the sequences and report the savings, before compressing anything
+    size = estimated_size = 0
+    for job in jobs:
+        job.plan = plan_sequence_encode(job.seq, args)
+        logging.info("Encode plan of sequence %d/%d: %s." % (job.idx + 1, len(jobs), encode_planner.describe_plan(job.plan)))
+        size += job.plan["size"]
+        estimated_size += job.plan["estimated_size"]
+    logging.info("The planned encodes should reduce the size of the %d sequences from %.1f MB to %.1f MB (%.1f MB saved)." % (len(jobs), size / 1000000.0, estimated_size / 1000000.0, (size - estimated_size) / 1000000.0))
+
+def get_uplink_rate(args):
+    # Uplink rate in bits/s: configured with --uplink-rate, or measured on the previous uploads (None if unknown)
+    if args.uplink_rate:
+        return args.uplink_rate * 1000000
+    ledger = open_upload_ledger(args)
+    if not ledger:
+        return None
+    try:
+        rate = upload_ledger.get_setting(ledger, "uplink_rate")
+    finally:
+        ledger.close()
+    return float(rate) if rate else None
+
+def record_uplink_rate(args, num_bytes, seconds):
+    # Measure the uplink rate on an upload, for the upload budget of the next runs
+    if seconds <= 0:
+        return
+    ledger = open_upload_ledger(args)
+    if ledger:
+        rate = upload_budget.update_rate(float(upload_ledger.get_setting(ledger, "uplink_rate") or 0), num_bytes, seconds)
+        upload_ledger.set_setting(ledger, "uplink_rate", "%.0f" % rate)
+        ledger.close()
+        logging.debug("Measured uplink rate: %.2f Mbit/s." % (rate / 1000000))
+
+def plan_upload_budget(jobs, args):
+    # Cap the bitrate of the compressed sequences so that all the sequences get uploaded within --upload-window
+    uplink_rate = get_uplink_rate(args)
+    if not uplink_rate:
+        logging.warning("The uplink rate is unknown (no upload measured yet), pass --uplink-rate to fit the uploads in the --upload-window.")
+        return
+    budget = upload_budget.get_budget(args.upload_window * 3600, uplink_rate)
+    # The sequences uploaded as they are use their size of the budget
+    fixed = [job for job in jobs if args.no_compression or (job.plan and "copy" == job.plan["mode"])]
+    encoded = [job for job in jobs if job not in fixed]
+    fixed_bytes = sum(job.seq.size for job in fixed)
+    bitrate = upload_budget.allocate_bitrate(budget, fixed_bytes, sum(get_sequence_duration(job.seq) or 0 for job in encoded))
+    total_bytes = fixed_bytes
+    for job in encoded:
+        job.bitrate = bitrate
+        capped_size = upload_budget.capped_size(bitrate, get_sequence_duration(job.seq) or 0)
+        total_bytes += min(capped_size, job.plan["estimated_size"]) if job.plan else capped_size
+    logging.info("Upload budget of the %.1f hours window at %.2f Mbit/s: %.1f MB." % (args.upload_window, uplink_rate / 1000000, budget / 1000000.0))
+    if bitrate:
+        logging.info("Capping the video bitrate of the %d compressed sequences to %d kbit/s." % (len(encoded), bitrate))
+    if total_bytes > budget:
+        logging.warning("The %d sequences (%.1f MB) don't fit in the upload budget." % (len(jobs), total_bytes / 1000000.0))
+    logging.info("The uploads of the %d sequences (%.1f MB at most) should be done by %s." % (len(jobs), total_bytes / 1000000.0, upload_budget.completion_time(total_bytes, uplink_rate).strftime(SEQUENCE_TIMESTAMP_FORMAT)))
+
+def compress_merge_and_upload_sequences(new_sequences, pre_copy_folders, youtube, args, index=None):
     num_sequences = len(new_sequences)
     logging.debug("Preparing to compress, merge and upload %d sequences." % num_sequences)
+    jobs = [Job(seq, idx) for (idx, seq) in enumerate(new_sequences)]
+    if args.adaptive_encoding and not args.no_compression:
+        plan_encodes(jobs, args)
+    if args.upload_window:
+        plan_upload_budget(jobs, args)
+    uploaded_sequences = []
+    # Keys of the files of the encode cache waiting to be uploaded, which must not be evicted
+    cache_in_use = set()
+
+    # The sequences go through the stages as a pipeline, e.g. the next sequence gets compressed while the previous one is uploaded
+    stages = []
+    if args.pre_copy and not pre_copy_folders:
+        # Copy the files from the actioncam to a temporary folder on the computer, useful in case the actioncam gets disconnected
+        pre_copy_folders = [None] * num_sequences
+        def copy_sequence(job):
+            reserve_space(job, job.seq.size, num_sequences, args, "pre-copy")
+            pre_copy_folders[job.idx] = pre_copy_sequence(job.seq, job.idx, num_sequences)
+            return job
+        stages.append(pipeline.Stage("copy", copy_sequence, args.copy_workers))
+    if args.stream:
+        # Compress, merge and upload each sequence at once
+        stages.append(pipeline.Stage("stream", lambda job: upload_streamed_sequence(job, num_sequences, pre_copy_folders, youtube, args), 1))
+    else:
+        # Limit the number of compressed files waiting to be uploaded, to save disk space
+        pending_uploads = threading.BoundedSemaphore(args.max_pending_uploads)
+        stages.append(pipeline.Stage("compress", lambda job: prepare_sequence(job, num_sequences, args, cache_in_use), args.sequence_workers, acquire=pending_uploads))
+        # The YouTube API client isn't thread-safe, the sequences are uploaded one at a time
+        stages.append(pipeline.Stage("upload", lambda job: upload_prepared_sequence(job, num_sequences, pre_copy_folders, youtube, args, cache_in_use), 1, release=pending_uploads))
 
-    for idx, seq in enumerate(new_sequences):
-        if args.no_compression:
-            logging.info("Not compressing sequence %d/%d due to --no-compression parameter." % (idx + 1, num_sequences))
-        else:
-            # Create a temporary folder to hold the compressed files
-            # Do create (and delete) a new folder for each sequence, to save disk space
-            tempdir = tempfile.mkdtemp()
-            # Reduce resolution and framerate
-            logging.info("Compressing sequence %d/%d, which contains %d files." % (idx + 1, num_sequences, len(seq)))
-            seq = compress_sequence(seq, tempdir, args.dry_run, args.logging_level, idx + 1, num_sequences)
-            # seq[] now contains the paths to the temporary compressed files
-
-        if len(seq) > 1:
-            # Combine this sequence into an individual file
-            logging.info("Merging sequence %d/%d, which contains %d files." % (idx + 1, num_sequences, len(seq)))
-            file_to_upload = merge_sequence(seq, args.dry_run, args.logging_level)
-        else:
-            # No need to merge, as there is only one file
-            logging.info("Sequence %d/%d has only one file, no need to merge files." % (idx + 1, num_sequences))
-            file_to_upload = seq[0]["file_path"]
-
-        if args.no_net:
-            logging.info("Not uploading sequence %d/%d due to --no-net parameter." % (idx + 1, num_sequences))
-        elif args.dry_run:
-            logging.info("Not uploading sequence %d/%d due to --dry-run parameter." % (idx + 1, num_sequences))
-        else:
-            # Upload the merged sequence
-            logging.info("Uploading sequence %d/%d." % (idx + 1, num_sequences))
-            sequence_title = get_sequence_title(seq[0]["creation_time"])
-            try:
-                upload_sequence(file_to_upload, sequence_title, youtube, args)
-            except Exception as e:
-                # Delete the temporary folders and files, since the program execution stops here
-                delete_temporary_files(seq, file_to_upload, idx, num_sequences, args, tempdir, pre_copy_folders)
-                raise
-        # Delete the temporary folders and files
-        delete_temporary_files(seq, file_to_upload, idx, num_sequences, args, tempdir, pre_copy_folders)
+    try:
+        for job in pipeline.run_pipeline(jobs, stages):
+            if job.response:
+                uploaded_sequences.append(job.seq)
+            if index and job.response:
+                # Remember the content of this sequence, in case its clips come up again under another creation time
+                sequence_fingerprint = get_sequence_fingerprint(job.seq)
+                if sequence_fingerprint:
+                    sequence_index.store_fingerprint(index, sequence_fingerprint, get_sequence_title(job.seq.creation_time, job.seq.device))
+    except KeyboardInterrupt:
+        raise
+    except BaseException:
+        # Delete the temporary files of the sequences compressed but not uploaded, since the program execution stops here
+        for job in jobs:
+            if job.file_to_upload and not job.done:
+                delete_job_temporary_files(job, num_sequences, args, pre_copy_folders)
+        raise
+    return uploaded_sequences
 
 def delete_temporary_files(seq, file_to_upload, idx, num_sequences, args, tempdir, pre_copy_folders):
-    if len(seq) > 1:
-        # Delete the merged file (if there is only one file, no temporary merged file was created, so no need to delete)
+    if file_to_upload and (len(seq) > 1 or file_to_upload != seq[0].file_path):
+        # Delete the merged file (if the file to upload is the only file of the sequence, no temporary merged file was created, so no need to delete)
         if os.path.isfile(file_to_upload):
             logging.debug("Deleting merged file for sequence %d/%d." % (idx + 1, num_sequences))
             os.remove(file_to_upload)
             logging.debug("File '%s' removed." % file_to_upload)
 
-    if not args.no_compression:
+    if tempdir:
         # Delete the compressed files' temporary folder
         shutil.rmtree(tempdir)
         logging.debug("The temporary folder with the compressed files for this sequence has been removed.")
@@ -192,28 +812,114 @@ def delete_temporary_files(seq, file_to_upload, idx, num_sequences, args, tempdi
         shutil.rmtree(pre_copy_folders[idx])
         logging.debug("The temporary folder where the original files where copied to has been removed.")
 
-def get_sequence_title(creation_time):
-    return creation_time.strftime("%Y-%m-%d %H:%M:%S")
-
-def pre_copy(new_sequences):
-    logging.debug("Pre-copying the files from the actioncam to a temporary folder")
-    pre_copy_folders = []
-    for idx, seq in enumerate(new_sequences):
-        # Create a new temporary folder for this sequence's files
-        pre_copy_folders.append(tempfile.mkdtemp())
-        for idx2, files in enumerate(seq):
-            logging.info("Pre-copying file %d/%d of sequence %d/%d..." % (idx2 + 1, len(seq), idx + 1, len(new_sequences)))
-            # Copy the files from that sequence to that new temporary folder
-            new_filename = os.path.join(pre_copy_folders[idx], os.path.split(files["file_path"])[1])
-            shutil.copy(files["file_path"], new_filename)
-            # Update that file's path to the new temporary path
-            files["file_path"] = new_filename
-    return (new_sequences, pre_copy_folders)
-
-def analyze_sequences(sequences, youtube, args):
+def get_sequence_title(creation_time, device=None):
+    title = creation_time.strftime(SEQUENCE_TIMESTAMP_FORMAT)
+    if device:
+        # Distinguish the sequences of different actioncams
+        title = "%s %s" % (title, device)
+    return title
+
+def get_sequence_identity(creation_time, device=None):
+    # Key identifying a sequence among the uploaded videos, independently of the --title prefix
+    return (creation_time.strftime(SEQUENCE_TIMESTAMP_FORMAT), device or None)
+
+def parse_sequence_identity(text):
+    # Identity of the sequence whose title ends the title or description of an uploaded video (None if there is none)
+    if not text:
+        return None
+    matches = list(SEQUENCE_TIMESTAMP_PATTERN.finditer(text))
+    if not matches:
+        return None
+    # The prefix could contain a date as well, the sequence title comes last
+    match = matches[-1]
+    return (match.group(0), text[match.end():].strip() or None)
+
+def get_uploaded_identities(videos):
+    # Set of the identities of the uploaded videos, from their (title, description)
+    identities = set()
+    for (title, description) in videos:
+        identity = parse_sequence_identity(title) or parse_sequence_identity(description)
+        if identity:
+            identities.add(identity)
+    return identities
+
+def pre_copy_sequence(seq, idx, num_sequences):
+    # Create a new temporary folder for this sequence's files
+    pre_copy_folder = workspace.make_dir()
+    for idx2, files in enumerate(seq):
+        logging.info("Pre-copying file %d/%d of sequence %d/%d..." % (idx2 + 1, len(seq), idx + 1, num_sequences))
+        # Copy the files from that sequence to that new temporary folder
+        new_filename = os.path.join(pre_copy_folder, os.path.split(files.file_path)[1])
+        shutil.copy(files.file_path, new_filename)
+        # Update that file's path to the new temporary path
+        files.file_path = new_filename
+    return pre_copy_folder
+
+def open_upload_ledger(args):
+    if args.no_upload_ledger:
+        return None
+    return upload_ledger.open_ledger(args.upload_ledger)
+
+def list_uploaded_videos(youtube, args):
+    # Identities of the sequences uploaded to YouTube
+    # With the upload ledger, only the videos uploaded since the previous run are fetched from YouTube
+    ledger = open_upload_ledger(args)
+    if not ledger:
+        logging.info("Not using the upload ledger due to --no-upload-ledger parameter, listing all the uploaded videos.")
+        uploads_playlist_id = yt_get_my_uploads_list(youtube)
+        if not uploads_playlist_id:
+            logging.info('There is no uploaded videos playlist for this user.')
+            return set()
+        return get_uploaded_identities([(video["title"], video["description"]) for video in yt_list_my_uploaded_videos(uploads_playlist_id, youtube)])
+
+    try:
+        if args.resync_upload_ledger:
+            logging.info("Fetching all the uploaded videos again due to --resync-upload-ledger parameter.")
+            upload_ledger.clear_ledger(ledger)
+        uploads_playlist_id = upload_ledger.get_setting(ledger, "uploads_playlist_id")
+        if not uploads_playlist_id:
+            uploads_playlist_id = yt_get_my_uploads_list(youtube)
+            if not uploads_playlist_id:
+                logging.info('There is no uploaded videos playlist for this user.')
+                return set()
+            upload_ledger.set_setting(ledger, "uploads_playlist_id", uploads_playlist_id)
+        new_videos = yt_list_my_uploaded_videos(uploads_playlist_id, youtube, upload_ledger.get_setting(ledger, "sync_mark"))
+        upload_ledger.store_uploads(ledger, new_videos)
+        if new_videos:
+            # The next run stops at the most recent video seen here
+            upload_ledger.set_setting(ledger, "sync_mark", new_videos[0]["video_id"])
+        return get_uploaded_identities(upload_ledger.load_videos(ledger))
+    finally:
+        ledger.close()
+
+def record_upload(response, args):
+    # Add a video uploaded by this run to the upload ledger, no need to fetch it from YouTube in the next run
+    if not response or 'id' not in response:
+        return
+    ledger = open_upload_ledger(args)
+    if ledger:
+        snippet = response.get('snippet', {})
+        upload_ledger.store_uploads(ledger, [{"video_id": response['id'], "title": snippet.get('title'), "description": snippet.get('description'),
+                                              "published_at": snippet.get('publishedAt'), "etag": response.get('etag')}])
+        ledger.close()
+
+def get_sequence_fingerprint(seq):
+    # Content fingerprint of the original files of a sequence, None if they can't be read anymore
+    try:
+        for clip in seq:
+            if clip.fingerprint is None:
+                clip.fingerprint = fingerprint.clip_fingerprint(clip.original_path)
+    except (IOError, OSError, ValueError) as e:
+        logging.debug("Unable to fingerprint the sequence: %s" % e)
+        return None
+    return fingerprint.sequence_fingerprint([clip.fingerprint for clip in seq])
+
+def analyze_sequences(sequences, youtube, args, index=None, old_sequences=None):
+    # The sequences found already uploaded are appended to old_sequences (if given)
     sequence_title = None
     new_sequences = []
-    uploaded_videos = []
+    uploaded_videos = set()
+    uploaded_fingerprints = {}
 
     num_sequences = len(sequences)
     logging.debug("Starting to analyze %d sequences." % num_sequences)
@@ -223,17 +929,16 @@ def analyze_sequences(sequences, youtube, args):
     else:
         # Get the list of videos uploaded to YouTube
         try:
-            uploads_playlist_id = yt_get_my_uploads_list(youtube)
-            if uploads_playlist_id:
-                uploaded_videos = yt_list_my_uploaded_videos(uploads_playlist_id, youtube)
-                logging.debug("Uploaded videos: %s" % uploaded_videos)
-            else:
-                logging.info('There is no uploaded videos playlist for this user.')
+            uploaded_videos = list_uploaded_videos(youtube, args)
+            logging.debug("Uploaded videos: %s" % uploaded_videos)
         except HttpError as e:
             logging.debug('An HTTP error %d occurred:\n%s' % (e.resp.status, e.content))
             logging.critical("Exiting...")
             sys.exit(14)
 
+    if index:
+        uploaded_fingerprints = sequence_index.load_fingerprints(index)
+
     if args.interactive:
         print("Entering Interactive mode:")
 
@@ -244,11 +949,20 @@ def analyze_sequences(sequences, youtube, args):
             raise Exception("No files in sequence (should never happen, something has gone wrong...)")
 
         # Use the creation time of the first file in the sequence as name for the entire sequence
-        sequence_title = get_sequence_title(seq[0]["creation_time"])
+        sequence_title = get_sequence_title(seq.creation_time, seq.device)
 
         # Check if this sequence has already uploaded
-        if sequence_title in uploaded_videos:
-            extra_info = "%s (%d files)." % (sequence_title, len(seq))
+        is_uploaded = get_sequence_identity(seq.creation_time, seq.device) in uploaded_videos
+        extra_info = "%s (%d files)." % (sequence_title, len(seq))
+        if not is_uploaded and uploaded_fingerprints:
+            # Same content as an uploaded sequence, under another creation time
+            uploaded_title = uploaded_fingerprints.get(get_sequence_fingerprint(seq))
+            if uploaded_title:
+                is_uploaded = True
+                extra_info = "%s (%d files), same content as the uploaded sequence %s." % (sequence_title, len(seq), uploaded_title)
+        if is_uploaded:
+            if old_sequences is not None:
+                old_sequences.append(seq)
             if not args.interactive:
                 logging.info("OLD  sequence %2d/%d %s" % (idx + 1, num_sequences, extra_info))
             else:
@@ -258,10 +972,7 @@ def analyze_sequences(sequences, youtube, args):
             # If bounds supplied, check if the duration of this sequence is within them
             if args.min_length or args.max_length:
                 # Calculate duration of this sequence
-                sequence_length = 0
-                for idx2, vid in enumerate(seq):
-                    sequence_length += vid["duration"]
-                sequence_length /= 60 # Convert seconds in minutes
+                sequence_length = seq.duration / 60 # Convert seconds in minutes
                 if args.min_length and sequence_length < args.min_length:
                     extra_info = "%s (%d files), duration %.1f < --min-length=%d." % (sequence_title, len(seq), sequence_length, args.min_length)
                     if not args.interactive:
@@ -327,101 +1038,288 @@ def interactive_sequence_selection(sequences, new_sequences):
             new_sequences.append(sequences[s])
     return new_sequences
 
-def analyze_files(files):
-    video_metadata = None
-    duration = None
-    videos_by_creation_time = {}
-    creation_times = []
-
-    num_files = len(files)
-    logging.info("Starting to analyze %d video files..." % num_files)
-
-    for idx, f in enumerate(files):
-        logging.debug("Analyzing file %d/%d: '%s'" % (idx + 1, num_files, f))
-        if not os.path.isfile(f):
-            raise Exception("There is no file to analyze at '%s'" % f)
+def probe_file(f, probe_backend="native"):
+    if "native" == probe_backend:
+        # Read the MOV/MP4 header directly, falling back to ffprobe if needed
+        video_metadata = ffprobe.probe_fast(f)
+    else:
         video_metadata = ffprobe.probe(f)
-        duration = ffprobe.duration(video_metadata)
-        creation_time = ffprobe.creation_time(video_metadata)
-        logging.debug("File '%s': Duration: '%.3f', Creation Time: '%s'" %(f, duration, creation_time))
-        creation_times.append(creation_time)
-        videos_by_creation_time[creation_time] = {"file_path": f, "duration": duration}
-
-    return identify_sequences(videos_by_creation_time, creation_times)
+    return (ffprobe.duration(video_metadata), ffprobe.creation_time(video_metadata), ffprobe.video_stream(video_metadata))
+
+def probe_files(files, probe_workers, probe_backend="native", failed=None):
+    # Run ffprobe on several files at the same time (mostly waiting on I/O from the actioncam)
+    # The results are returned in the same order as the files, errors are reported per file
+    # If a failed list is given, the indexes of the files that can't be analyzed are appended to it (their result is None) instead of raising the first error
+    results = [None] * len(files)
+    first_error = None
+    with ThreadPoolExecutor(max_workers=probe_workers) as executor:
+        futures = [executor.submit(probe_file, f, probe_backend) for f in files]
+        for idx, future in enumerate(futures):
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                logging.error("Error while analyzing file '%s': %s" % (files[idx], e))
+                if failed is not None:
+                    failed.append(idx)
+                elif first_error is None:
+                    first_error = e
+    if first_error is not None:
+        raise first_error
+    return results
+
+def analyze_files(clips, cache=None, probe_workers=1, probe_backend="native", gap_seconds=30):
+    probe_clips(clips, cache, probe_workers, probe_backend)
+    return identify_sequences(clips, gap_seconds)
+
+def probe_clips(clips, cache=None, probe_workers=1, probe_backend="native", failed=None):
+    # Fill in the duration, creation time and video stream of the clips
+    # If a failed list is given, the clips that can't be analyzed are appended to it instead of raising an exception
+    clips_to_probe = []
+
+    num_files = len(clips)
+    logging.info("Starting to analyze %d video files..." % num_files)
 
-def identify_sequences(videos_by_creation_time, creation_times):
+    for idx, clip in enumerate(clips):
+        if clip.duration is not None:
+            # Already analyzed in a previous run
+            continue
+        logging.debug("Analyzing file %d/%d: '%s'" % (idx + 1, num_files, clip.file_path))
+        if clip.size is None:
+            if not os.path.isfile(clip.file_path):
+                if failed is None:
+                    raise Exception("There is no file to analyze at '%s'" % clip.file_path)
+                logging.error("There is no file to analyze at '%s'" % clip.file_path)
+                failed.append(clip)
+                continue
+            stat = os.stat(clip.file_path)
+            (clip.size, clip.mtime) = (stat.st_size, stat.st_mtime)
+        cached_metadata = None
+        if cache:
+            cached_metadata = probe_cache.get_metadata(cache, clip.file_path, clip.size, clip.mtime)
+        if cached_metadata:
+            (clip.duration, clip.creation_time, clip.video) = cached_metadata
+        else:
+            clips_to_probe.append(clip)
+
+    if cache:
+        logging.info("The metadata of %d/%d files was retrieved from the probe cache." % (num_files - len(clips_to_probe), num_files))
+
+    if clips_to_probe:
+        logging.info("Probing %d video files using %d workers..." % (len(clips_to_probe), probe_workers))
+        files_to_probe = [clip.file_path for clip in clips_to_probe]
+        failed_indexes = [] if failed is not None else None
+        for (clip, metadata) in zip(clips_to_probe, probe_files(files_to_probe, probe_workers, probe_backend, failed_indexes)):
+            if metadata is None:
+                failed.append(clip)
+                continue
+            (clip.duration, clip.creation_time, clip.video) = metadata
+            if cache:
+                probe_cache.store_metadata(cache, clip.file_path, clip.size, clip.mtime, clip.duration, clip.creation_time, clip.video)
+        if cache:
+            cache.commit()
+
+    for clip in clips:
+        if clip.duration is not None:
+            logging.debug("File '%s': Duration: '%.3f', Creation Time: '%s'" %(clip.file_path, clip.duration, clip.creation_time))
+
+def open_probe_cache(folders, args):
+    if args.no_probe_cache:
+        logging.info("Not using the probe cache due to --no-probe-cache parameter.")
+        return None
+    cache = probe_cache.open_cache(args.probe_cache)
+    if args.rebuild_probe_cache:
+        logging.info("Rebuilding the probe cache due to --rebuild-probe-cache parameter.")
+        probe_cache.clear_cache(cache)
+    else:
+        # Forget about the files that have been deleted from the actioncams
+        for folder in folders:
+            probe_cache.evict_missing_files(cache, folder)
+    return cache
+
+def open_sequence_index(args):
+    if args.no_sequence_index:
+        logging.info("Not using the sequence index due to --no-sequence-index parameter.")
+        return None
+    return sequence_index.open_index(args.sequence_index)
+
+def select_files_to_analyze(clips, folders, cache, full_scan):
+    # Returns the clips that haven't been handled in a previous run
+    # The metadata of the clips already in the probe cache is filled in, they don't need to be probed again
+    clips_to_analyze = []
+    outdated_files = []
+    num_new = 0
+    num_done = 0
+    if not cache:
+        return clips
+
+    indexed_clips = probe_cache.load_clips(cache)
+    for clip in clips:
+        if clip.size is None:
+            stat = os.stat(clip.file_path)
+            (clip.size, clip.mtime) = (stat.st_size, stat.st_mtime)
+        indexed = indexed_clips.pop(os.path.abspath(clip.file_path), None)
+        if indexed and indexed[0].size == clip.size and indexed[0].mtime == clip.mtime:
+            (indexed_clip, done) = indexed
+            if done and not full_scan:
+                # This clip is part of a closed sequence that was handled in a previous run
+                num_done += 1
+                continue
+            # This clip is part of the trailing sequence, which could be extended by the new files
+            (clip.duration, clip.creation_time, clip.video) = (indexed_clip.duration, indexed_clip.creation_time, indexed_clip.video)
+        else:
+            num_new += 1
+            if indexed:
+                # This file has been modified since it was probed
+                outdated_files.append(indexed[0].file_path)
+        clips_to_analyze.append(clip)
+
+    # Forget about the modified files and the files that have been deleted from the actioncams
+    prefixes = tuple(os.path.join(os.path.abspath(folder), "") for folder in folders)
+    outdated_files += [f for f in indexed_clips if f.startswith(prefixes)]
+    probe_cache.remove_clips(cache, outdated_files)
+
+    logging.info("%d new files, %d files from the trailing sequences, %d files already handled in previous runs (use --full-scan to analyze them again)." % (num_new, len(clips_to_analyze) - num_new, num_done))
+    return clips_to_analyze
+
+def flag_done_sequences(cache, sequences, done_sequences, args):
+    # done_sequences: the sequences uploaded during this run or found already uploaded
+    if args.dry_run or args.no_net:
+        logging.info("Not flagging the sequences as done in the probe cache due to --dry-run or --no-net parameter.")
+        return
+    # All the sequences but the last one of each device are closed, and won't be analyzed anymore once they are uploaded
+    # (the sequences skipped by --min-length/--max-length or not selected in --interactive mode are analyzed again by the next run)
+    trailing_sequences = {}
+    for seq in sequences:
+        trailing_sequences[seq.device] = seq
+    done = set(id(seq) for seq in done_sequences)
+    closed_sequences = [seq for seq in sequences if seq is not trailing_sequences[seq.device] and id(seq) in done]
+    probe_cache.mark_done(cache, closed_sequences)
+    logging.debug("Flagged %d closed sequences as done in the probe cache." % len(closed_sequences))
+
+def clip_sort_key(clip):
+    # The file path breaks the ties between clips created during the same second
+    return (clip.creation_time, clip.device or "", clip.file_path)
+
+def segment_clips(clips, gap_seconds):
     sequences = []
-    new_sequence = []
-    previous_end_time = None
-
-    # Sort the creation dates
-    creation_times.sort()
-    logging.debug("creation_times: %s" % creation_times)
-
-    # Loop over the sorted creation times, identify adjacent videos to recreate full sequences
-    for ts in creation_times:
-        v = videos_by_creation_time[ts]
-        if not previous_end_time:
-            new_sequence = [{"file_path": v["file_path"], "duration": v["duration"], "creation_time": ts}]
+    current_sequences = {}
+    previous_end_times = {}
+    gap = timedelta(seconds=gap_seconds)
+
+    # Sort the clips of each device by creation time
+    clips_by_device = {}
+    for clip in clips:
+        clips_by_device.setdefault(clip.device, []).append(clip)
+    for device_clips in clips_by_device.values():
+        device_clips.sort(key=clip_sort_key)
+
+    # Merge the sorted clips of all devices, identify adjacent videos of each device to recreate full sequences
+    for clip in heapq.merge(*clips_by_device.values(), key=clip_sort_key):
+        previous_end_time = previous_end_times.get(clip.device)
+        # Videos less than gap_seconds apart are considered part of the same sequence
+        if previous_end_time and clip.creation_time - previous_end_time < gap:
+            # Add this video to the current sequence of this device
+            current_sequences[clip.device].append(clip)
         else:
-            # Videos less than 30 seconds apart are considered part of the same sequence
-            if ts - previous_end_time < timedelta(seconds=30):
-                # Add this video to the current sequences
-                new_sequence.append({"file_path": v["file_path"], "duration": v["duration"], "creation_time": ts})
-            else:
-                # Save the previous sequence and start a new sequence
-                sequences.append(new_sequence)
-                new_sequence = [{"file_path": v["file_path"], "duration": v["duration"], "creation_time": ts}]
+            # Start a new sequence for this device
+            current_sequences[clip.device] = Sequence([clip])
+            sequences.append(current_sequences[clip.device])
         # Save this video's end time to compare with the next video's start time
-        previous_end_time = ts + timedelta(seconds=videos_by_creation_time[ts]["duration"])
+        previous_end_times[clip.device] = clip.creation_time + timedelta(seconds=clip.duration)
+    return sequences
+
+def identify_sequences(clips, gap_seconds=30):
+    sequences = segment_clips(clips, gap_seconds)
 
-    # Store the last new sequence
-    if new_sequence:
-        sequences.append(new_sequence)
     logging.info("Sequences identified: %d" % len(sequences))
     logging.debug(sequences)
 
     return sequences
 
-def analyze_folder(folder):
-    #pattern = "%s/*.mp4" % folder
-    pattern = "%s/*.MOV" % folder
-    logging.debug("Checking files matching pattern '%s'" % pattern)
-    files = glob.glob(pattern)
-    logging.info("There are %d files matching the pattern '%s'." % (len(files), pattern))
-    logging.debug('\n'.join(files))
-
-    return files if len(files) > 0 else None
+def analyze_folder(folder, device=None, extensions=discovery.DEFAULT_EXTENSIONS):
+    logging.debug("Checking files with extensions %s in folder '%s' and its subfolders" % (", ".join(extensions), folder))
+    clips = [Clip(file_path, size=size, mtime=mtime, device=device) for (file_path, size, mtime) in discovery.scan_video_files(folder, extensions)]
+    logging.info("There are %d files with extensions %s in folder '%s'." % (len(clips), ", ".join(extensions), folder))
+    logging.debug('\n'.join(clip.file_path for clip in clips))
+
+    return clips if len(clips) > 0 else None
+
+def parse_folder_arguments(folder_arguments):
+    # Each folder can be labelled with a device id, as DEVICE=PATH
+    # (an existing folder whose path contains "=", or a prefix containing a path separator, isn't a label)
+    sources = []
+    for folder_argument in folder_arguments:
+        (device, separator, path) = folder_argument.partition("=")
+        if os.path.exists(folder_argument) or not device or os.sep in device or (os.altsep and os.altsep in device):
+            (device, separator, path) = ("", "", folder_argument)
+        if not separator and len(folder_arguments) > 1:
+            # Use the name of the folder as device id
+            device = os.path.basename(os.path.normpath(path))
+        sources.append((device or None, path))
+    devices = [device for (device, path) in sources]
+    for device in devices:
+        if devices.count(device) > 1:
+            logging.critical("The device id '%s' is used for several folders, label each folder as DEVICE=PATH. Exiting..." % device)
+            sys.exit(19)
+    return sources
 
 def detect_folder(args):
-    folder = None
-    files = None
+    folders = []
+    clips = []
     if args.folder:
-        check_folder = os.path.abspath(args.folder)
-        logging.debug("Checking if provided folder '%s' is valid." % check_folder)
-        # Check if provided folder is valid
-        if not os.path.exists(check_folder):
-            logging.critical("Provided folder does not exist. Exiting...")
-            sys.exit(10)
-        folder = check_folder
-        logging.debug("The provided folder '%s' exists." % folder)
-        files = analyze_folder(folder)
-        if not files:
-            logging.critical("The provided folder '%s' does not contain any processable video files. Exiting..." % check_folder)
+        for (device, folder) in parse_folder_arguments(args.folder):
+            check_folder = os.path.abspath(folder)
+            logging.debug("Checking if provided folder '%s' is valid." % check_folder)
+            # Check if provided folder is valid
+            if not os.path.exists(check_folder):
+                logging.critical("Provided folder '%s' does not exist. Exiting..." % check_folder)
+                sys.exit(10)
+            logging.debug("The provided folder '%s' exists." % check_folder)
+            folder_clips = analyze_folder(check_folder, device, args.extensions)
+            folders.append(check_folder)
+            if not folder_clips:
+                logging.warning("The provided folder '%s' does not contain any processable video files." % check_folder)
+                continue
+            clips += folder_clips
+        if not clips and not args.watch:
+            logging.critical("The provided folders do not contain any processable video files. Exiting...")
             sys.exit(11)
     else:
         # Try to identify the folder automatically
         logging.debug("Start automatic folder detection.")
-        # TODO
-        if not folder:
+        for folder in camera_detection.detect_camera_folders(args.detect_root, args.last_volume, args.extensions):
+            folders.append(folder)
+            clips += analyze_folder(folder, None, args.extensions) or []
+        if not folders:
             logging.critical("Automatic folder detection failed. Exiting...\n(You can point to an explicit folder using the `--folder` argument).")
             sys.exit(12)
-    logging.debug("Continuing with the %d files in folder '%s'." % (len(files), folder))
-    return (folder, files)
+    logging.debug("Continuing with the %d files in folders %s." % (len(clips), folders))
+    return (folders, clips)
+
+def positive_int(value):
+    ivalue = int(value)
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % value)
+    return ivalue
+
+def non_negative_int(value):
+    ivalue = int(value)
+    if ivalue < 0:
+        raise argparse.ArgumentTypeError("%s is not a non-negative integer" % value)
+    return ivalue
+
+def positive_float(value):
+    fvalue = float(value)
+    if fvalue <= 0:
+        raise argparse.ArgumentTypeError("%s is not a positive number" % value)
+    return fvalue
 
 def parse_args(arguments):
     parser = argparse.ArgumentParser(description="Automatically upload videos from an Action Cam to YouTube.")
-    parser.add_argument("-f", "--folder", required=False, help="Path to folder containing the video files.")
+    parser.add_argument("-f", "--folder", nargs="+", required=False, help="Path to folder containing the video files. Several folders (one per actioncam) can be passed, labelled with a device id as DEVICE=PATH.")
+    parser.add_argument("-e", "--extensions", nargs="+", default=list(discovery.DEFAULT_EXTENSIONS), help="Extensions of the video files (case-sensitive), looked for in the folder and its subfolders. The .LRV and .THM preview files are always ignored.")
+    parser.add_argument("-dtr", "--detect-root", nargs="+", default=[], help="When no folder is provided, look for the actioncam in the subfolders of these folders (e.g. /media/$USER) instead of the removable mounts.")
+    parser.add_argument("-lv", "--last-volume", default="actioncam-upload-volume.json", help="Path to the file remembering the last automatically detected actioncam, which gets checked first.")
     parser.add_argument("-t", '--title', help='Will be prepended to the video title')
     parser.add_argument("-ds", '--description', help='Video description')
     parser.add_argument("-c", '--category', help='Numeric video category. See https://developers.google.com/youtube/v3/docs/videoCategories/list')
@@ -434,6 +1332,48 @@ def parse_args(arguments):
     parser.add_argument("-nc", "--no-compression", action='store_true', required=False, help="Do not compress the files before uploading.")
     parser.add_argument("-min", "--min-length", type=int, help="Do not consider sequences shorter than this number of minutes.")
     parser.add_argument("-max", "--max-length", type=int, help="Do not consider sequences longer than this number of minutes.")
+    parser.add_argument("-gs", "--gap-seconds", type=positive_float, default=30, help="Videos less than this number of seconds apart are considered part of the same sequence.")
+    parser.add_argument("-pcf", "--probe-cache", default="actioncam-upload-cache.sqlite", help="Path to the file caching the metadata of the video files between runs, and flagging the files handled in previous runs.")
+    parser.add_argument("-npc", "--no-probe-cache", action='store_true', required=False, help="Do not use the probe cache, analyze all the video files with ffprobe (including the ones handled in previous runs).")
+    parser.add_argument("-rpc", "--rebuild-probe-cache", action='store_true', required=False, help="Empty the probe cache and analyze all the video files with ffprobe again.")
+    parser.add_argument("-pw", "--probe-workers", type=positive_int, default=4, help="Number of video files to analyze with ffprobe at the same time.")
+    parser.add_argument("-si", "--sequence-index", default="actioncam-upload-index.sqlite", help="Path to the file keeping track of the sequences uploaded in previous runs.")
+    parser.add_argument("-nsi", "--no-sequence-index", action='store_true', required=False, help="Do not use the sequence index, and analyze the files handled in previous runs again.")
+    parser.add_argument("-fs", "--full-scan", action='store_true', required=False, help="Analyze all the files, including the ones from closed sequences handled in previous runs.")
+    parser.add_argument("-pb", "--probe-backend", choices=["native", "ffprobe"], default="native", help="Read the duration and creation time from the MOV/MP4 header (falling back to ffprobe), or always use ffprobe.")
+    parser.add_argument("-sp", "--single-pass", action='store_true', required=False, help="Compress and merge the files of a sequence in a single FFmpeg pass, writing only the file to upload to the disk.")
+    parser.add_argument("-ep", "--encoder-profile", choices=sorted(encoder_profiles.PROFILES), default=encoder_profiles.DEFAULT_PROFILE, help="Encoder settings (codec, preset, CRF, scaling, frame rate, threads) used to compress the videos.")
+    parser.add_argument("-b", "--benchmark", nargs="*", metavar="FILE", required=False, help="Compress these video files (or a synthetic clip if none is given) with each encoder profile, report the speed and size of each profile, then exit.")
+    parser.add_argument("-bp", "--benchmark-profiles", nargs="+", choices=sorted(encoder_profiles.PROFILES), required=False, help="Encoder profiles to compare with --benchmark, by default all of them.")
+    parser.add_argument("-bs", "--benchmark-seconds", type=positive_int, default=20, help="Duration of the synthetic clip of --benchmark, in seconds.")
+    parser.add_argument("-ae", "--adaptive-encoding", action='store_true', required=False, help="Compress each sequence only as much as needed to meet --target-height, --target-fps and --target-bitrate, the sequences already meeting them are uploaded without re-encoding.")
+    parser.add_argument("-th", "--target-height", type=positive_int, default=720, help="Maximum height of the videos with --adaptive-encoding, in pixels.")
+    parser.add_argument("-tf", "--target-fps", type=positive_float, default=25, help="Maximum frame rate of the videos with --adaptive-encoding, in images/second.")
+    parser.add_argument("-tb", "--target-bitrate", type=positive_int, default=4000, help="Maximum video bitrate with --adaptive-encoding, in kbit/s.")
+    parser.add_argument("-uw", "--upload-window", type=positive_float, required=False, help="Number of hours within which the uploads must be done. The video bitrate of the compressed sequences gets capped to fit the uplink rate.")
+    parser.add_argument("-ur", "--uplink-rate", type=positive_float, required=False, help="Uplink rate for --upload-window, in Mbit/s. By default, the rate measured on the previous uploads (kept in the upload ledger).")
+    parser.add_argument("-dds", "--drop-dead-spans", action='store_true', required=False, help="Detect the static and black spans of the videos (FFmpeg freezedetect and blackdetect filters), drop them before compressing and uploading, and list them in the description.")
+    parser.add_argument("-dsd", "--dead-span-seconds", type=positive_float, default=10, help="Minimum duration of the static and black spans dropped by --drop-dead-spans, in seconds.")
+    parser.add_argument("-sps", "--split-segments", type=positive_int, default=1, help="Split long files at keyframes into up to this number of segments, compressed in parallel (see --encode-workers) and joined without re-encoding.")
+    parser.add_argument("-st", "--stream", action='store_true', required=False, help="Upload each sequence while FFmpeg compresses and merges it, without writing it to the disk.")
+    parser.add_argument("-ec", "--encode-cache", help="Path to a folder keeping the compressed and merged sequences until they are uploaded, so that they don't need to be compressed again after a failed upload.")
+    parser.add_argument("-ecs", "--encode-cache-size", type=positive_float, default=20, help="Maximum size of the encode cache, in GB. The least recently used files get deleted first.")
+    parser.add_argument("-es", "--encode-stats", default=None, help="Path to the CSV file recording the duration, speed and output size of each FFmpeg encode (not recorded by default).")
+    parser.add_argument("-sts", "--stall-seconds", type=positive_int, default=ffmpeg_progress.STALL_SECONDS, help="Warn about the FFmpeg commands making no progress for this number of seconds.")
+    parser.add_argument("-sd", "--scratch-dir", required=False, help="Folder in which each run creates its workspace, holding the temporary files (e.g. on a fast drive or a tmpfs). By default, the system temporary folder.")
+    parser.add_argument("-sr", "--scratch-reserve", type=positive_float, default=1, help="Free space to keep in the scratch folder, in GB. Exits before starting a sequence that would need more space.")
+    parser.add_argument("-ew", "--encode-workers", type=positive_int, default=1, help="Number of video files to compress with FFmpeg at the same time.")
+    parser.add_argument("-et", "--encode-threads", type=non_negative_int, help="Total number of threads of the FFmpeg compress commands, split across the --encode-workers (0: FFmpeg default; default: the number of cores when using several workers).")
+    parser.add_argument("-cw", "--copy-workers", type=positive_int, default=1, help="Number of sequences to pre-copy at the same time (with --pre-copy).")
+    parser.add_argument("-sw", "--sequence-workers", type=positive_int, default=1, help="Number of sequences to compress and merge at the same time, while the previous ones are uploaded.")
+    parser.add_argument("-mpu", "--max-pending-uploads", type=positive_int, default=2, help="Maximum number of compressed sequences kept on the disk, waiting to be uploaded or being uploaded.")
+    parser.add_argument("-ul", "--upload-ledger", default="actioncam-upload-ledger.sqlite", help="Path to the file keeping track of the videos uploaded to YouTube, so that only the videos uploaded since the previous run need to be fetched.")
+    parser.add_argument("-nul", "--no-upload-ledger", action='store_true', required=False, help="Do not use the upload ledger, fetch the list of all the uploaded videos on each run.")
+    parser.add_argument("-rul", "--resync-upload-ledger", action='store_true', required=False, help="Empty the upload ledger and fetch the list of all the uploaded videos again (e.g. after deleting videos on YouTube).")
+    parser.add_argument("-w", "--watch", action='store_true', required=False, help="Keep running, and handle the new sequences as they get recorded in the folders.")
+    parser.add_argument("-ss", "--settle-seconds", type=positive_float, default=10, help="In watch mode, files unchanged for this number of seconds are considered completely written.")
+    parser.add_argument("-pi", "--poll-interval", type=positive_float, default=5, help="In watch mode, number of seconds between the scans of the folders.")
+    parser.add_argument("-ni", "--no-inotify", action='store_true', required=False, help="In watch mode, scan the folders at a regular interval instead of being notified of the changes.")
     parser.add_argument(
         '-d', '--debug',
         help="Print lots of debugging statements",
@@ -446,6 +1386,10 @@ def parse_args(arguments):
         action="store_const", dest="loglevel", const=logging.INFO,
     )
     args = parser.parse_args(arguments)
+    if args.watch and args.interactive:
+        parser.error("--watch and --interactive can't be used together")
+    if args.split_segments > 1 and (args.single_pass or args.stream):
+        parser.error("--split-segments can't be used with --single-pass or --stream")
 
     # Add some more arguments
     if args.loglevel:
@@ -455,18 +1399,217 @@ def parse_args(arguments):
 
     return args
 
+def process_sequences(sequences, youtube, args, index=None):
+    # Returns the sequences uploaded, or found already uploaded
+    # Check which sequences have already been uploaded and which ones are new
+    done_sequences = []
+    new_sequences = analyze_sequences(sequences, youtube, args, index, done_sequences)
+
+    if(len(new_sequences) > 0):
+        # Copy (with --pre-copy), combine new sequences into individual files and upload the combined files
+        done_sequences += compress_merge_and_upload_sequences(new_sequences, [], youtube, args, index)
+    return done_sequences
+
+def get_sources(folders, args):
+    # List of (folder, device id) to watch
+    if args.folder:
+        return [(os.path.abspath(folder), device) for (device, folder) in parse_folder_arguments(args.folder)]
+    return [(folder, None) for folder in folders]
+
+def scan_sources(sources, extensions):
+    clips = []
+    for (folder, device) in sources:
+        clips += [Clip(file_path, size=size, mtime=mtime, device=device) for (file_path, size, mtime) in discovery.scan_video_files(folder, extensions)]
+    return clips
+
+def create_watch_state(clips, folders, cache, args, now):
+    # The clips known from the probe cache are ready straight away, the other ones are analyzed once they are settled
+    state = {"clips": {}, "pending": {}, "ready_times": {}, "handled": set(), "failed": {}}
+    selected = set()
+    for clip in select_files_to_analyze(clips, folders, cache, args.full_scan):
+        selected.add(clip.original_path)
+        if clip.duration is not None:
+            state["clips"][clip.original_path] = clip
+            state["ready_times"][clip.original_path] = now
+    state["handled"] = set(clip.original_path for clip in clips) - selected
+    return state
+
+def watch_iteration(state, sources, cache, index, youtube, args, now):
+    # Scan the folders, analyze the settled files and handle the closed sequences
+    # Returns the list of sequences handled during this iteration
+    ready_clips = []
+    pending = {}
+    for clip in scan_sources(sources, args.extensions):
+        if clip.original_path in state["clips"] or clip.original_path in state["handled"]:
+            continue
+        if state["failed"].get(clip.original_path) == (clip.size, clip.mtime):
+            # This file couldn't be analyzed, it's tried again if it changes
+            continue
+        previous = state["pending"].get(clip.original_path)
+        if previous and (previous[0], previous[1]) == (clip.size, clip.mtime):
+            if now - previous[2] >= args.settle_seconds:
+                # The file hasn't changed for a while, the actioncam is done writing it
+                ready_clips.append(clip)
+                continue
+            pending[clip.original_path] = previous
+        else:
+            logging.debug("File '%s' is being written." % clip.original_path)
+            pending[clip.original_path] = (clip.size, clip.mtime, now, clip.device)
+    state["pending"] = pending
+
+    if ready_clips:
+        logging.info("%d new files are ready to be analyzed." % len(ready_clips))
+        failed = []
+        probe_clips(ready_clips, cache, args.probe_workers, args.probe_backend, failed)
+        for clip in failed:
+            logging.warning("Skipping the file '%s', which can't be analyzed." % clip.original_path)
+            state["failed"][clip.original_path] = (clip.size, clip.mtime)
+        for clip in ready_clips:
+            if clip in failed:
+                continue
+            state["clips"][clip.original_path] = clip
+            state["ready_times"][clip.original_path] = now
+    if not state["clips"]:
+        return []
+
+    # A sequence is closed once it's followed by another one, or when its actioncam hasn't written anything for --gap-seconds
+    sequences = identify_sequences(list(state["clips"].values()), args.gap_seconds)
+    last_sequences = {}
+    for seq in sequences:
+        last_sequences[seq.device] = seq
+    writing_devices = set(p[3] for p in pending.values())
+    closed_sequences = []
+    for seq in sequences:
+        if seq is last_sequences[seq.device]:
+            if seq.device in writing_devices:
+                continue
+            if now - max(state["ready_times"][clip.original_path] for clip in seq) < args.gap_seconds:
+                continue
+        closed_sequences.append(seq)
+    if not closed_sequences:
+        return []
+
+    logging.info("%d sequences are complete." % len(closed_sequences))
+    done_sequences = process_sequences(closed_sequences, youtube, args, index)
+    for seq in closed_sequences:
+        for clip in seq:
+            state["handled"].add(clip.original_path)
+            del state["clips"][clip.original_path]
+            del state["ready_times"][clip.original_path]
+    if cache and index and not args.dry_run and not args.no_net:
+        probe_cache.mark_done(cache, done_sequences)
+    return closed_sequences
+
+def watch_folders(sources, youtube, args):
+    folders = [folder for (folder, device) in sources]
+    index = open_sequence_index(args)
+    cache = open_probe_cache(folders, args)
+    # The clips handled in previous runs are flagged in the probe cache, they are analyzed again with --no-sequence-index
+    state = create_watch_state(scan_sources(sources, args.extensions), folders, cache if index else None, args, time.time())
+    watcher = watch.create_watcher(folders, not args.no_inotify)
+    logging.info("Watching for new video files, press Ctrl+C to stop.")
+    try:
+        while True:
+            watch_iteration(state, sources, cache, index, youtube, args, time.time())
+            # Wake up early on changes, otherwise at a regular interval to check whether the files are settled
+            watcher.wait(args.poll_interval)
+    except KeyboardInterrupt:
+        logging.info("Stopping the watch mode.")
+    finally:
+        watcher.close()
+        if cache:
+            cache.close()
+        if index:
+            index.close()
+
+def create_synthetic_clip(folder, seconds, logging_level):
+    # Create a clip looking like the footage of an actioncam (1080p, 50 images/second, moving pattern), return its path
+    synthetic_clip = os.path.join(folder, "synthetic.mp4")
+    command = ["ffmpeg",
+               "-nostdin",
+               "-f", "lavfi",
+               "-i", "testsrc2=duration=%d:size=1920x1080:rate=50" % seconds,
+               "-c:v", "libx264",
+               "-preset", "ultrafast",
+               "-pix_fmt", "yuv420p",
+               synthetic_clip]
+    logging.debug(" ".join(command))
+    returncode = run_ffmpeg_command(command, logging_level, {"duration": seconds, "label": "synthetic clip"})
+    if 0 != returncode:
+        logging.error("The FFmpeg command creating the synthetic clip returned a non-zero code: %d" % returncode)
+        logging.critical("Exiting...")
+        sys.exit(21)
+    return synthetic_clip
+
+def benchmark_profile(name, clips, folder, args):
+    # Compress the benchmark clips ((path, duration) list) with a profile, return the frames, output bytes and wall time
+    profile = encoder_profiles.PROFILES[name]
+    (frames, size, elapsed) = (0, 0, 0.0)
+    for (idx, (clip, duration)) in enumerate(clips):
+        output_file = os.path.join(folder, "%s-%d%s" % (name, idx, os.path.splitext(clip)[1]))
+        command = get_compress_command(clip, output_file, profile["threads"] or 0, encoder_profiles.profile_options(profile))
+        logging.debug(" ".join(command))
+        pipe = start_ffmpeg_command(command, args.logging_level)
+        try:
+            (status, clip_elapsed) = ffmpeg_progress.monitor(pipe, "%s %s" % (name, os.path.split(clip)[1]), duration, args.stall_seconds)
+        finally:
+            pipe.stdout.close()
+        if 0 != pipe.returncode:
+            logging.warning("The FFmpeg compress command of profile '%s' returned a non-zero code: %d" % (name, pipe.returncode))
+            return None
+        frames += (status and status["frames"]) or 0
+        size += os.path.getsize(output_file)
+        elapsed += clip_elapsed
+        os.remove(output_file)
+    return (frames, size, elapsed)
+
+def run_benchmark(args):
+    # Compare the encoder profiles on sample clips, to pick the settings suiting the hardware
+    folder = workspace.make_dir("benchmark-")
+    try:
+        if args.benchmark:
+            clips = [(clip, ffprobe.duration(ffprobe.probe_fast(os.path.abspath(clip)))) for clip in args.benchmark]
+        else:
+            logging.info("No video file given, creating a synthetic clip of %d seconds." % args.benchmark_seconds)
+            clips = [(create_synthetic_clip(folder, args.benchmark_seconds, args.logging_level), float(args.benchmark_seconds))]
+        source_minutes = sum(duration for (clip, duration) in clips) / 60
+        results = []
+        for name in args.benchmark_profiles or sorted(encoder_profiles.PROFILES):
+            logging.info("Benchmarking encoder profile '%s' on %d clips..." % (name, len(clips)))
+            result = benchmark_profile(name, clips, folder, args)
+            if result:
+                results.append((name,) + result)
+    finally:
+        shutil.rmtree(folder)
+
+    print("%-16s %12s %18s %14s" % ("Profile", "Encode fps", "MB/source minute", "Wall time (s)"))
+    for (name, frames, size, elapsed) in results:
+        print("%-16s %12.1f %18.1f %14.1f" % (name, frames / elapsed if elapsed else 0, size / 1000000.0 / source_minutes, elapsed))
+
 def main():
-    folder = None
-    files = None
+    # Parse the provided command-line arguments
+    args = parse_args(sys.argv[1:])
+
+    # The temporary files of this run go to a workspace of its own, deleted at the end of the run, whatever happens
+    workspace.open_workspace(args.scratch_dir)
+    try:
+        run(args)
+    finally:
+        workspace.close_workspace()
+
+def run(args):
+    folders = None
+    clips = None
     sequences = None
     new_sequences = None
     youtube = None
 
-    # Parse the provided command-line arguments
-    args = parse_args(sys.argv[1:])
+    if args.benchmark is not None:
+        run_benchmark(args)
+        return
 
-    # Validate if the provided folder is valid, or try to automatically detect the folder
-    (folder, files) = detect_folder(args)
+    # Validate if the provided folders are valid, or try to automatically detect the folder
+    (folders, clips) = detect_folder(args)
 
     if args.no_net:
         logging.info("Not authenticating on YouTube due to --no-net parameter.")
@@ -475,22 +1618,30 @@ def main():
         logging.info("Authenticating on YouTube...")
         youtube = yt_get_authenticated_service(args)
 
-    # Analyze the files to identify continuous sequences
-    sequences = analyze_files(files)
-
-    if(len(sequences) > 0):
-        # Check which sequences have already been uploaded and which ones are new
-        new_sequences = analyze_sequences(sequences, youtube, args)
+    if args.watch:
+        # Keep running, and handle the new sequences as they get recorded
+        watch_folders(get_sources(folders, args), youtube, args)
+        logging.info("Done, exiting.")
+        return
 
-        pre_copy_folders = []
-        if(args.pre_copy):
-            # Copy the files from the actioncam to a temporary folder on the computer, useful in case the actioncam gets disconnected
-            (new_sequences, pre_copy_folders) = pre_copy(new_sequences)
+    # Only analyze the files that haven't been handled in a previous run
+    # (they are flagged in the probe cache, and analyzed again with --no-sequence-index)
+    index = open_sequence_index(args)
+    cache = open_probe_cache(folders, args)
+    clips = select_files_to_analyze(clips, folders, cache if index else None, args.full_scan)
 
-        if(len(new_sequences) > 0):
-            # Combine new sequences into individual files and upload the combined files
-            compress_merge_and_upload_sequences(new_sequences, pre_copy_folders, youtube, args)
+    # Analyze the files to identify continuous sequences
+    sequences = analyze_files(clips, cache, args.probe_workers, args.probe_backend, args.gap_seconds)
 
+    if(len(sequences) > 0):
+        done_sequences = process_sequences(sequences, youtube, args, index)
+        if cache and index:
+            flag_done_sequences(cache, sequences, done_sequences, args)
+
+    if cache:
+        cache.close()
+    if index:
+        index.close()
     logging.info("Done, exiting.")
 
 def init():
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Automatic detection of the folder containing the video files, when an
+# actioncam (or its memory card) is mounted.
+#
+# Candidate volumes are the removable mounts listed in /proc/mounts, or the
+# folders directly under a configurable root (e.g. /media/$USER). Volumes
+# containing a DCIM folder with video files are considered to be actioncams.
+# The last detected volume is remembered by filesystem UUID and label, and
+# gets checked first on the next run.
+#
+
+import os
+import json
+import logging
+
+import discovery
+
+# Filesystems typically used on the memory cards of actioncams
+CAMERA_FILESYSTEMS = ("vfat", "exfat", "msdos")
+DISK_BY_UUID = "/dev/disk/by-uuid"
+DISK_BY_LABEL = "/dev/disk/by-label"
+
+
+def unescape_mount_field(field):
+    ''' /proc/mounts escapes spaces, tabs, newlines and backslashes as octal
+    '''
+    for (escaped, character) in [("\\040", " "), ("\\011", "\t"), ("\\012", "\n"), ("\\134", "\\")]:
+        field = field.replace(escaped, character)
+    return field
+
+
+def list_mounts(mounts_file="/proc/mounts"):
+    ''' List of (device, mount point, filesystem type) of the mounted filesystems
+    '''
+    mounts = []
+    try:
+        with open(mounts_file) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3:
+                    mounts.append((fields[0], unescape_mount_field(fields[1]), fields[2]))
+    except IOError as e:
+        logging.debug("Unable to read the list of mounts from '%s': %s" % (mounts_file, e))
+    return mounts
+
+
+def is_removable(device, fstype):
+    ''' Whether a mounted device is a removable drive (memory card, USB storage)
+    '''
+    if not device.startswith("/dev/"):
+        return False
+    # /dev/sdb1 -> /sys/class/block/sdb1 -> /sys/block/sdb/removable
+    sys_path = os.path.realpath(os.path.join("/sys/class/block", os.path.basename(device)))
+    for path in [sys_path, os.path.dirname(sys_path)]:
+        try:
+            with open(os.path.join(path, "removable")) as f:
+                if f.read().strip() == "1":
+                    return True
+        except IOError:
+            pass
+    return fstype in CAMERA_FILESYSTEMS
+
+
+def find_link_name(links_folder, device):
+    ''' Name of the symlink in links_folder pointing to device, or None
+    '''
+    try:
+        names = os.listdir(links_folder)
+    except OSError:
+        return None
+    device = os.path.realpath(device)
+    for name in names:
+        if os.path.realpath(os.path.join(links_folder, name)) == device:
+            # udev escapes the spaces in the labels
+            return name.replace("\\x20", " ")
+    return None
+
+
+def volume_identity(device, mount_point):
+    ''' Identify a volume by its filesystem UUID and label
+    '''
+    return {"uuid": find_link_name(DISK_BY_UUID, device) if device else None,
+            "label": find_link_name(DISK_BY_LABEL, device) if device else os.path.basename(mount_point),
+            "mount_point": mount_point}
+
+
+def same_volume(volume, other):
+    if volume.get("uuid") and other.get("uuid"):
+        return volume["uuid"] == other["uuid"]
+    if volume.get("label") and other.get("label"):
+        return volume["label"] == other["label"]
+    return volume.get("mount_point") == other.get("mount_point")
+
+
+def list_candidate_volumes(roots, mounts_file="/proc/mounts"):
+    ''' List of the volumes that could be an actioncam, as dicts (uuid, label, mount_point)
+
+    @roots : Folders whose subfolders are candidate mount points. If empty,
+             the removable mounts from mounts_file are used.
+    '''
+    volumes = []
+    if roots:
+        for root in roots:
+            try:
+                names = sorted(os.listdir(root))
+            except OSError as e:
+                logging.debug("Unable to list the folder '%s': %s" % (root, e))
+                continue
+            for name in names:
+                mount_point = os.path.join(root, name)
+                if os.path.isdir(mount_point):
+                    volumes.append(volume_identity(None, mount_point))
+    else:
+        for (device, mount_point, fstype) in list_mounts(mounts_file):
+            if is_removable(device, fstype):
+                volumes.append(volume_identity(device, mount_point))
+    return volumes
+
+
+def find_video_folders(mount_point, extensions):
+    ''' The DCIM folder of a volume, if it (or its 100MEDIA, ... subfolders) contains video files
+    '''
+    dcim = os.path.join(mount_point, "DCIM")
+    if os.path.isdir(dcim) and discovery.contains_video_files(dcim, extensions):
+        return [dcim]
+    return []
+
+
+def load_last_volume(last_volume_file):
+    try:
+        with open(last_volume_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def save_last_volume(last_volume_file, volume):
+    with open(last_volume_file, "w") as f:
+        json.dump(volume, f)
+
+
+def detect_camera_folders(roots, last_volume_file, extensions=discovery.DEFAULT_EXTENSIONS, mounts_file="/proc/mounts"):
+    ''' Folders containing the video files of the first detected actioncam
+
+    @roots : Folders whose subfolders are candidate mount points, or an empty
+             list to use the removable mounts.
+    @last_volume_file : JSON file remembering the last detected volume, or None.
+    '''
+    volumes = list_candidate_volumes(roots, mounts_file)
+    logging.debug("Candidate volumes: %s" % volumes)
+
+    # Check the last detected volume first
+    last_volume = load_last_volume(last_volume_file) if last_volume_file else None
+    if last_volume:
+        volumes.sort(key=lambda volume: not same_volume(volume, last_volume))
+
+    for volume in volumes:
+        folders = find_video_folders(volume["mount_point"], extensions)
+        if folders:
+            logging.info("Detected actioncam at '%s' (UUID: %s, label: %s)." % (volume["mount_point"], volume["uuid"], volume["label"]))
+            if last_volume_file:
+                save_last_volume(last_volume_file, volume)
+            return folders
+    return []
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Compact records for the video files (clips), the sequences of adjacent
+# clips and their jobs, passed between the different stages of actioncam-upload.
+#
+
+
+class Clip(object):
+    ''' A video file, with the metadata extracted by ffprobe
+    '''
+    __slots__ = ("original_path", "file_path", "device", "size", "mtime", "duration", "creation_time", "video", "fingerprint", "dead_spans")
+
+    def __init__(self, file_path, duration=None, creation_time=None, size=None, mtime=None, device=None):
+        # Path of the file on the actioncam
+        self.original_path = file_path
+        # Path of the file to use in the next stage (pre-copied or compressed file)
+        self.file_path = file_path
+        # Id of the actioncam this file comes from (None if there is only one actioncam)
+        self.device = device
+        # Size (in bytes) and modification time of the original file
+        self.size = size
+        self.mtime = mtime
+        self.duration = duration
+        self.creation_time = creation_time
+        # Width, height, fps and bit_rate of the video stream (see ffprobe.video_stream()), None if unknown
+        self.video = None
+        # Sampled content fingerprint of the original file, computed when needed
+        self.fingerprint = None
+        # (start, end) static and black spans of the file, in seconds, None if not detected
+        self.dead_spans = None
+
+    def __repr__(self):
+        return "Clip(%r, %r, %r)" % (self.file_path, self.duration, self.creation_time)
+
+
+class Sequence(object):
+    ''' A list of adjacent clips, uploaded as one video
+    '''
+    __slots__ = ("clips",)
+
+    def __init__(self, clips=None):
+        self.clips = clips if clips is not None else []
+
+    def __len__(self):
+        return len(self.clips)
+
+    def __iter__(self):
+        return iter(self.clips)
+
+    def __getitem__(self, idx):
+        return self.clips[idx]
+
+    def __repr__(self):
+        return "Sequence(%r)" % self.clips
+
+    def append(self, clip):
+        self.clips.append(clip)
+
+    @property
+    def creation_time(self):
+        ''' Creation time of the first clip, used to name the sequence
+        '''
+        return self.clips[0].creation_time
+
+    @property
+    def device(self):
+        ''' Id of the actioncam the clips come from
+        '''
+        return self.clips[0].device
+
+    @property
+    def duration(self):
+        ''' Total duration of the clips, in seconds
+        '''
+        return sum(clip.duration for clip in self.clips)
+
+    @property
+    def size(self):
+        ''' Total size of the original files, in bytes (0 for the files of unknown size)
+        '''
+        return sum(clip.size or 0 for clip in self.clips)
+
+
+class Job(object):
+    ''' A sequence going through the stages of the pipeline (copy, compress, upload)
+    '''
+    __slots__ = ("seq", "idx", "tempdir", "file_to_upload", "cache_key", "response", "done", "plan", "bitrate", "reserved", "description_note")
+
+    def __init__(self, seq, idx, plan=None):
+        self.seq = seq
+        # Position of the sequence, to report the progress
+        self.idx = idx
+        # Temporary folder holding the compressed and merged files
+        self.tempdir = None
+        self.file_to_upload = None
+        # Key of the file to upload in the encode cache, None if not cached
+        self.cache_key = None
+        # Response of the YouTube API, None if not uploaded
+        self.response = None
+        # Whether the temporary files have been deleted
+        self.done = False
+        # Encode plan (--adaptive-encoding) and capped bitrate (--upload-window), None if not planned
+        self.plan = plan
+        self.bitrate = None
+        # Space reserved in the workspace, in bytes
+        self.reserved = 0
+        # Note listing the dropped static and black spans in the description of the video
+        self.description_note = None
+
+    def __repr__(self):
+        return "Job(%r, %r)" % (self.seq, self.idx)
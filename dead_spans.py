@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Static and black spans of the videos, dropped by the --drop-dead-spans
+# mode before they get compressed and uploaded.
+#
+# A parked dashcam or a chest-cam lying on a table records long stretches of
+# nothing. An analysis pass through FFmpeg's freezedetect and blackdetect
+# filters (decoding only, nothing gets encoded) finds the spans lasting more
+# than a threshold. The remaining spans are kept, either through select and
+# aselect filters when the file gets re-encoded, or through the inpoint and
+# outpoint directives of the concat demuxer when it's merged as is.
+#
+
+import re
+import datetime
+
+# Noise tolerance of freezedetect, and luminance threshold of blackdetect
+FREEZE_NOISE = "-60dB"
+BLACK_PIXEL_THRESHOLD = 0.10
+# Part of a file kept when it's entirely static or black, so that it remains a valid video
+MIN_KEPT_SECONDS = 1.0
+
+# [freezedetect @ 0x...] lavfi.freezedetect.freeze_start: 5.005
+FREEZE_PATTERN = re.compile(r"lavfi\.freezedetect\.freeze_(start|end): *([\d.]+)")
+# [blackdetect @ 0x...] black_start:0 black_end:2.5 black_duration:2.5
+BLACK_PATTERN = re.compile(r"black_start: *([\d.]+) +black_end: *([\d.]+)")
+
+
+def get_detect_command(file_path, min_seconds):
+    ''' FFmpeg command logging the static and black spans of a file, lasting at least min_seconds
+    '''
+    return ["ffmpeg",
+            "-nostdin",
+            "-hide_banner",
+            "-i", file_path,
+            "-an",
+            "-vf", "freezedetect=n=%s:d=%g,blackdetect=d=%g:pix_th=%.2f" % (FREEZE_NOISE, min_seconds, min_seconds, BLACK_PIXEL_THRESHOLD),
+            "-f", "null",
+            "-"]
+
+
+def merge_spans(spans, min_seconds=0):
+    ''' Sorted union of the (start, end) spans, without the spans shorter than min_seconds
+    '''
+    merged = []
+    for (start, end) in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return [(start, end) for (start, end) in merged if end - start >= min_seconds]
+
+
+def parse_spans(output, duration, min_seconds=0):
+    ''' Static and black (start, end) spans from the log of the detect command
+
+    @duration : The duration of the file, the end of the spans lasting until the end of the file.
+    '''
+    spans = []
+    freeze_start = None
+    for match in FREEZE_PATTERN.finditer(output):
+        if "start" == match.group(1):
+            freeze_start = float(match.group(2))
+        elif freeze_start is not None:
+            spans.append((freeze_start, float(match.group(2))))
+            freeze_start = None
+    if freeze_start is not None and duration:
+        # Still frozen at the end of the file
+        spans.append((freeze_start, duration))
+    spans += [(float(start), float(end)) for (start, end) in BLACK_PATTERN.findall(output)]
+    return merge_spans(spans, min_seconds)
+
+
+def kept_spans(dead_spans, duration):
+    ''' The (start, end) spans of a file left once its dead spans are removed
+    '''
+    kept = []
+    position = 0.0
+    for (start, end) in dead_spans:
+        if start > position:
+            kept.append((position, start))
+        position = max(position, end)
+    if position < duration:
+        kept.append((position, duration))
+    if not kept:
+        kept.append((0.0, min(MIN_KEPT_SECONDS, duration)))
+    return kept
+
+
+def add_filter(options, option, video_filter):
+    ''' FFmpeg options with a filter inserted before the other filters of option (-vf or -af)
+    '''
+    options = list(options)
+    if option in options:
+        index = options.index(option) + 1
+        options[index] = "%s,%s" % (video_filter, options[index])
+    else:
+        options += [option, video_filter]
+    return options
+
+
+def exclude_options(options, kept):
+    ''' FFmpeg compress options only keeping the kept (start, end) spans of the video and audio
+    '''
+    expression = "+".join("between(t,%.3f,%.3f)" % (start, end) for (start, end) in kept)
+    options = add_filter(options, "-vf", "select='%s',setpts=N/FRAME_RATE/TB" % expression)
+    return add_filter(options, "-af", "aselect='%s',asetpts=N/SR/TB" % expression)
+
+
+def describe(dead_spans):
+    ''' Note for the description of a video, listing the removed (start, end) spans (in seconds from its beginning)
+    '''
+    total = sum(end - start for (start, end) in dead_spans)
+    return "Removed %d static or black spans (%s in total): %s." % (
+        len(dead_spans), datetime.timedelta(seconds=int(total)),
+        ", ".join("%s-%s" % (datetime.timedelta(seconds=int(start)), datetime.timedelta(seconds=int(end))) for (start, end) in dead_spans))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Discovery of the video files in a folder and its subfolders (e.g. the
+# DCIM/100MEDIA, DCIM/101MEDIA, ... folders of an actioncam).
+#
+# os.scandir() is used instead of glob, so that the size and modification
+# time of each file are obtained during the scan, and don't need to be
+# retrieved again by the later stages.
+#
+
+import os
+import logging
+
+DEFAULT_EXTENSIONS = (".MOV",)
+# Low-resolution previews and thumbnails recorded next to the videos by some actioncams
+PREVIEW_EXTENSIONS = (".LRV", ".THM")
+
+
+def scan_video_files(folder, extensions=DEFAULT_EXTENSIONS):
+    ''' Generator of (file path, size, modification time) of the video files
+    in a folder and its subfolders, sorted by path
+
+    @extensions : The (case-sensitive) extensions of the video files.
+    '''
+    try:
+        entries = sorted(os.scandir(folder), key=lambda entry: entry.name)
+    except OSError as e:
+        logging.warning("Unable to scan the folder '%s': %s" % (folder, e))
+        return
+    for entry in entries:
+        if entry.name.startswith("."):
+            # Hidden files and folders (e.g. macOS "._" metadata files)
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            # The symbolic links to folders are not followed, they could loop back to a parent folder
+            for video_file in scan_video_files(entry.path, extensions):
+                yield video_file
+        elif entry.is_file() and entry.name.endswith(tuple(extensions)) and not entry.name.upper().endswith(PREVIEW_EXTENSIONS):
+            stat = entry.stat()
+            yield (entry.path, stat.st_size, stat.st_mtime)
+
+
+def contains_video_files(folder, extensions=DEFAULT_EXTENSIONS):
+    ''' Whether a folder or its subfolders contain at least one video file
+    '''
+    for video_file in scan_video_files(folder, extensions):
+        return True
+    return False
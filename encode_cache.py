@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Cache of the compressed and merged files of the sequences, kept until
+# they are uploaded, so that a run aborted by a failed upload doesn't need
+# to compress the sequences again.
+#
+# The files are named after a key made of the fingerprints of the original
+# clips and the encode settings. The total size of the cache is limited,
+# the least recently used files get evicted first (the modification time of
+# a file is updated each time it's used).
+#
+# The note added to the description of a video (e.g. the static and black
+# spans removed from it) is kept next to its file, so that it doesn't need
+# to be found again when the file comes from the cache.
+#
+
+import os
+import shutil
+import hashlib
+import logging
+
+PARTIAL_SUFFIX = ".part"
+NOTE_SUFFIX = ".note"
+
+
+def get_cache_key(clip_fingerprints, settings):
+    ''' Key of the file produced from these clips with these encode settings, string
+    '''
+    return hashlib.sha1(("\n".join(clip_fingerprints) + "\n" + settings).encode("utf-8")).hexdigest()
+
+
+def list_entries(cache_dir):
+    ''' List of (key, path, size, last use time) of the cached files
+    '''
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return entries
+    for name in names:
+        if name.endswith(NOTE_SUFFIX):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((name.split(".")[0], path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def lookup(cache_dir, key):
+    ''' Path of the cached file for this key (marked as recently used), or None
+    '''
+    for (entry_key, path, size, last_use) in list_entries(cache_dir):
+        if entry_key == key and not path.endswith(PARTIAL_SUFFIX):
+            os.utime(path, None)
+            return path
+    return None
+
+
+def evict(cache_dir, max_size, in_use=()):
+    ''' Delete the least recently used files until the cache fits in max_size bytes
+
+    @in_use : Keys of the files that must be kept (e.g. waiting to be uploaded).
+    '''
+    entries = sorted(list_entries(cache_dir), key=lambda entry: entry[3])
+    total_size = sum(entry[2] for entry in entries)
+    for (key, path, size, last_use) in entries:
+        if total_size <= max_size:
+            break
+        if key in in_use:
+            continue
+        logging.debug("Evicting '%s' (%d bytes) from the encode cache." % (path, size))
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        remove_note(cache_dir, key)
+        total_size -= size
+
+
+def store(cache_dir, key, file_path, max_size, in_use=()):
+    ''' Move a file into the cache, return its new path (or its path if it's larger than the cache)
+    '''
+    size = os.path.getsize(file_path)
+    if size > max_size:
+        logging.info("The file '%s' is larger than the encode cache, not caching it." % file_path)
+        return file_path
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    evict(cache_dir, max_size - size, in_use)
+    cached_path = os.path.join(cache_dir, key + os.path.splitext(file_path)[1])
+    # Only complete files get their final name
+    shutil.move(file_path, cached_path + PARTIAL_SUFFIX)
+    os.replace(cached_path + PARTIAL_SUFFIX, cached_path)
+    return cached_path
+
+
+def remove(cache_dir, key):
+    ''' Delete the cached file for this key, if any
+    '''
+    for (entry_key, path, size, last_use) in list_entries(cache_dir):
+        if entry_key == key:
+            os.remove(path)
+    remove_note(cache_dir, key)
+
+
+def store_note(cache_dir, key, note):
+    ''' Keep the description note of the cached file for this key (an empty string if it has none)
+    '''
+    with open(os.path.join(cache_dir, key + NOTE_SUFFIX), "w") as f:
+        f.write(note)
+
+
+def lookup_note(cache_dir, key):
+    ''' Description note of the cached file for this key, None if it wasn't kept
+    '''
+    try:
+        with open(os.path.join(cache_dir, key + NOTE_SUFFIX)) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def remove_note(cache_dir, key):
+    ''' Delete the description note of the cached file for this key, if any
+    '''
+    try:
+        os.remove(os.path.join(cache_dir, key + NOTE_SUFFIX))
+    except OSError:
+        pass
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Encode planner of the --adaptive-encoding mode, choosing how much work the
+# compression of each clip needs.
+#
+# The fixed compression (half the resolution, 25 images/second) re-encodes
+# every clip, including the clips that are already small, for almost no size
+# gain and a loss of quality. Given the resolution, frame rate and bitrate of
+# a clip, the planner picks the cheapest of:
+#   - copy: the clip already meets the targets, it's uploaded as is,
+#   - scale: the clip is re-encoded at its own frame rate, scaled down to the
+#     target height and with its bitrate capped,
+#   - full: the frame rate is reduced to the target as well.
+# The compressed clips of a sequence are merged without re-encoding, so they
+# all get the most thorough plan of the sequence.
+#
+
+MODES = ["copy", "scale", "full"]
+# Frame rates this close to the target are not reduced (e.g. 25.02 images/second)
+FPS_TOLERANCE = 0.5
+
+
+def plan_clip(info, size, duration, target_height, target_fps, target_bitrate):
+    ''' Plan of the encode of a clip, dict (mode, scale, rate, size, estimated_size)
+
+    @info : The width, height, fps and bit_rate of the video stream (see ffprobe.video_stream()), None if unknown.
+    @target_bitrate : The maximum video bitrate, in kbit/s.
+    '''
+    if info is None:
+        # Nothing known about the clip, compress it fully without expecting any saving
+        return {"mode": "full", "scale": True, "rate": True, "size": size, "estimated_size": size}
+
+    bit_rate = info["bit_rate"]
+    if bit_rate is None and size and duration:
+        bit_rate = size * 8 / duration
+    scale = info["height"] > target_height
+    rate = info["fps"] is not None and info["fps"] > target_fps + FPS_TOLERANCE
+    over_bitrate = bit_rate is not None and bit_rate > target_bitrate * 1000
+    if not (scale or rate or over_bitrate):
+        return {"mode": "copy", "scale": False, "rate": False, "size": size, "estimated_size": size}
+
+    # The bitrate is roughly proportional to the number of pixels per second
+    ratio = 1.0
+    if scale:
+        ratio *= (float(target_height) / info["height"]) ** 2
+    if rate:
+        ratio *= target_fps / info["fps"]
+    estimated_bit_rate = min(bit_rate * ratio, target_bitrate * 1000) if bit_rate else target_bitrate * 1000
+    estimated_size = size
+    if size and duration:
+        estimated_size = min(size, int(estimated_bit_rate * duration / 8))
+    return {"mode": "full" if rate else "scale", "scale": scale, "rate": rate, "size": size, "estimated_size": estimated_size}
+
+
+def plan_sequence(clip_plans, target_height, target_fps, target_bitrate):
+    ''' Plan of the encode of a sequence, from the plans of its clips
+
+    Returns a dict (mode, options, counts, size, estimated_size), the options
+    replacing the default FFmpeg compress options.
+    '''
+    mode = max((plan["mode"] for plan in clip_plans), key=MODES.index)
+    options = []
+    if "copy" != mode:
+        if any(plan["scale"] for plan in clip_plans):
+            # Never scale up the clips that are already small enough
+            options += ["-vf", "scale=-2:'min(%d,ih)'" % target_height]
+        if "full" == mode:
+            options += ["-r", "%g" % target_fps]
+        # Cap the bitrate, without raising the bitrate of the clips below the target
+        options += ["-maxrate", "%dk" % target_bitrate,
+                    "-bufsize", "%dk" % (2 * target_bitrate)]
+    counts = dict((m, len([plan for plan in clip_plans if plan["mode"] == m])) for m in MODES)
+    return {"mode": mode,
+            "options": options,
+            "counts": counts,
+            "size": sum(plan["size"] or 0 for plan in clip_plans),
+            "estimated_size": sum(plan["estimated_size"] or 0 for plan in clip_plans)}
+
+
+def describe_plan(plan):
+    ''' One line description of the plan of a sequence
+    '''
+    return "%s (files: %d copy, %d scale, %d full), %.1f MB -> %.1f MB" % (
+        plan["mode"], plan["counts"]["copy"], plan["counts"]["scale"], plan["counts"]["full"],
+        plan["size"] / 1000000.0, plan["estimated_size"] / 1000000.0)
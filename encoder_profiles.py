@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Named encoder profiles, selected with --encoder-profile, and compared on
+# the hardware at hand with --benchmark.
+#
+# A profile gives the codec, preset and CRF of the encoder, the scaling and
+# frame rate of the video, and the number of threads of each encode. The
+# settings left to None are FFmpeg defaults: the "default" profile is the
+# historical compression (half the resolution, 25 images/second).
+#
+
+DEFAULT_PROFILE = "default"
+
+PROFILES = {
+    "default": {"codec": None, "preset": None, "crf": None, "scale": "iw/2:ih/2", "fps": 25, "threads": None},
+    "x264-fast": {"codec": "libx264", "preset": "veryfast", "crf": 23, "scale": "iw/2:ih/2", "fps": 25, "threads": None},
+    "x264-quality": {"codec": "libx264", "preset": "slow", "crf": 20, "scale": "iw/2:ih/2", "fps": 25, "threads": None},
+    "x264-720p": {"codec": "libx264", "preset": "medium", "crf": 23, "scale": "-2:720", "fps": 30, "threads": None},
+    "x265-small": {"codec": "libx265", "preset": "medium", "crf": 28, "scale": "iw/2:ih/2", "fps": 25, "threads": None},
+}
+
+
+def filter_options(profile):
+    ''' FFmpeg options scaling the video and setting its frame rate, list
+    '''
+    options = []
+    if profile["scale"]:
+        options += ["-vf", "scale=%s" % profile["scale"]]
+    if profile["fps"]:
+        options += ["-r", "%g" % profile["fps"]]
+    return options
+
+
+def codec_options(profile):
+    ''' FFmpeg options of the video encoder, list
+    '''
+    options = []
+    if profile["codec"]:
+        options += ["-c:v", profile["codec"]]
+    if profile["preset"]:
+        options += ["-preset", profile["preset"]]
+    if profile["crf"] is not None:
+        options += ["-crf", "%g" % profile["crf"]]
+    return options
+
+
+def profile_options(profile):
+    ''' FFmpeg compress options of a profile, list
+    '''
+    return filter_options(profile) + codec_options(profile)
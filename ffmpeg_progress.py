@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Live progress of the FFmpeg commands.
+#
+# FFmpeg is run with "-progress pipe:1", writing blocks of key=value lines
+# (frame, fps, total_size, out_time_us, speed...) to its standard output,
+# each block ending with a "progress=continue" or "progress=end" line. The
+# blocks are parsed while FFmpeg runs, to report the fps, speed, output size
+# and ETA of each encode, to warn about the encodes that stop progressing,
+# and to record the throughput of each encode in a CSV stats file.
+#
+
+import os
+import csv
+import time
+import datetime
+import logging
+import threading
+import subprocess as sp
+
+# Seconds between two progress reports of an encode
+REPORT_INTERVAL = 10
+# Seconds without progress after which an encode is reported as stalled
+STALL_SECONDS = 120
+STATS_FIELDS = ["finished", "input", "output", "options", "duration", "elapsed", "frames", "fps", "speed", "size"]
+
+# Several encodes can finish at the same time
+stats_lock = threading.Lock()
+
+
+def progress_command(command):
+    ''' The FFmpeg command, writing its progress to its standard output instead of the stats to its standard error
+    '''
+    return command[:1] + ["-progress", "pipe:1", "-nostats"] + command[1:]
+
+
+def parse_progress(lines):
+    ''' Generator of the progress blocks written by FFmpeg, dicts
+    '''
+    block = {}
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        (key, separator, value) = line.strip().partition("=")
+        if not separator:
+            continue
+        block[key] = value.strip()
+        if "progress" == key:
+            yield block
+            block = {}
+
+
+def parse_number(value):
+    ''' Number from a progress value (e.g. "1.5x"), None if not available (e.g. "N/A")
+    '''
+    try:
+        return float(value.rstrip("x"))
+    except (AttributeError, ValueError):
+        return None
+
+
+def get_status(block, duration=None):
+    ''' Status of an encode from a progress block: frames, fps, speed, size (bytes), out_time and eta (seconds)
+
+    @duration : Duration of the input, in seconds, needed for the ETA.
+    '''
+    # out_time_ms is in microseconds as well, older FFmpeg versions don't write out_time_us
+    out_time = parse_number(block.get("out_time_us", block.get("out_time_ms")))
+    if out_time is not None:
+        out_time /= 1000000.0
+    status = {"frames": parse_number(block.get("frame")),
+              "fps": parse_number(block.get("fps")),
+              "speed": parse_number(block.get("speed")),
+              "size": parse_number(block.get("total_size")),
+              "out_time": out_time,
+              "eta": None}
+    if duration and out_time is not None and status["speed"]:
+        status["eta"] = max(0.0, (duration - out_time) / status["speed"])
+    return status
+
+
+def format_status(label, status, duration=None):
+    ''' One line description of the status of an encode
+    '''
+    parts = [label + ":"]
+    if duration and status["out_time"] is not None:
+        parts.append("%d%%" % min(100, 100 * status["out_time"] / duration))
+    if status["fps"] is not None:
+        parts.append("%.1f fps" % status["fps"])
+    if status["speed"] is not None:
+        parts.append("%.2fx" % status["speed"])
+    if status["size"] is not None:
+        parts.append("%.1f MB" % (status["size"] / 1000000.0))
+    if status["eta"] is not None:
+        parts.append("ETA %s" % datetime.timedelta(seconds=int(status["eta"])))
+    return " ".join(parts)
+
+
+def monitor(pipe, label, duration=None, stall_seconds=STALL_SECONDS):
+    ''' Report the progress of an FFmpeg process until it exits
+
+    Returns the last status of the encode (None if FFmpeg didn't report any
+    progress) and the elapsed time in seconds.
+
+    @pipe : The FFmpeg process, started with progress_command() and its standard output piped.
+    '''
+    start = time.time()
+    state = {"status": None, "last_progress": start}
+
+    def read_progress():
+        for block in parse_progress(pipe.stdout):
+            status = get_status(block, duration)
+            previous = state["status"]
+            if previous is None or (status["out_time"], status["size"]) != (previous["out_time"], previous["size"]):
+                state["last_progress"] = time.time()
+            state["status"] = status
+
+    reader = threading.Thread(target=read_progress, name="ffmpeg-progress")
+    reader.daemon = True
+    reader.start()
+    stalled = False
+    while True:
+        try:
+            pipe.wait(timeout=REPORT_INTERVAL)
+            break
+        except sp.TimeoutExpired:
+            pass
+        if state["status"]:
+            logging.info(format_status(label, state["status"], duration))
+        idle = time.time() - state["last_progress"]
+        if idle > stall_seconds and not stalled:
+            logging.warning("The FFmpeg command for '%s' made no progress for %d seconds, it may be stalled." % (label, idle))
+        stalled = idle > stall_seconds
+    reader.join()
+    return (state["status"], time.time() - start)
+
+
+def write_stats(stats_file, command, status, duration, elapsed):
+    ''' Append the throughput of a finished encode to the CSV stats file
+
+    @command : The FFmpeg command (without the progress options), its options are recorded to compare the encode settings.
+    '''
+    input_index = len(command) - 1 - command[::-1].index("-i")
+    out_time = status["out_time"] if status["out_time"] is not None else duration
+    row = {"finished": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+           "input": command[input_index + 1],
+           "output": command[-1],
+           "options": " ".join(command[input_index + 2:-1]),
+           "duration": "%.3f" % out_time if out_time is not None else "",
+           "elapsed": "%.3f" % elapsed,
+           "frames": "%d" % status["frames"] if status["frames"] is not None else "",
+           "fps": "%.2f" % (status["frames"] / elapsed) if status["frames"] is not None and elapsed > 0 else "",
+           "speed": "%.3f" % (out_time / elapsed) if out_time is not None and elapsed > 0 else "",
+           "size": "%d" % status["size"] if status["size"] is not None else ""}
+    with stats_lock:
+        new_file = not os.path.isfile(stats_file)
+        with open(stats_file, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=STATS_FIELDS)
+            if new_file:
+                writer.writeheader()
+            writer.writerow(row)
@@ -13,10 +13,21 @@
 #
 # man ffprobe # for more information about ffprobe
 #
+# probe_header() reads the same duration and creation time directly from the
+# 'moov/mvhd' atom of MOV/MP4 files, without spawning an ffprobe process,
+# along with the size, frame rate and bitrate of the video track (from its
+# 'tkhd', 'mdhd' and 'stsz' atoms).
+#
 
 import subprocess as sp
 import json
 import datetime
+import mmap
+import struct
+import logging
+
+# The timestamps in the MOV/MP4 headers are seconds since midnight, Jan. 1, 1904 (UTC)
+MOV_EPOCH = datetime.datetime(1904, 1, 1)
 
 
 def probe(vid_file_path):
@@ -41,6 +52,137 @@ def probe(vid_file_path):
     return json.loads(out.decode('utf-8'))
 
 
+def find_atom(buf, start, end, atom_type):
+    ''' Position (payload start, atom end) of the first atom of a given type, or None
+
+    @buf : The content of the file (typically memory-mapped).
+    @start, @end : The boundaries within which to look for sibling atoms.
+    @atom_type : The four-character code of the atom, bytes.
+    '''
+    offset = start
+    while offset + 8 <= end:
+        (size, current_type) = struct.unpack_from('>I4s', buf, offset)
+        header_size = 8
+        if size == 1:
+            # 64-bit atom size, stored after the type
+            if offset + 16 > end:
+                raise Exception('Truncated atom header')
+            size = struct.unpack_from('>Q', buf, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            # This atom extends to the end of its container
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise Exception('Invalid size for atom %s' % current_type)
+        if current_type == atom_type:
+            return (offset + header_size, offset + size)
+        offset += size
+    return None
+
+
+def read_times(buf, payload, payload_end):
+    ''' (creation time, timescale, duration) of a 'mvhd' or 'mdhd' atom, the times being in its timescale
+    '''
+    version = buf[payload]
+    if version == 1:
+        fields_format = '>QQIQ'
+    else:
+        fields_format = '>IIII'
+    if payload + 4 + struct.calcsize(fields_format) > payload_end:
+        raise Exception('Truncated header atom')
+    (creation, modification, timescale, units) = struct.unpack_from(fields_format, buf, payload + 4)
+    return (creation, timescale, units)
+
+
+def read_video_track(buf, moov):
+    ''' Stream of the first video track of the 'moov' atom (as in the json of probe()), or None
+
+    @moov : The position (payload start, atom end) of the 'moov' atom.
+    '''
+    offset = moov[0]
+    while True:
+        trak = find_atom(buf, offset, moov[1], b'trak')
+        if not trak:
+            return None
+        offset = trak[1]
+        mdia = find_atom(buf, trak[0], trak[1], b'mdia')
+        if not mdia:
+            continue
+        hdlr = find_atom(buf, mdia[0], mdia[1], b'hdlr')
+        # version and flags, pre-defined, handler type
+        if not hdlr or buf[hdlr[0] + 8:hdlr[0] + 12] != b'vide':
+            continue
+        tkhd = find_atom(buf, trak[0], trak[1], b'tkhd')
+        mdhd = find_atom(buf, mdia[0], mdia[1], b'mdhd')
+        minf = find_atom(buf, mdia[0], mdia[1], b'minf')
+        stbl = minf and find_atom(buf, minf[0], minf[1], b'stbl')
+        stsz = stbl and find_atom(buf, stbl[0], stbl[1], b'stsz')
+        if not (tkhd and mdhd and stsz) or tkhd[1] - tkhd[0] < 8 or stsz[1] - stsz[0] < 12:
+            return None
+        # The width and height (16.16 fixed-point numbers) end the 'tkhd' atom
+        (width, height) = struct.unpack_from('>II', buf, tkhd[1] - 8)
+        (creation, timescale, units) = read_times(buf, mdhd[0], mdhd[1])
+        (sample_size, sample_count) = struct.unpack_from('>II', buf, stsz[0] + 4)
+        if sample_size:
+            total_size = sample_size * sample_count
+        else:
+            if stsz[0] + 12 + 4 * sample_count > stsz[1]:
+                raise Exception('Truncated stsz atom')
+            total_size = sum(struct.unpack_from('>%dI' % sample_count, buf, stsz[0] + 12))
+        if not (timescale and units and sample_count):
+            return None
+        return {'codec_type': 'video',
+                'width': width >> 16,
+                'height': height >> 16,
+                'avg_frame_rate': '%d/%d' % (sample_count * timescale, units),
+                'bit_rate': '%d' % (total_size * 8 * timescale // units)}
+
+
+def probe_header(vid_file_path):
+    ''' Give the same json as probe(), limited to the duration, creation
+    time and video stream, by reading the 'moov' atom of a MOV/MP4 file
+
+    @vid_file_path : The absolute (full) path of the video file, string.
+    '''
+    with open(vid_file_path, 'rb') as f:
+        # mmap only reads the pages that are accessed, i.e. the atom headers
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            moov = find_atom(buf, 0, len(buf), b'moov')
+            if not moov:
+                raise Exception('I found no moov atom')
+            mvhd = find_atom(buf, moov[0], moov[1], b'mvhd')
+            if not mvhd:
+                raise Exception('I found no mvhd atom')
+            (creation, timescale, units) = read_times(buf, mvhd[0], mvhd[1])
+            try:
+                streams = [read_video_track(buf, moov)]
+            except Exception as e:
+                logging.debug("Unable to read the video track of '%s': %s" % (vid_file_path, e))
+                streams = [None]
+
+    if timescale == 0:
+        raise Exception('I found no duration')
+    if creation == 0:
+        raise Exception('I found no creation time')
+    creation = MOV_EPOCH + datetime.timedelta(seconds=creation)
+    return {'format': {'duration': '%.6f' % (units / timescale),
+                       'tags': {'creation_time': creation.strftime("%Y-%m-%d %H:%M:%S")}},
+            'streams': [s for s in streams if s]}
+
+
+def probe_fast(vid_file_path):
+    ''' Give a json from the MOV/MP4 header, or from the ffprobe command line
+    if the header can't be parsed
+
+    @vid_file_path : The absolute (full) path of the video file, string.
+    '''
+    try:
+        return probe_header(vid_file_path)
+    except Exception as e:
+        logging.debug("Falling back to ffprobe for '%s': %s" % (vid_file_path, e))
+        return probe(vid_file_path)
+
+
 def duration(metadata_json):
     ''' Video's duration in seconds, return a float number
     '''
@@ -73,3 +215,30 @@ def creation_time(metadata_json):
     # we got here because no single 'return' in the above happen.
     raise Exception('I found no creation time')
     #return None
+
+
+def frame_rate(rate):
+    ''' Frame rate from an ffprobe rate such as "30000/1001", return a float number (None if unknown)
+    '''
+    try:
+        (numerator, separator, denominator) = rate.partition('/')
+        value = float(numerator) / float(denominator or 1)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+    return value or None
+
+
+def video_stream(metadata_json):
+    ''' Width, height, frame rate and bitrate (bits/s) of the first video stream, return a dict (None if there is no video stream)
+
+    @metadata_json : The json given by probe() or probe_header().
+    '''
+    for s in metadata_json.get('streams', []):
+        if s.get('codec_type') != 'video':
+            continue
+        bit_rate = s.get('bit_rate') or metadata_json.get('format', {}).get('bit_rate')
+        return {'width': int(s['width']),
+                'height': int(s['height']),
+                'fps': frame_rate(s.get('avg_frame_rate')) or frame_rate(s.get('r_frame_rate')),
+                'bit_rate': int(bit_rate) if bit_rate else None}
+    return None
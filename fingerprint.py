@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Sampled content fingerprints of the video files, used to recognize the
+# sequences that have already been uploaded even if their creation time
+# changed (e.g. after a clock reset of the actioncam).
+#
+# Hashing entire video files would mean reading gigabytes from the
+# actioncam. Instead, a clip is fingerprinted by its size and the hash of a
+# few blocks at fixed offsets, read through mmap.
+#
+
+import os
+import mmap
+import hashlib
+
+BLOCK_SIZE = 64 * 1024
+NUM_BLOCKS = 5
+
+
+def block_ranges(size):
+    ''' (start, end) of the sampled blocks: the start, the end, and evenly spaced in between
+    '''
+    if size <= NUM_BLOCKS * BLOCK_SIZE:
+        # Small file, hash it entirely
+        return [(0, size)]
+    offsets = [i * (size - BLOCK_SIZE) // (NUM_BLOCKS - 1) for i in range(NUM_BLOCKS)]
+    return [(offset, offset + BLOCK_SIZE) for offset in offsets]
+
+
+def clip_fingerprint(file_path):
+    ''' Fingerprint of a video file, string
+
+    @file_path : The path of the video file, string.
+    '''
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        digest = hashlib.sha1()
+        if size > 0:
+            # mmap only reads the pages of the sampled blocks
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for (start, end) in block_ranges(size):
+                    digest.update(buf[start:end])
+    return "%d-%s" % (size, digest.hexdigest())
+
+
+def sequence_fingerprint(clip_fingerprints):
+    ''' Fingerprint of a sequence, from the fingerprints of its clips (in order)
+    '''
+    return hashlib.sha1("\n".join(clip_fingerprints).encode("utf-8")).hexdigest()
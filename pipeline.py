@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Producer/consumer pipeline running the stages of the processing of the
+# sequences (copy, compress and merge, upload) at the same time.
+#
+# Each stage has its own worker threads, and the stages are connected by
+# bounded queues, so that e.g. the next sequence gets compressed while the
+# previous one is being uploaded. A semaphore can limit the number of items
+# between two stages, e.g. the encoded files waiting to be uploaded.
+#
+
+import threading
+import queue
+import logging
+
+# Seconds between the checks whether the pipeline has been stopped, while waiting
+POLL_INTERVAL = 0.1
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class Stage(object):
+    ''' A step of the pipeline, run on each item by a number of worker threads
+    '''
+    def __init__(self, name, function, workers=1, acquire=None, release=None):
+        self.name = name
+        # function(item), returns the item passed to the next stage
+        self.function = function
+        self.workers = workers
+        # Semaphore acquired before running the function on an item
+        self.acquire = acquire
+        # Semaphore released once the function has been run on an item
+        self.release = release
+
+
+def put(items_queue, item, stopped):
+    ''' Put an item in a queue, waiting for a free slot unless the pipeline gets stopped
+    '''
+    while not stopped.is_set():
+        try:
+            items_queue.put(item, timeout=POLL_INTERVAL)
+            return
+        except queue.Full:
+            pass
+    raise PipelineStopped()
+
+
+def get(items_queue, stopped):
+    ''' Get an item from a queue, waiting for one unless the pipeline gets stopped
+    '''
+    while not stopped.is_set():
+        try:
+            return items_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    raise PipelineStopped()
+
+
+def acquire(semaphore, stopped):
+    ''' Acquire a semaphore, waiting unless the pipeline gets stopped
+    '''
+    while not stopped.is_set():
+        if semaphore.acquire(timeout=POLL_INTERVAL):
+            return
+    raise PipelineStopped()
+
+
+def run_pipeline(items, stages, queue_size=1):
+    ''' Generator of the items coming out of the last stage, in completion order
+
+    The first exception raised in a stage stops the pipeline, and is raised
+    again once the worker threads have finished their current item.
+
+    @queue_size : Maximum number of items waiting between two stages.
+    '''
+    stopped = threading.Event()
+    errors = []
+    queues = [queue.Queue(queue_size) for stage in stages] + [queue.Queue()]
+    end_of_items = object()
+    threads = []
+
+    def feed():
+        try:
+            for item in items:
+                put(queues[0], item, stopped)
+            for worker in range(stages[0].workers):
+                put(queues[0], end_of_items, stopped)
+        except PipelineStopped:
+            pass
+
+    def work(idx, stage, remaining_workers):
+        try:
+            while True:
+                item = get(queues[idx], stopped)
+                if item is end_of_items:
+                    break
+                if stage.acquire:
+                    acquire(stage.acquire, stopped)
+                try:
+                    item = stage.function(item)
+                finally:
+                    if stage.release:
+                        stage.release.release()
+                put(queues[idx + 1], item, stopped)
+            # The last worker of this stage tells the next stage that there are no more items
+            with remaining_workers["lock"]:
+                remaining_workers["count"] -= 1
+                last_worker = remaining_workers["count"] == 0
+            if last_worker:
+                next_workers = stages[idx + 1].workers if idx + 1 < len(stages) else 1
+                for worker in range(next_workers):
+                    put(queues[idx + 1], end_of_items, stopped)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            # Including SystemExit, raised by sys.exit() in the stage functions
+            logging.debug("Stopping the pipeline, stage '%s' failed: %r" % (stage.name, e))
+            errors.append(e)
+            stopped.set()
+
+    threads.append(threading.Thread(target=feed, name="pipeline-feed"))
+    for (idx, stage) in enumerate(stages):
+        remaining_workers = {"lock": threading.Lock(), "count": stage.workers}
+        for worker in range(stage.workers):
+            threads.append(threading.Thread(target=work, args=(idx, stage, remaining_workers), name="pipeline-%s-%d" % (stage.name, worker)))
+    for thread in threads:
+        # Don't keep the program running after e.g. a KeyboardInterrupt in the main thread
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            item = get(queues[-1], stopped)
+            if item is end_of_items:
+                break
+            yield item
+    except PipelineStopped:
+        pass
+    except BaseException:
+        stopped.set()
+        raise
+    finally:
+        if errors or not stopped.is_set():
+            for thread in threads:
+                thread.join()
+    if errors:
+        raise errors[0]
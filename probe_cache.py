@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# On-disk cache of the metadata extracted by ffprobe, to avoid spawning one
+# ffprobe process per video file on every run.
+#
+# Along with the duration and creation time, the size, frame rate and bitrate
+# of the video stream are kept, for the --adaptive-encoding mode.
+#
+# The entries are keyed on the absolute path, size and modification time of
+# the video files: if any of these change, the file gets probed again.
+#
+# The clips belonging to a closed sequence (i.e. a sequence followed by
+# another one, which can therefore not be extended by new recordings) that
+# has been uploaded in a previous run are flagged as done, and don't need to
+# be analyzed again.
+#
+
+import sqlite3
+import os
+import logging
+import datetime
+
+from clips import Clip
+
+CREATION_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def open_cache(db_path):
+    ''' Open (and create if needed) the cache database, return a connection
+
+    @db_path : The path of the SQLite database file, string.
+    '''
+    conn = sqlite3.connect(db_path)
+    conn.execute("""CREATE TABLE IF NOT EXISTS probe_cache (
+                        file_path TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        mtime REAL NOT NULL,
+                        duration REAL NOT NULL,
+                        creation_time TEXT NOT NULL,
+                        width INTEGER,
+                        height INTEGER,
+                        fps REAL,
+                        bit_rate INTEGER,
+                        done INTEGER NOT NULL DEFAULT 0
+                    )""")
+    conn.commit()
+    logging.debug("Opened the probe cache '%s'." % db_path)
+    return conn
+
+
+def get_video(width, height, fps, bit_rate):
+    ''' Video stream from the columns of an entry, dict (None if the file has no video stream)
+    '''
+    if width is None:
+        return None
+    return {"width": width, "height": height, "fps": fps, "bit_rate": bit_rate}
+
+
+def get_metadata(conn, file_path, size, mtime):
+    ''' Cached (duration, creation_time, video) of a file, or None if not cached
+    '''
+    row = conn.execute("SELECT duration, creation_time, width, height, fps, bit_rate FROM probe_cache WHERE file_path = ? AND size = ? AND mtime = ?",
+                       (os.path.abspath(file_path), size, mtime)).fetchone()
+    if row is None:
+        return None
+    return (row[0], datetime.datetime.strptime(row[1], CREATION_TIME_FORMAT), get_video(*row[2:]))
+
+
+def store_metadata(conn, file_path, size, mtime, duration, creation_time, video=None):
+    ''' Store the duration, creation time and video stream of a file in the cache, not done yet
+        (call conn.commit() once all the files have been stored)
+    '''
+    video = video or {"width": None, "height": None, "fps": None, "bit_rate": None}
+    conn.execute("INSERT OR REPLACE INTO probe_cache (file_path, size, mtime, duration, creation_time, width, height, fps, bit_rate, done) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                 (os.path.abspath(file_path), size, mtime, duration, creation_time.strftime(CREATION_TIME_FORMAT),
+                  video["width"], video["height"], video["fps"], video["bit_rate"]))
+
+
+def load_clips(conn):
+    ''' All the clips in the cache, as a dict {file_path: (Clip, done)}
+    '''
+    clips = {}
+    for (file_path, size, mtime, duration, creation_time, width, height, fps, bit_rate, done) in conn.execute(
+            "SELECT file_path, size, mtime, duration, creation_time, width, height, fps, bit_rate, done FROM probe_cache"):
+        clip = Clip(file_path, duration, datetime.datetime.strptime(creation_time, CREATION_TIME_FORMAT), size, mtime)
+        clip.video = get_video(width, height, fps, bit_rate)
+        clips[file_path] = (clip, bool(done))
+    return clips
+
+
+def mark_done(conn, sequences):
+    ''' Flag the clips of these sequences as done, they won't be analyzed anymore
+    '''
+    conn.executemany("UPDATE probe_cache SET done = 1 WHERE file_path = ?",
+                     [(os.path.abspath(c.original_path),) for seq in sequences for c in seq])
+    conn.commit()
+
+
+def remove_clips(conn, file_paths):
+    ''' Remove the entries of these files (typically modified or deleted from the actioncam)
+    '''
+    conn.executemany("DELETE FROM probe_cache WHERE file_path = ?", [(f,) for f in file_paths])
+    conn.commit()
+
+
+def evict_missing_files(conn, folder=None):
+    ''' Remove the entries of files that no longer exist, return the number of evicted entries
+
+    @folder : Only consider the entries located in this folder (the other
+              entries might be on an actioncam that is currently unplugged).
+    '''
+    prefix = os.path.join(os.path.abspath(folder), "") if folder else ""
+    missing = [row[0] for row in conn.execute("SELECT file_path FROM probe_cache")
+               if row[0].startswith(prefix) and not os.path.isfile(row[0])]
+    conn.executemany("DELETE FROM probe_cache WHERE file_path = ?", [(f,) for f in missing])
+    conn.commit()
+    logging.debug("Evicted %d entries from the probe cache." % len(missing))
+    return len(missing)
+
+
+def clear_cache(conn):
+    ''' Remove all the entries from the cache
+    '''
+    conn.execute("DELETE FROM probe_cache")
+    conn.commit()
+    logging.debug("The probe cache has been cleared.")
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Persistent index of the sequences uploaded in previous runs.
+#
+# The content fingerprints of the uploaded sequences are kept, to recognize
+# them when their clips come up again under another creation time. The
+# clips themselves are kept in the probe cache, with their metadata.
+#
+
+import sqlite3
+import logging
+
+
+def open_index(db_path):
+    ''' Open (and create if needed) the index database, return a connection
+
+    @db_path : The path of the SQLite database file, string.
+    '''
+    conn = sqlite3.connect(db_path)
+    conn.execute("""CREATE TABLE IF NOT EXISTS uploaded_sequences (
+                        fingerprint TEXT PRIMARY KEY,
+                        title TEXT NOT NULL
+                    )""")
+    conn.commit()
+    logging.debug("Opened the sequence index '%s'." % db_path)
+    return conn
+
+
+def load_fingerprints(conn):
+    ''' Dict {fingerprint: title} of the uploaded sequences
+    '''
+    return dict(conn.execute("SELECT fingerprint, title FROM uploaded_sequences"))
+
+
+def store_fingerprint(conn, fingerprint, title):
+    ''' Remember the fingerprint of an uploaded sequence
+    '''
+    conn.execute("INSERT OR REPLACE INTO uploaded_sequences (fingerprint, title) VALUES (?, ?)", (fingerprint, title))
+    conn.commit()
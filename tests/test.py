@@ -17,9 +17,18 @@ import shutil
 import os
 import copy
 import socket
+import struct
+import contextlib
+import io
+import time
+import threading
+import csv
 
 sys.path.append('.')
 target = __import__("actioncam-upload")
+from clips import Clip
+from clips import Sequence
+from clips import Job
 
 # Check if we're connected to the Internet
 def is_connected():
@@ -46,25 +55,63 @@ def mock_raw_input(s):
 target.input = mock_raw_input
 
 sample_sequences = [
-    [
-        {'duration': 300.0, 'file_path': '/tmp/vids/20190121_085007.MOV', 'creation_time': datetime.datetime(2019, 1, 21, 8, 50, 7)},
-        {'duration': 300.0, 'file_path': '/tmp/vids/20190121_085508.MOV', 'creation_time': datetime.datetime(2019, 1, 21, 8, 55, 8)},
-        {'duration': 300.0, 'file_path': '/tmp/vids/20190121_090008.MOV', 'creation_time': datetime.datetime(2019, 1, 21, 9, 0, 8)},
-        {'duration': 216.75, 'file_path': '/tmp/vids/20190121_090508.MOV', 'creation_time': datetime.datetime(2019, 1, 21, 9, 5, 8)}
-    ],
-    [
-        {'duration': 300.0, 'file_path': '/tmp/vids/20190125_162220.MOV', 'creation_time': datetime.datetime(2019, 1, 25, 16, 22, 20)},
-        {'duration': 300.0, 'file_path': '/tmp/vids/20190125_162721.MOV', 'creation_time': datetime.datetime(2019, 1, 25, 16, 27, 21)},
-        {'duration': 300.0, 'file_path': '/tmp/vids/20190125_163221.MOV', 'creation_time': datetime.datetime(2019, 1, 25, 16, 32, 21)},
-        {'duration': 300.0, 'file_path': '/tmp/vids/20190125_163721.MOV', 'creation_time': datetime.datetime(2019, 1, 25, 16, 37, 21)}
-    ],
-    [
-        {'duration': 300.0, 'file_path': '/tmp/vids/20190129_082825.MOV', 'creation_time': datetime.datetime(2019, 1, 29, 8, 28, 26)},
-        {'duration': 300.0, 'file_path': '/tmp/vids/20190129_083327.MOV', 'creation_time': datetime.datetime(2019, 1, 29, 8, 33, 27)},
-        {'duration': 286.0, 'file_path': '/tmp/vids/20190129_083826.MOV', 'creation_time': datetime.datetime(2019, 1, 29, 8, 38, 27)}
-    ]
+    Sequence([
+        Clip('/tmp/vids/20190121_085007.MOV', 300.0, datetime.datetime(2019, 1, 21, 8, 50, 7)),
+        Clip('/tmp/vids/20190121_085508.MOV', 300.0, datetime.datetime(2019, 1, 21, 8, 55, 8)),
+        Clip('/tmp/vids/20190121_090008.MOV', 300.0, datetime.datetime(2019, 1, 21, 9, 0, 8)),
+        Clip('/tmp/vids/20190121_090508.MOV', 216.75, datetime.datetime(2019, 1, 21, 9, 5, 8))
+    ]),
+    Sequence([
+        Clip('/tmp/vids/20190125_162220.MOV', 300.0, datetime.datetime(2019, 1, 25, 16, 22, 20)),
+        Clip('/tmp/vids/20190125_162721.MOV', 300.0, datetime.datetime(2019, 1, 25, 16, 27, 21)),
+        Clip('/tmp/vids/20190125_163221.MOV', 300.0, datetime.datetime(2019, 1, 25, 16, 32, 21)),
+        Clip('/tmp/vids/20190125_163721.MOV', 300.0, datetime.datetime(2019, 1, 25, 16, 37, 21))
+    ]),
+    Sequence([
+        Clip('/tmp/vids/20190129_082825.MOV', 300.0, datetime.datetime(2019, 1, 29, 8, 28, 26)),
+        Clip('/tmp/vids/20190129_083327.MOV', 300.0, datetime.datetime(2019, 1, 29, 8, 33, 27)),
+        Clip('/tmp/vids/20190129_083826.MOV', 286.0, datetime.datetime(2019, 1, 29, 8, 38, 27))
+    ])
 ]
 
+def createAtom(atom_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), atom_type) + payload
+
+def createTrack(handler_type, duration, width=0, height=0, sample_sizes=()):
+    """
+    Create a minimal 'trak' atom, containing only the atoms needed to read the size, frame rate and bitrate of a video track
+    """
+    tkhd = createAtom(b"tkhd", b"\0" * 76 + struct.pack(">II", width << 16, height << 16))
+    mdhd = createAtom(b"mdhd", struct.pack(">B3sIIII", 0, b"\0\0\0", 0, 0, 90000, int(duration * 90000)) + b"\0" * 4)
+    hdlr = createAtom(b"hdlr", b"\0" * 8 + handler_type + b"\0" * 13)
+    stsz = createAtom(b"stsz", struct.pack(">III", 0, 0, len(sample_sizes)) + b"".join(struct.pack(">I", size) for size in sample_sizes))
+    minf = createAtom(b"minf", createAtom(b"stbl", stsz))
+    return createAtom(b"trak", tkhd + createAtom(b"mdia", mdhd + hdlr + minf))
+
+def createMOVFile(file_path, creation_time, duration, version=0, moov_at_end=True, tracks=b""):
+    """
+    Create a minimal MOV file, containing only the atoms needed to read its duration and creation time (and the tracks given)
+    """
+    timescale = 1000
+    seconds = int((creation_time - datetime.datetime(1904, 1, 1)).total_seconds())
+    if version == 1:
+        mvhd_payload = struct.pack(">B3sQQIQ", 1, b"\0\0\0", seconds, seconds, timescale, int(duration * timescale))
+    else:
+        mvhd_payload = struct.pack(">B3sIIII", 0, b"\0\0\0", seconds, seconds, timescale, int(duration * timescale))
+    mvhd_payload += b"\0" * 80
+    mvhd = struct.pack(">I4s", 8 + len(mvhd_payload), b"mvhd") + mvhd_payload
+    moov = struct.pack(">I4s", 8 + len(mvhd) + len(tracks), b"moov") + mvhd + tracks
+    ftyp = struct.pack(">I4s4sI", 16, b"ftyp", b"qt  ", 0)
+    # Use a 64-bit size for the media data atom
+    mdat = struct.pack(">I4sQ", 1, b"mdat", 16 + 4096) + b"\0" * 4096
+    with open(file_path, "wb") as f:
+        f.write(ftyp + (mdat + moov if moov_at_end else moov + mdat))
+
+def storeClips(cache, clips):
+    for clip in clips:
+        target.probe_cache.store_metadata(cache, clip.file_path, clip.size, clip.mtime, clip.duration, clip.creation_time, clip.video)
+    cache.commit()
+
 def createTempFolderWithDummyMOVFiles():
     """
     Create a temporary folder with 5 dummy files, 3 of which with .MOV extension
@@ -134,8 +181,16 @@ class TestMergeSequence(unittest.TestCase):
         Test the merge_sequence() function with --dry-run (doesn't run the ffmpeg command)
         """
         args = target.parse_args(['--dry-run', '--verbose'])
-        file_to_upload = target.merge_sequence(sample_sequences[0], args.dry_run, args.logging_level)
-        self.assertEqual(file_to_upload, "/tmp/%s" % os.path.split(sample_sequences[0][0]["file_path"])[1])
+        tempdir = tempfile.mkdtemp()
+        try:
+            file_to_upload = target.merge_sequence(sample_sequences[0], args.dry_run, args.logging_level, None, tempdir)
+            # In a merge folder of its own, within the temporary folder of the sequence
+            (merge_folder, name) = os.path.split(file_to_upload)
+            self.assertEqual(name, os.path.split(sample_sequences[0][0].file_path)[1])
+            self.assertEqual(os.path.dirname(merge_folder), tempdir)
+            self.assertEqual(os.listdir(merge_folder), [])
+        finally:
+            shutil.rmtree(tempdir)
 
     # def test_merge_sequence_ffmpeg_verbose(self):
     #     """
@@ -143,7 +198,7 @@ class TestMergeSequence(unittest.TestCase):
     #     """
     #     args = target.parse_args(['--verbose'])
     #     file_to_upload = target.merge_sequence(sample_sequences[0], args.dry_run, args.logging_level)
-    #     self.assertEqual(file_to_upload, "/tmp/%s" % os.path.split(sample_sequences[0][0]["file_path"])[1])
+    #     self.assertEqual(file_to_upload, "/tmp/%s" % os.path.split(sample_sequences[0][0].file_path)[1])
 
     # def test_merge_sequence_ffmpeg_debug(self):
     #     """
@@ -155,7 +210,7 @@ class TestMergeSequence(unittest.TestCase):
     #     """
     #     args = target.parse_args(['--debug'])
     #     file_to_upload = target.merge_sequence(sample_sequences[0], args.dry_run, args.logging_level)
-    #     self.assertEqual(file_to_upload, "/tmp/%s" % os.path.split(sample_sequences[0][0]["file_path"])[1])
+    #     self.assertEqual(file_to_upload, "/tmp/%s" % os.path.split(sample_sequences[0][0].file_path)[1])
 
 class TestCompressSequence(unittest.TestCase):
     def test_compress_sequence_invalid_file(self):
@@ -174,8 +229,221 @@ class TestCompressSequence(unittest.TestCase):
         # Delete the temporary folder
         shutil.rmtree(tempdir)
 
+    def createSequence(self, tempdir, num_files):
+        """
+        Create a sequence of (empty) files
+        """
+        clips = []
+        for idx in range(num_files):
+            file_path = os.path.join(tempdir, "GOPR%04d.MOV" % idx)
+            open(file_path, "w").close()
+            clips.append(Clip(file_path, 300.0, datetime.datetime(2019, 1, 21, 8, 0, 0) + datetime.timedelta(minutes=5 * idx)))
+        return Sequence(clips)
+
+    def test_compress_sequence_parallel(self):
+        """
+        Test the compress_sequence() function with several workers keeps the order of the files
+        """
+        run_compress_command = target.run_compress_command
+        commands = []
+        def mock_run_compress_command(command, logging_level, running, progress=None):
+            # The first files take longer to compress
+            time.sleep(0.01 * (8 - len(commands)))
+            commands.append(command)
+            return 0
+        target.run_compress_command = mock_run_compress_command
+        tempdir = tempfile.mkdtemp()
+        outdir = tempfile.mkdtemp()
+        try:
+            seq = self.createSequence(tempdir, 8)
+            seq = target.compress_sequence(seq, outdir, False, "INFO", 1, 1, 4, 8)
+        finally:
+            target.run_compress_command = run_compress_command
+        self.assertEqual([f.file_path for f in seq], [os.path.join(outdir, "GOPR%04d.MOV" % idx) for idx in range(8)])
+        self.assertEqual(len(commands), 8)
+        for command in commands:
+            self.assertEqual(command[command.index("-threads") + 1], "8")
+        shutil.rmtree(tempdir)
+        shutil.rmtree(outdir)
+
+    def test_compress_sequence_failure(self):
+        """
+        Test the compress_sequence() function cancels the remaining work when a compress command fails
+        """
+        run_compress_command = target.run_compress_command
+        started = []
+        def mock_run_compress_command(command, logging_level, running, progress=None):
+            started.append(command)
+            return 1 if len(started) == 2 else 0
+        target.run_compress_command = mock_run_compress_command
+        tempdir = tempfile.mkdtemp()
+        try:
+            seq = self.createSequence(tempdir, 20)
+            with self.assertRaises(SystemExit) as cm:
+                target.compress_sequence(seq, tempdir, False, "INFO", 1, 1)
+        finally:
+            target.run_compress_command = run_compress_command
+        self.assertEqual(cm.exception.code, 16)
+        self.assertEqual(len(started), 2)
+        # The sequence still points to the original files
+        self.assertEqual(seq[0].file_path, os.path.join(tempdir, "GOPR0000.MOV"))
+        shutil.rmtree(tempdir)
+
+    def test_run_compress_commands_cancel_early(self):
+        """
+        Test the run_compress_commands() function cancels the other commands as soon as one fails, without waiting for the earlier ones
+        """
+        run_compress_command = target.run_compress_command
+        cancelled = []
+        def mock_run_compress_command(command, logging_level, running, progress=None):
+            if "slow" == command[0]:
+                # Runs until its process gets terminated
+                terminated = threading.Event()
+                with running["lock"]:
+                    running["processes"].add(type("FakeProcess", (object,), {"terminate": lambda self: terminated.set()})())
+                cancelled.append(terminated.wait(5))
+                return 255
+            time.sleep(0.1)
+            return 1
+        target.run_compress_command = mock_run_compress_command
+        start = time.time()
+        try:
+            returncode = target.run_compress_commands([(["slow"], 10.0), (["fail"], 10.0)], 2, "INFO")
+        finally:
+            target.run_compress_command = run_compress_command
+        self.assertEqual(returncode, 1)
+        self.assertEqual(cancelled, [True])
+        self.assertLess(time.time() - start, 2)
+
+    def test_merge_and_compress_sequence(self):
+        """
+        Test the merge_and_compress_sequence() function runs a single FFmpeg command over the original files
+        """
+        run_ffmpeg_command = target.run_ffmpeg_command
+        commands = []
+        def mock_run_ffmpeg_command(command, logging_level, progress=None):
+            # The list of files to concatenate exists while FFmpeg runs
+            with open(command[command.index("-i") + 1]) as f:
+                commands.append((command, f.read()))
+            return 0
+        target.run_ffmpeg_command = mock_run_ffmpeg_command
+        tempdir = tempfile.mkdtemp()
+        outdir = tempfile.mkdtemp()
+        try:
+            seq = self.createSequence(tempdir, 3)
+            file_to_upload = target.merge_and_compress_sequence(seq, outdir, False, "INFO", 1, 1, 4)
+        finally:
+            target.run_ffmpeg_command = run_ffmpeg_command
+        self.assertEqual(file_to_upload, os.path.join(outdir, "GOPR0000.MOV"))
+        self.assertEqual(len(commands), 1)
+        (command, concat_list) = commands[0]
+        self.assertEqual(command[command.index("-f") + 1], "concat")
+        self.assertEqual(command[command.index("-vf") + 1], "scale=iw/2:ih/2")
+        self.assertEqual(command[command.index("-threads") + 1], "4")
+        self.assertEqual(concat_list, "".join("file '%s'\n" % f.file_path for f in seq))
+        # The list of files to concatenate has been removed
+        self.assertEqual(os.listdir(outdir), [])
+        shutil.rmtree(tempdir)
+        shutil.rmtree(outdir)
+
+    def test_merge_and_compress_sequence_invalid_file(self):
+        """
+        Test the merge_and_compress_sequence() function with non-existing files
+        """
+        tempdir = tempfile.mkdtemp()
+        with self.assertRaises(SystemExit) as cm:
+            target.merge_and_compress_sequence(sample_sequences[0], tempdir, True, "INFO", 1, 1)
+        self.assertEqual(cm.exception.code, 15)
+        shutil.rmtree(tempdir)
+
+    def test_write_concat_list(self):
+        """
+        Test the write_concat_list() function escapes the single quotes
+        """
+        tempdir = tempfile.mkdtemp()
+        list_file = os.path.join(tempdir, "files.txt")
+        target.write_concat_list(["/tmp/a.MOV", "/tmp/it's.MOV"], list_file)
+        with open(list_file) as f:
+            self.assertEqual(f.read(), "file '/tmp/a.MOV'\nfile '/tmp/it'\\''s.MOV'\n")
+        shutil.rmtree(tempdir)
 
+    def test_get_num_segments(self):
+        """
+        Test the get_num_segments() function keeps the segments at least MIN_SEGMENT_SECONDS long
+        """
+        self.assertEqual(target.get_num_segments(3600.0, 1), 1)
+        self.assertEqual(target.get_num_segments(3600.0, 8), 8)
+        self.assertEqual(target.get_num_segments(target.MIN_SEGMENT_SECONDS * 3, 8), 3)
+        self.assertEqual(target.get_num_segments(target.MIN_SEGMENT_SECONDS / 2, 8), 1)
+        self.assertEqual(target.get_num_segments(None, 8), 1)
 
+    def test_compress_sequence_split_segments(self):
+        """
+        Test the compress_sequence() function splits a long file, compresses its segments and joins them in order
+        """
+        run_compress_command = target.run_compress_command
+        run_ffmpeg_command = target.run_ffmpeg_command
+        compressed = []
+        joined = []
+        def mock_run_ffmpeg_command(command, logging_level, progress=None):
+            if "segment" in command:
+                # Split into 4 segments
+                pattern = command[-1]
+                for idx in range(4):
+                    open(pattern % idx, "w").close()
+            else:
+                list_file = command[command.index("-i") + 1]
+                with open(list_file) as f:
+                    joined.append(f.read())
+                open(command[-1], "w").close()
+            return 0
+        def mock_run_compress_command(command, logging_level, running, progress=None):
+            compressed.append(command[command.index("-i") + 1])
+            return 0
+        target.run_compress_command = mock_run_compress_command
+        target.run_ffmpeg_command = mock_run_ffmpeg_command
+        tempdir = tempfile.mkdtemp()
+        outdir = tempfile.mkdtemp()
+        try:
+            seq = self.createSequence(tempdir, 1)
+            seq[0].duration = 3600.0
+            seq = target.compress_sequence(seq, outdir, False, "INFO", 1, 1, 4, 0, 4)
+        finally:
+            target.run_compress_command = run_compress_command
+            target.run_ffmpeg_command = run_ffmpeg_command
+        self.assertEqual(seq[0].file_path, os.path.join(outdir, "GOPR0000.MOV"))
+        self.assertEqual(sorted(os.path.split(path)[1] for path in compressed), ["%03d.MOV" % idx for idx in range(4)])
+        self.assertEqual(len(joined), 1)
+        self.assertEqual([line.split("/")[-1] for line in joined[0].splitlines()], ["compressed-%03d.MOV'" % idx for idx in range(4)])
+        # The segments were deleted once joined
+        self.assertEqual(os.listdir(outdir), ["GOPR0000.MOV"])
+        shutil.rmtree(tempdir)
+        shutil.rmtree(outdir)
+
+    def test_split_segments_single_pass(self):
+        """
+        Test the parse_args() function rejects --split-segments with --single-pass and --stream, which don't split the files
+        """
+        for option in ['--single-pass', '--stream']:
+            with self.assertRaises(SystemExit) as cm:
+                with contextlib.redirect_stderr(io.StringIO()):
+                    target.parse_args(['--split-segments', '4', option])
+            self.assertEqual(cm.exception.code, 2)
+        self.assertTrue(target.parse_args(['--split-segments', '1', '--single-pass']).single_pass)
+
+    def test_get_encode_threads(self):
+        """
+        Test the get_encode_threads() function splits the thread budget across the workers
+        """
+        self.assertEqual(target.get_encode_threads(target.parse_args([])), 0)
+        self.assertEqual(target.get_encode_threads(target.parse_args(['--encode-threads', '32', '--encode-workers', '4'])), 8)
+        self.assertEqual(target.get_encode_threads(target.parse_args(['--encode-threads', '2', '--encode-workers', '4'])), 1)
+        self.assertEqual(target.get_encode_threads(target.parse_args(['--encode-threads', '0', '--encode-workers', '4'])), 0)
+        self.assertGreaterEqual(target.get_encode_threads(target.parse_args(['--encode-workers', '2'])), 1)
+        # A negative number of threads is rejected
+        with self.assertRaises(SystemExit):
+            with contextlib.redirect_stderr(io.StringIO()):
+                target.parse_args(['--encode-threads', '-1'])
 
 #     def test_compress_sequence_dry_run(self):
 #         """
@@ -189,7 +457,7 @@ class TestCompressSequence(unittest.TestCase):
 #         # The returned sequence should be the same as the first sample_sequences (due to --dry-run)
 #         for idx, files in enumerate(seq):
 #             for data in ["creation_time", "duration", "file_path"]:
-#                 self.assertEqual(files[data], sample_sequences[0][idx][data])
+#                 self.assertEqual(getattr(files, data), sample_sequences[0][idx][data])
 #         # Delete the temporary folder
 #         shutil.rmtree(tempdir)
 #
@@ -208,11 +476,11 @@ class TestCompressSequence(unittest.TestCase):
 #         # The returned sequence should be the same as the first sample_sequences (due to --dry-run)
 #         for idx, files in enumerate(seq):
 #             for data in ["creation_time", "duration"]:
-#                 self.assertEqual(files[data], sample_sequences[0][idx][data])
+#                 self.assertEqual(getattr(files, data), sample_sequences[0][idx][data])
 #             # The file path is different, now a new temporary folder (because the file has been compressed)
 #             # Should start with the path to the temporary folder and end with the sequence's first file name.
-#             self.assertTrue(files["file_path"].startswith(tempfile.gettempdir()))
-#             self.assertTrue(files["file_path"].endswith(os.path.split(sample_sequences[0][idx]["file_path"])[1]))
+#             self.assertTrue(files.file_path.startswith(tempfile.gettempdir()))
+#             self.assertTrue(files.file_path.endswith(os.path.split(sample_sequences[0][idx].file_path)[1]))
 #         # Delete the temporary folder
 #         shutil.rmtree(tempdir)
 #
@@ -234,18 +502,18 @@ class TestCompressSequence(unittest.TestCase):
 #         # The returned sequence should be the same as the first sample_sequences (due to --dry-run)
 #         for idx, files in enumerate(seq):
 #             for data in ["creation_time", "duration"]:
-#                 self.assertEqual(files[data], sample_sequences[0][idx][data])
+#                 self.assertEqual(getattr(files, data), sample_sequences[0][idx][data])
 #             # The file path is different, now a new temporary folder (because the file has been compressed)
 #             # Should start with the path to the temporary folder and end with the sequence's first file name.
-#             self.assertTrue(files["file_path"].startswith(tempfile.gettempdir()))
-#             self.assertTrue(files["file_path"].endswith(os.path.split(sample_sequences[0][idx]["file_path"])[1]))
+#             self.assertTrue(files.file_path.startswith(tempfile.gettempdir()))
+#             self.assertTrue(files.file_path.endswith(os.path.split(sample_sequences[0][idx].file_path)[1]))
 #         # Delete the temporary folder
 #         shutil.rmtree(tempdir)
 
 class TestPreCopy(unittest.TestCase):
-    def test_pre_copy(self):
+    def test_pre_copy_sequence(self):
         """
-        Test the pre_copy() function
+        Test the pre_copy_sequence() function
         """
         # Simulate files on the actioncam
         temp_actioncam_dir = tempfile.mkdtemp()
@@ -258,13 +526,13 @@ class TestPreCopy(unittest.TestCase):
             mov_files[idx] = {}
             for idx2, files in enumerate(seq):
                 (ignore, mov_files[idx][idx2]) = tempfile.mkstemp(suffix=".MOV", dir=temp_actioncam_dir)
-                files["file_path"] = mov_files[idx][idx2]
+                files.original_path = files.file_path = mov_files[idx][idx2]
 
         # Confirm that there are 11 dummy files in the temporary actioncam folder
         self.assertEqual(len([name for name in os.listdir(temp_actioncam_dir) if os.path.isfile(os.path.join(temp_actioncam_dir, name))]), 11)
 
         # Copy the files from the "actioncam" folder to new temporary folders
-        (new_sequences, pre_copy_folders) = target.pre_copy(new_sequences)
+        pre_copy_folders = [target.pre_copy_sequence(seq, idx, len(new_sequences)) for (idx, seq) in enumerate(new_sequences)]
 
         for idx, seq in enumerate(new_sequences):
             # Confirm the number of files in that sequence's temporary folder is correct
@@ -272,7 +540,8 @@ class TestPreCopy(unittest.TestCase):
             for idx2, files in enumerate(seq):
                 # concatenate that sequence's temp folder with that file's filename
                 fname = os.path.join(pre_copy_folders[idx], os.path.split(mov_files[idx][idx2])[1])
-                self.assertEqual(files["file_path"], fname)
+                self.assertEqual(files.file_path, fname)
+                self.assertEqual(files.original_path, mov_files[idx][idx2])
             # Delete the new temporary folders (and files)
             shutil.rmtree(pre_copy_folders[idx])
 
@@ -297,7 +566,7 @@ class TestAnalyzeSequences(unittest.TestCase):
             self.assertEqual(len(seq), len(sample_sequences[idx]))
             for idx2, files in enumerate(seq):
                 for data in ["creation_time", "duration", "file_path"]:
-                    self.assertEqual(files[data], sample_sequences[idx][idx2][data])
+                    self.assertEqual(getattr(files, data), getattr(sample_sequences[idx][idx2], data))
 
     def test_analyze_sequences_empty_sequence(self):
         """
@@ -328,7 +597,7 @@ class TestAnalyzeSequences(unittest.TestCase):
             self.assertEqual(len(seq), len(sample_sequences[idx]))
             for idx2, files in enumerate(seq):
                 for data in ["creation_time", "duration", "file_path"]:
-                    self.assertEqual(files[data], sample_sequences[idx][idx2][data])
+                    self.assertEqual(getattr(files, data), getattr(sample_sequences[idx][idx2], data))
 
     def test_analyze_sequences_length_restriction(self):
         """
@@ -345,7 +614,7 @@ class TestAnalyzeSequences(unittest.TestCase):
             self.assertEqual(len(seq), len(sample_sequences[0]))
             for idx2, files in enumerate(seq):
                 for data in ["creation_time", "duration", "file_path"]:
-                    self.assertEqual(files[data], sample_sequences[0][idx2][data])
+                    self.assertEqual(getattr(files, data), getattr(sample_sequences[0][idx2], data))
 
     def test_analyze_sequences_interactive_length_restriction(self):
         """
@@ -366,41 +635,256 @@ class TestAnalyzeSequences(unittest.TestCase):
             self.assertEqual(len(seq), len(sample_sequences[0]))
             for idx2, files in enumerate(seq):
                 for data in ["creation_time", "duration", "file_path"]:
-                    self.assertEqual(files[data], sample_sequences[0][idx2][data])
+                    self.assertEqual(getattr(files, data), getattr(sample_sequences[0][idx2], data))
+
+class FakeRequest(object):
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+class FakePlaylistItems(object):
+    """
+    Uploads playlist of a fake YouTube channel, most recent videos first
+    """
+    def __init__(self, youtube):
+        self.youtube = youtube
+
+    def list(self, **kwargs):
+        self.youtube.list_kwargs = kwargs
+        return self.page(0)
+
+    def list_next(self, request, response):
+        if "nextPageToken" not in response:
+            return None
+        return self.page(response["nextPageToken"])
+
+    def page(self, start):
+        self.youtube.num_requests += 1
+        items = [{"etag": "etag-%s" % video_id, "snippet": {"title": title, "publishedAt": "2019-01-01T00:00:00Z", "resourceId": {"videoId": video_id}}}
+                 for (video_id, title) in self.youtube.videos[start:start + 50]]
+        response = {"items": items}
+        if start + 50 < len(self.youtube.videos):
+            response["nextPageToken"] = start + 50
+        return FakeRequest(response)
+
+class FakeYouTube(object):
+    def __init__(self, videos):
+        self.videos = videos
+        self.num_requests = 0
+        self.list_kwargs = None
+
+    def channels(self):
+        self.num_requests += 1
+        return type("FakeChannels", (object,), {"list": lambda s, **kwargs: FakeRequest({"items": [{"contentDetails": {"relatedPlaylists": {"uploads": "UU123"}}}]})})()
+
+    def playlistItems(self):
+        return FakePlaylistItems(self)
+
+class TestUploadLedger(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.ledger_file = os.path.join(self.tempdir, "ledger.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_list_uploaded_videos_incremental(self):
+        """
+        Test the list_uploaded_videos() function only fetches the videos uploaded since the previous run
+        """
+        videos = [("id%d" % i, "2019-01-01 00:%02d:%02d" % (i // 60, i % 60)) for i in range(120)]
+        youtube = FakeYouTube(list(videos))
+        args = target.parse_args(['--upload-ledger', self.ledger_file])
+        identities = target.list_uploaded_videos(youtube, args)
+        self.assertEqual(identities, set((title, None) for (video_id, title) in videos))
+        # 1 request for the uploads playlist id, 3 pages of 50 videos
+        self.assertEqual(youtube.num_requests, 4)
+        self.assertEqual(youtube.list_kwargs["maxResults"], 50)
+        self.assertIn("fields", youtube.list_kwargs)
+
+        # Two new videos, only the first page is fetched
+        youtube.videos.insert(0, ("id120", "2019-01-02 00:00:00"))
+        youtube.videos.insert(0, ("id121", "2019-01-02 00:01:00"))
+        youtube.num_requests = 0
+        identities = target.list_uploaded_videos(youtube, args)
+        self.assertEqual(len(identities), 122)
+        self.assertIn(("2019-01-02 00:01:00", None), identities)
+        self.assertEqual(youtube.num_requests, 1)
+
+        # --resync-upload-ledger fetches everything again
+        youtube.num_requests = 0
+        identities = target.list_uploaded_videos(youtube, target.parse_args(['--upload-ledger', self.ledger_file, '--resync-upload-ledger']))
+        self.assertEqual(len(identities), 122)
+        self.assertEqual(youtube.num_requests, 4)
+
+    def test_list_uploaded_videos_sync_mark(self):
+        """
+        Test the list_uploaded_videos() function finds the videos uploaded by other means before a video recorded by this program
+        """
+        youtube = FakeYouTube([("id1", "2019-01-01 00:00:00")])
+        args = target.parse_args(['--upload-ledger', self.ledger_file])
+        target.list_uploaded_videos(youtube, args)
+        # A video uploaded from another computer, then a video uploaded by this program
+        youtube.videos.insert(0, ("id2", "2019-01-02 00:00:00"))
+        youtube.videos.insert(0, ("id3", "2019-01-03 00:00:00"))
+        target.record_upload({"id": "id3", "snippet": {"title": "2019-01-03 00:00:00"}}, args)
+        identities = target.list_uploaded_videos(youtube, args)
+        self.assertIn(("2019-01-02 00:00:00", None), identities)
+        self.assertEqual(len(identities), 3)
+
+    def test_list_uploaded_videos_no_upload_ledger(self):
+        """
+        Test the list_uploaded_videos() function with --no-upload-ledger
+        """
+        youtube = FakeYouTube([("id1", "2019-01-01 00:00:00")])
+        args = target.parse_args(['--upload-ledger', self.ledger_file, '--no-upload-ledger'])
+        self.assertEqual(target.list_uploaded_videos(youtube, args), set([("2019-01-01 00:00:00", None)]))
+        self.assertEqual(target.list_uploaded_videos(youtube, args), set([("2019-01-01 00:00:00", None)]))
+        self.assertFalse(os.path.exists(self.ledger_file))
+
+    def test_record_upload(self):
+        """
+        Test the record_upload() function adds the uploaded video to the ledger
+        """
+        args = target.parse_args(['--upload-ledger', self.ledger_file])
+        target.record_upload({"id": "id1", "etag": "abc", "snippet": {"title": "2019-01-01 00:00:00", "publishedAt": "2019-01-01T10:00:00Z"}}, args)
+        ledger = target.upload_ledger.open_ledger(self.ledger_file)
+        self.assertEqual(target.upload_ledger.load_videos(ledger), [("2019-01-01 00:00:00", None)])
+        ledger.close()
+
+    def test_parse_sequence_identity(self):
+        """
+        Test the parse_sequence_identity() function with --title prefixes and device ids
+        """
+        self.assertEqual(target.parse_sequence_identity("2019-01-21 08:50:07"), ("2019-01-21 08:50:07", None))
+        self.assertEqual(target.parse_sequence_identity("Holidays 2019-01-21 08:50:07"), ("2019-01-21 08:50:07", None))
+        self.assertEqual(target.parse_sequence_identity("Trip of 2019-01-20 2019-01-21 08:50:07 cam1"), ("2019-01-21 08:50:07", "cam1"))
+        self.assertEqual(target.parse_sequence_identity("Renamed video"), None)
+        self.assertEqual(target.parse_sequence_identity(None), None)
+
+    def test_get_uploaded_identities(self):
+        """
+        Test the get_uploaded_identities() function falls back to the description for renamed videos
+        """
+        identities = target.get_uploaded_identities([("Prefix 2019-01-21 08:50:07 cam1", "Description 2019-01-21 08:50:07 cam1"),
+                                                     ("Renamed video", "Description 2019-01-25 16:22:20"),
+                                                     ("Other video", None)])
+        self.assertEqual(identities, set([("2019-01-21 08:50:07", "cam1"), ("2019-01-25 16:22:20", None)]))
+
+    def test_analyze_sequences_uploaded_with_title_prefix(self):
+        """
+        Test the analyze_sequences() function recognizes the sequences uploaded with a --title prefix
+        """
+        youtube = FakeYouTube([("id1", "Holidays 2019-01-25 16:22:20")])
+        args = target.parse_args(['--upload-ledger', self.ledger_file, '--title', 'Holidays'])
+        new_sequences = target.analyze_sequences(sample_sequences, youtube, args)
+        self.assertEqual(len(new_sequences), 2)
+        self.assertNotIn(sample_sequences[1], new_sequences)
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def createFile(self, name, content):
+        file_path = os.path.join(self.tempdir, name)
+        with open(file_path, "wb") as f:
+            f.write(content)
+        return file_path
+
+    def test_block_ranges(self):
+        """
+        Test the block_ranges() function samples the start, the end and evenly spaced blocks, or the whole of a small file
+        """
+        block_size = target.fingerprint.BLOCK_SIZE
+        self.assertEqual(target.fingerprint.block_ranges(100), [(0, 100)])
+        self.assertEqual(target.fingerprint.block_ranges(3 * block_size), [(0, 3 * block_size)])
+        ranges = target.fingerprint.block_ranges(100 * block_size)
+        self.assertEqual(len(ranges), target.fingerprint.NUM_BLOCKS)
+        self.assertEqual(ranges[0], (0, block_size))
+        self.assertEqual(ranges[-1], (99 * block_size, 100 * block_size))
+
+    def test_clip_fingerprint_small_file(self):
+        """
+        Test the clip_fingerprint() function hashes the whole of a small file, not only its first block
+        """
+        content = os.urandom(3 * target.fingerprint.BLOCK_SIZE)
+        file_1 = self.createFile("GOPR0001.MOV", content)
+        file_2 = self.createFile("GOPR0002.MOV", content[:-1] + bytes([content[-1] ^ 1]))
+        self.assertNotEqual(target.fingerprint.clip_fingerprint(file_1), target.fingerprint.clip_fingerprint(file_2))
+
+    def test_clip_fingerprint(self):
+        """
+        Test the clip_fingerprint() function only depends on the size and content of the file
+        """
+        content = os.urandom(20 * target.fingerprint.BLOCK_SIZE)
+        file_1 = self.createFile("GOPR0001.MOV", content)
+        file_2 = self.createFile("GOPR0002.MOV", content)
+        self.assertEqual(target.fingerprint.clip_fingerprint(file_1), target.fingerprint.clip_fingerprint(file_2))
+        # Modify the last byte (part of the last sampled block)
+        file_3 = self.createFile("GOPR0003.MOV", content[:-1] + bytes([(content[-1] + 1) % 256]))
+        self.assertNotEqual(target.fingerprint.clip_fingerprint(file_1), target.fingerprint.clip_fingerprint(file_3))
+        self.assertEqual(target.fingerprint.clip_fingerprint(self.createFile("empty.MOV", b"")), "0-" + target.fingerprint.hashlib.sha1().hexdigest())
+
+    def test_analyze_sequences_same_content(self):
+        """
+        Test the analyze_sequences() function recognizes an uploaded sequence whose creation time changed
+        """
+        file_1 = self.createFile("GOPR0001.MOV", os.urandom(1024))
+        file_2 = self.createFile("GOPR0002.MOV", os.urandom(1024))
+        uploaded = Sequence([Clip(file_1, 300.0, datetime.datetime(2019, 1, 21, 8, 50, 7)), Clip(file_2, 300.0, datetime.datetime(2019, 1, 21, 8, 55, 8))])
+        index = target.sequence_index.open_index(":memory:")
+        target.sequence_index.store_fingerprint(index, target.get_sequence_fingerprint(uploaded), "2019-01-21 08:50:07")
+
+        # The clock of the actioncam has been reset
+        sequences = [Sequence([Clip(file_1, 300.0, datetime.datetime(2016, 1, 1, 0, 0, 0)), Clip(file_2, 300.0, datetime.datetime(2016, 1, 1, 0, 5, 1))]),
+                     Sequence([Clip(file_2, 300.0, datetime.datetime(2016, 1, 2, 0, 0, 0))]),
+                     Sequence([Clip("/tmp/vids/missing.MOV", 300.0, datetime.datetime(2016, 1, 3, 0, 0, 0))])]
+        new_sequences = target.analyze_sequences(sequences, None, target.parse_args(['--no-net']), index)
+        self.assertEqual(new_sequences, sequences[1:])
+        index.close()
+
+    def test_analyze_sequences_old_sequences(self):
+        """
+        Test the analyze_sequences() function reports the sequences already uploaded, but not the skipped ones
+        """
+        file_1 = self.createFile("GOPR0001.MOV", os.urandom(1024))
+        file_2 = self.createFile("GOPR0002.MOV", os.urandom(1024))
+        sequences = [Sequence([Clip(file_1, 300.0, datetime.datetime(2019, 1, 21, 8, 50, 7))]),
+                     Sequence([Clip(file_2, 300.0, datetime.datetime(2019, 1, 21, 10, 0, 0))])]
+        index = target.sequence_index.open_index(":memory:")
+        target.sequence_index.store_fingerprint(index, target.get_sequence_fingerprint(sequences[0]), "2019-01-21 08:50:07")
+        old_sequences = []
+        new_sequences = target.analyze_sequences(sequences, None, target.parse_args(['--no-net', '--min-length', '10']), index, old_sequences)
+        self.assertEqual(new_sequences, [])
+        self.assertEqual(old_sequences, sequences[:1])
+        index.close()
 
 class TestIdentifySequences(unittest.TestCase):
     def test_identify_sequences_valid(self):
         """
         Test the identify_sequences() function, passing a valid array of files
         """
-        videos_by_creation_time = {
-            datetime.datetime(2019, 1, 21, 8, 50, 7): {'duration': 300.0, 'file_path': '/tmp/vids/20190121_085007.MOV'},
-            datetime.datetime(2019, 1, 25, 16, 22, 20): {'duration': 300.0, 'file_path': '/tmp/vids/20190125_162220.MOV'},
-            datetime.datetime(2019, 1, 21, 9, 5, 8): {'duration': 216.75, 'file_path': '/tmp/vids/20190121_090508.MOV'},
-            datetime.datetime(2019, 1, 29, 8, 28, 26): {'duration': 300.0, 'file_path': '/tmp/vids/20190129_082825.MOV'},
-            datetime.datetime(2019, 1, 29, 8, 38, 27): {'duration': 286.0, 'file_path': '/tmp/vids/20190129_083826.MOV'},
-            datetime.datetime(2019, 1, 29, 8, 33, 27): {'duration': 300.0, 'file_path': '/tmp/vids/20190129_083327.MOV'},
-            datetime.datetime(2019, 1, 25, 16, 37, 21): {'duration': 300.0, 'file_path': '/tmp/vids/20190125_163721.MOV'},
-            datetime.datetime(2019, 1, 25, 16, 27, 21): {'duration': 300.0, 'file_path': '/tmp/vids/20190125_162721.MOV'},
-            datetime.datetime(2019, 1, 21, 8, 55, 8): {'duration': 300.0, 'file_path': '/tmp/vids/20190121_085508.MOV'},
-            datetime.datetime(2019, 1, 21, 9, 0, 8): {'duration': 300.0, 'file_path': '/tmp/vids/20190121_090008.MOV'},
-            datetime.datetime(2019, 1, 25, 16, 32, 21): {'duration': 300.0, 'file_path': '/tmp/vids/20190125_163221.MOV'}
-        }
-        creation_times = [
-            datetime.datetime(2019, 1, 25, 16, 37, 21),
-            datetime.datetime(2019, 1, 25, 16, 27, 21),
-            datetime.datetime(2019, 1, 25, 16, 32, 21),
-            datetime.datetime(2019, 1, 21, 8, 55, 8),
-            datetime.datetime(2019, 1, 25, 16, 22, 20),
-            datetime.datetime(2019, 1, 29, 8, 33, 27),
-            datetime.datetime(2019, 1, 21, 9, 5, 8),
-            datetime.datetime(2019, 1, 29, 8, 28, 26),
-            datetime.datetime(2019, 1, 21, 8, 50, 7),
-            datetime.datetime(2019, 1, 21, 9, 0, 8),
-            datetime.datetime(2019, 1, 29, 8, 38, 27)
+        # Unsorted list of clips
+        clips = [
+            Clip('/tmp/vids/20190121_085007.MOV', 300.0, datetime.datetime(2019, 1, 21, 8, 50, 7)),
+            Clip('/tmp/vids/20190125_162220.MOV', 300.0, datetime.datetime(2019, 1, 25, 16, 22, 20)),
+            Clip('/tmp/vids/20190121_090508.MOV', 216.75, datetime.datetime(2019, 1, 21, 9, 5, 8)),
+            Clip('/tmp/vids/20190129_082825.MOV', 300.0, datetime.datetime(2019, 1, 29, 8, 28, 26)),
+            Clip('/tmp/vids/20190129_083826.MOV', 286.0, datetime.datetime(2019, 1, 29, 8, 38, 27)),
+            Clip('/tmp/vids/20190129_083327.MOV', 300.0, datetime.datetime(2019, 1, 29, 8, 33, 27)),
+            Clip('/tmp/vids/20190125_163721.MOV', 300.0, datetime.datetime(2019, 1, 25, 16, 37, 21)),
+            Clip('/tmp/vids/20190125_162721.MOV', 300.0, datetime.datetime(2019, 1, 25, 16, 27, 21)),
+            Clip('/tmp/vids/20190121_085508.MOV', 300.0, datetime.datetime(2019, 1, 21, 8, 55, 8)),
+            Clip('/tmp/vids/20190121_090008.MOV', 300.0, datetime.datetime(2019, 1, 21, 9, 0, 8)),
+            Clip('/tmp/vids/20190125_163221.MOV', 300.0, datetime.datetime(2019, 1, 25, 16, 32, 21))
         ]
 
-        sequences = target.identify_sequences(videos_by_creation_time, creation_times)
+        sequences = target.identify_sequences(clips)
 
         # Confirm 3 sequences were identified
         self.assertEqual(len(sequences), 3)
@@ -409,7 +893,61 @@ class TestIdentifySequences(unittest.TestCase):
             self.assertEqual(len(seq), len(sample_sequences[idx]))
             for idx2, files in enumerate(seq):
                 for data in ["creation_time", "duration", "file_path"]:
-                    self.assertEqual(files[data], sample_sequences[idx][idx2][data])
+                    self.assertEqual(getattr(files, data), getattr(sample_sequences[idx][idx2], data))
+
+    def test_identify_sequences_gap_seconds(self):
+        """
+        Test the identify_sequences() function with a shorter and a longer gap between sequences
+        """
+        clips = [clip for seq in copy.deepcopy(sample_sequences) for clip in seq]
+        # In each sequence, there is a 1-second gap between the first and the second clips
+        self.assertEqual(len(target.identify_sequences(clips, 1)), 6)
+        # Over 4 days between the first and the second sequences, less between the second and the third
+        self.assertEqual(len(target.identify_sequences(clips, 4 * 86400)), 2)
+
+    def test_identify_sequences_multiple_devices(self):
+        """
+        Test the identify_sequences() function with overlapping clips from two devices,
+        and two clips created during the same second
+        """
+        clips = [
+            Clip('/tmp/cam1/A.MOV', 300.0, datetime.datetime(2019, 1, 21, 8, 50, 7), device="cam1"),
+            Clip('/tmp/cam2/A.MOV', 300.0, datetime.datetime(2019, 1, 21, 8, 50, 7), device="cam2"),
+            Clip('/tmp/cam1/C.MOV', 300.0, datetime.datetime(2019, 1, 21, 8, 55, 8), device="cam1"),
+            Clip('/tmp/cam1/B.MOV', 1.0, datetime.datetime(2019, 1, 21, 8, 55, 8), device="cam1"),
+            Clip('/tmp/cam2/B.MOV', 300.0, datetime.datetime(2019, 1, 21, 9, 30, 0), device="cam2")
+        ]
+        sequences = target.identify_sequences(clips)
+        self.assertEqual([[c.file_path for c in seq] for seq in sequences], [
+            ['/tmp/cam1/A.MOV', '/tmp/cam1/B.MOV', '/tmp/cam1/C.MOV'],
+            ['/tmp/cam2/A.MOV'],
+            ['/tmp/cam2/B.MOV']
+        ])
+        self.assertEqual([seq.device for seq in sequences], ["cam1", "cam2", "cam2"])
+
+class TestClipsAndSequences(unittest.TestCase):
+    def test_sequence_totals(self):
+        """
+        Test the derived totals of a Sequence
+        """
+        seq = Sequence([Clip('/tmp/vids/20190121_085007.MOV', 300.0, datetime.datetime(2019, 1, 21, 8, 50, 7), 1000),
+                        Clip('/tmp/vids/20190121_090508.MOV', 216.75, datetime.datetime(2019, 1, 21, 9, 5, 8), 500)])
+        self.assertEqual(len(seq), 2)
+        self.assertEqual(seq.duration, 516.75)
+        self.assertEqual(seq.size, 1500)
+        seq.append(Clip('/tmp/vids/20190121_091000.MOV', 10.0, datetime.datetime(2019, 1, 21, 9, 10, 0)))
+        self.assertEqual(seq.size, 1500)
+        self.assertEqual(seq.creation_time, datetime.datetime(2019, 1, 21, 8, 50, 7))
+
+    def test_clip_working_path(self):
+        """
+        Test that a Clip keeps track of its original path when its working path changes
+        """
+        clip = Clip('/tmp/vids/20190121_085007.MOV', 300.0, datetime.datetime(2019, 1, 21, 8, 50, 7))
+        clip.file_path = '/tmp/compressed/20190121_085007.MOV'
+        self.assertEqual(clip.original_path, '/tmp/vids/20190121_085007.MOV')
+        with self.assertRaises(AttributeError):
+            clip.unknown_attribute = True
 
 class TestInteractiveSequenceSelection(unittest.TestCase):
     def test_interactive_sequence_selection_empty_sequences(self):
@@ -528,9 +1066,279 @@ class TestAnalyzeFiles(unittest.TestCase):
         (This scenario should not ever happen)
         """
         with self.assertRaises(Exception) as cm:
-            sequences = target.analyze_files([""])
+            sequences = target.analyze_files([Clip("")])
         self.assertEqual(str(cm.exception), "There is no file to analyze at ''")
 
+    def test_analyze_files_probe_cache(self):
+        """
+        Test the analyze_files() function, with the metadata of the files in the probe cache
+        (ffprobe doesn't get called, since the dummy files are not real MOV files)
+        """
+        (tempdir, mov_file_1, mov_file_2, mov_file_3) = createTempFolderWithDummyMOVFiles()
+        cache = target.probe_cache.open_cache(":memory:")
+        for (f, creation_time) in [(mov_file_1, datetime.datetime(2019, 1, 21, 8, 50, 7)),
+                                   (mov_file_2, datetime.datetime(2019, 1, 21, 8, 55, 8)),
+                                   (mov_file_3, datetime.datetime(2019, 1, 25, 16, 22, 20))]:
+            stat = os.stat(f)
+            target.probe_cache.store_metadata(cache, f, stat.st_size, stat.st_mtime, 300.0, creation_time)
+        sequences = target.analyze_files([Clip(mov_file_3), Clip(mov_file_1), Clip(mov_file_2)], cache)
+        self.assertEqual(len(sequences), 2)
+        self.assertEqual([v.file_path for v in sequences[0]], [mov_file_1, mov_file_2])
+        self.assertEqual([v.file_path for v in sequences[1]], [mov_file_3])
+        cache.close()
+        shutil.rmtree(tempdir)
+
+class TestProbeFiles(unittest.TestCase):
+    def mock_probe_file(self, f, probe_backend):
+        if "invalid" in f:
+            raise Exception("I found no duration")
+        return (300.0, datetime.datetime(2019, 1, 21, 8, 50, int(f[-6:-4])), None)
+
+    def test_probe_files_order(self):
+        """
+        Test the probe_files() function returns the results in the same order as the files
+        """
+        original_probe_file = target.probe_file
+        target.probe_file = self.mock_probe_file
+        files = ["/tmp/vids/%02d.MOV" % i for i in range(20)]
+        results = target.probe_files(files, 4)
+        target.probe_file = original_probe_file
+        self.assertEqual([r[1].second for r in results], list(range(20)))
+
+    def test_probe_files_errors(self):
+        """
+        Test the probe_files() function reports the errors for each file, and raises the first error
+        """
+        original_probe_file = target.probe_file
+        target.probe_file = self.mock_probe_file
+        files = ["/tmp/vids/01.MOV", "/tmp/vids/invalid-02.MOV", "/tmp/vids/invalid-03.MOV"]
+        with self.assertLogs(level="ERROR") as cm:
+            with self.assertRaises(Exception) as cm_exception:
+                target.probe_files(files, 2)
+        target.probe_file = original_probe_file
+        self.assertEqual(str(cm_exception.exception), "I found no duration")
+        self.assertEqual(len(cm.output), 2)
+        self.assertTrue("/tmp/vids/invalid-02.MOV" in cm.output[0])
+        self.assertTrue("/tmp/vids/invalid-03.MOV" in cm.output[1])
+
+class TestProbeHeader(unittest.TestCase):
+    def test_probe_header(self):
+        """
+        Test the ffprobe.probe_header() function on MOV files with version 0 and 1 mvhd atoms
+        """
+        tempdir = tempfile.mkdtemp()
+        creation_time = datetime.datetime(2019, 1, 21, 8, 50, 7)
+        for (version, moov_at_end) in [(0, True), (0, False), (1, True)]:
+            file_path = os.path.join(tempdir, "20190121_085007.MOV")
+            createMOVFile(file_path, creation_time, 216.75, version, moov_at_end)
+            metadata = target.ffprobe.probe_header(file_path)
+            self.assertEqual(target.ffprobe.duration(metadata), 216.75)
+            self.assertEqual(target.ffprobe.creation_time(metadata), creation_time)
+            self.assertIsNone(target.ffprobe.video_stream(metadata))
+        shutil.rmtree(tempdir)
+
+    def test_probe_header_video_track(self):
+        """
+        Test the ffprobe.probe_header() function reads the size, frame rate and bitrate of the video track
+        """
+        tempdir = tempfile.mkdtemp()
+        file_path = os.path.join(tempdir, "GOPR0001.MP4")
+        # 2 seconds at 50 images/second, 2 MB in total (8 Mbit/s), after a sound track
+        tracks = createTrack(b"soun", 2.0, sample_sizes=[1000] * 10) + createTrack(b"vide", 2.0, 1920, 1080, [20000] * 100)
+        createMOVFile(file_path, datetime.datetime(2019, 1, 21, 8, 50, 7), 2.0, tracks=tracks)
+        info = target.ffprobe.video_stream(target.ffprobe.probe_header(file_path))
+        self.assertEqual(info, {"width": 1920, "height": 1080, "fps": 50.0, "bit_rate": 8000000})
+        (duration, creation_time, video) = target.probe_file(file_path)
+        self.assertEqual(video, info)
+        shutil.rmtree(tempdir)
+
+    def test_probe_header_invalid_file(self):
+        """
+        Test the ffprobe.probe_header() function on a file without moov atom
+        """
+        tempdir = tempfile.mkdtemp()
+        file_path = os.path.join(tempdir, "20190121_085007.MOV")
+        with open(file_path, "wb") as f:
+            f.write(struct.pack(">I4s4sI", 16, b"ftyp", b"qt  ", 0))
+        with self.assertRaises(Exception) as cm:
+            target.ffprobe.probe_header(file_path)
+        self.assertEqual(str(cm.exception), "I found no moov atom")
+        shutil.rmtree(tempdir)
+
+    def test_probe_fast_fallback(self):
+        """
+        Test the ffprobe.probe_fast() function falls back to ffprobe when the header can't be parsed
+        """
+        (tempdir, mov_file_1, mov_file_2, mov_file_3) = createTempFolderWithDummyMOVFiles()
+        original_probe = target.ffprobe.probe
+        target.ffprobe.probe = lambda f: {"fallback": f}
+        metadata = target.ffprobe.probe_fast(mov_file_1)
+        target.ffprobe.probe = original_probe
+        self.assertEqual(metadata, {"fallback": mov_file_1})
+        shutil.rmtree(tempdir)
+
+class TestProbeCache(unittest.TestCase):
+    def test_probe_cache_get_metadata(self):
+        """
+        Test that the cached metadata is only returned if the size and modification time match
+        """
+        cache = target.probe_cache.open_cache(":memory:")
+        creation_time = datetime.datetime(2019, 1, 21, 8, 50, 7)
+        target.probe_cache.store_metadata(cache, "/tmp/vids/20190121_085007.MOV", 1234, 1548060607.5, 300.0, creation_time)
+        self.assertEqual(target.probe_cache.get_metadata(cache, "/tmp/vids/20190121_085007.MOV", 1234, 1548060607.5), (300.0, creation_time, None))
+        self.assertIsNone(target.probe_cache.get_metadata(cache, "/tmp/vids/20190121_085007.MOV", 4321, 1548060607.5))
+        self.assertIsNone(target.probe_cache.get_metadata(cache, "/tmp/vids/20190121_085007.MOV", 1234, 1548060608.5))
+        self.assertIsNone(target.probe_cache.get_metadata(cache, "/tmp/vids/20190121_085508.MOV", 1234, 1548060607.5))
+        # The video stream is kept as well
+        video = {"width": 1920, "height": 1080, "fps": 59.94, "bit_rate": 45000000}
+        target.probe_cache.store_metadata(cache, "/tmp/vids/20190121_085508.MOV", 1234, 1548060607.5, 300.0, creation_time, video)
+        self.assertEqual(target.probe_cache.get_metadata(cache, "/tmp/vids/20190121_085508.MOV", 1234, 1548060607.5), (300.0, creation_time, video))
+        self.assertEqual(target.probe_cache.load_clips(cache)["/tmp/vids/20190121_085508.MOV"][0].video, video)
+        cache.close()
+
+    def test_probe_cache_evict_missing_files(self):
+        """
+        Test that only the entries of deleted files within the scanned folder get evicted
+        """
+        (tempdir, mov_file_1, mov_file_2, mov_file_3) = createTempFolderWithDummyMOVFiles()
+        cache = target.probe_cache.open_cache(":memory:")
+        creation_time = datetime.datetime(2019, 1, 21, 8, 50, 7)
+        for f in [mov_file_1, mov_file_2, mov_file_3, "/tmp/unplugged-actioncam/20190121_085007.MOV"]:
+            target.probe_cache.store_metadata(cache, f, 0, 0, 300.0, creation_time)
+        os.remove(mov_file_2)
+        self.assertEqual(target.probe_cache.evict_missing_files(cache, tempdir), 1)
+        self.assertIsNone(target.probe_cache.get_metadata(cache, mov_file_2, 0, 0))
+        self.assertIsNotNone(target.probe_cache.get_metadata(cache, mov_file_1, 0, 0))
+        self.assertIsNotNone(target.probe_cache.get_metadata(cache, "/tmp/unplugged-actioncam/20190121_085007.MOV", 0, 0))
+        # Without a folder, all the missing files get evicted
+        self.assertEqual(target.probe_cache.evict_missing_files(cache), 1)
+        target.probe_cache.clear_cache(cache)
+        self.assertIsNone(target.probe_cache.get_metadata(cache, mov_file_1, 0, 0))
+        cache.close()
+        shutil.rmtree(tempdir)
+
+    def test_probe_cache_done_flags(self):
+        """
+        Test that the clips are flagged as done in the probe cache, and that probing them again resets the flag
+        """
+        cache = target.probe_cache.open_cache(":memory:")
+        clip = Clip("/tmp/vids/20190121_085007.MOV", 300.0, datetime.datetime(2019, 1, 21, 8, 50, 7), 1234, 0)
+        storeClips(cache, [clip])
+        self.assertFalse(target.probe_cache.load_clips(cache)[clip.file_path][1])
+        target.probe_cache.mark_done(cache, [Sequence([clip])])
+        self.assertTrue(target.probe_cache.load_clips(cache)[clip.file_path][1])
+        storeClips(cache, [clip])
+        self.assertFalse(target.probe_cache.load_clips(cache)[clip.file_path][1])
+        target.probe_cache.remove_clips(cache, [clip.file_path])
+        self.assertEqual(target.probe_cache.load_clips(cache), {})
+        cache.close()
+
+class TestDoneClips(unittest.TestCase):
+    def createCache(self, mov_files):
+        """
+        Create a probe cache containing the first two files, only the first one being done
+        """
+        cache = target.probe_cache.open_cache(":memory:")
+        clips = []
+        for (f, creation_time) in [(mov_files[0], datetime.datetime(2019, 1, 21, 8, 50, 7)),
+                                   (mov_files[1], datetime.datetime(2019, 1, 25, 16, 22, 20))]:
+            stat = os.stat(f)
+            clips.append(Clip(f, 300.0, creation_time, stat.st_size, stat.st_mtime))
+        storeClips(cache, clips)
+        target.probe_cache.mark_done(cache, [Sequence([clips[0]])])
+        return cache
+
+    def test_select_files_to_analyze(self):
+        """
+        Test the select_files_to_analyze() function only returns the new files and the clips not done yet
+        """
+        (tempdir, mov_file_1, mov_file_2, mov_file_3) = createTempFolderWithDummyMOVFiles()
+        cache = self.createCache([mov_file_1, mov_file_2])
+        clips = target.select_files_to_analyze([Clip(mov_file_1), Clip(mov_file_2), Clip(mov_file_3)], [tempdir], cache, False)
+        self.assertEqual([c.file_path for c in clips], [mov_file_2, mov_file_3])
+        # The metadata of the clip from the trailing sequence comes from the probe cache
+        self.assertEqual(clips[0].creation_time, datetime.datetime(2019, 1, 25, 16, 22, 20))
+        self.assertIsNone(clips[1].creation_time)
+
+        # With --full-scan, the done clips are returned as well
+        clips = target.select_files_to_analyze([Clip(mov_file_1), Clip(mov_file_2), Clip(mov_file_3)], [tempdir], cache, True)
+        self.assertEqual([c.file_path for c in clips], [mov_file_1, mov_file_2, mov_file_3])
+        self.assertEqual(clips[0].duration, 300.0)
+        cache.close()
+        shutil.rmtree(tempdir)
+
+    def test_select_files_to_analyze_deleted_and_modified_files(self):
+        """
+        Test the select_files_to_analyze() function with files deleted from or modified on the actioncam
+        """
+        (tempdir, mov_file_1, mov_file_2, mov_file_3) = createTempFolderWithDummyMOVFiles()
+        cache = self.createCache([mov_file_1, mov_file_2])
+        os.remove(mov_file_1)
+        with open(mov_file_2, "w") as f:
+            f.write("modified")
+        clips = target.select_files_to_analyze([Clip(mov_file_2), Clip(mov_file_3)], [tempdir], cache, False)
+        self.assertEqual([c.file_path for c in clips], [mov_file_2, mov_file_3])
+        self.assertIsNone(clips[0].duration)
+        self.assertEqual(target.probe_cache.load_clips(cache), {})
+        cache.close()
+        shutil.rmtree(tempdir)
+
+    def test_flag_done_sequences(self):
+        """
+        Test the flag_done_sequences() function flags all the sequences but the trailing one as done
+        """
+        cache = target.probe_cache.open_cache(":memory:")
+        sequences = copy.deepcopy(sample_sequences)
+        for seq in sequences:
+            for clip in seq:
+                clip.size = 0
+                clip.mtime = 0
+        storeClips(cache, [clip for seq in sequences for clip in seq])
+
+        args = target.parse_args(['--no-net'])
+        target.flag_done_sequences(cache, sequences, sequences, args)
+        self.assertFalse(any(done for (clip, done) in target.probe_cache.load_clips(cache).values()))
+
+        args = target.parse_args([])
+        target.flag_done_sequences(cache, sequences, sequences, args)
+        indexed_clips = target.probe_cache.load_clips(cache)
+        for seq in sequences[:-1]:
+            for clip in seq:
+                self.assertTrue(indexed_clips[clip.file_path][1])
+        for clip in sequences[-1]:
+            self.assertFalse(indexed_clips[clip.file_path][1])
+        cache.close()
+
+    def test_flag_done_sequences_multiple_devices(self):
+        """
+        Test the flag_done_sequences() function keeps the trailing sequence of each device open
+        """
+        cache = target.probe_cache.open_cache(":memory:")
+        sequences = copy.deepcopy(sample_sequences)
+        for (seq, device) in zip(sequences, ["cam1", "cam2", "cam1"]):
+            for clip in seq:
+                (clip.size, clip.mtime, clip.device) = (0, 0, device)
+        storeClips(cache, [clip for seq in sequences for clip in seq])
+        target.flag_done_sequences(cache, sequences, sequences, target.parse_args([]))
+        indexed_clips = target.probe_cache.load_clips(cache)
+        self.assertEqual([indexed_clips[seq[0].file_path][1] for seq in sequences], [True, False, False])
+        cache.close()
+
+    def test_flag_done_sequences_not_uploaded(self):
+        """
+        Test the flag_done_sequences() function keeps open the closed sequences that weren't uploaded (e.g. skipped by --min-length)
+        """
+        cache = target.probe_cache.open_cache(":memory:")
+        sequences = copy.deepcopy(sample_sequences)
+        for seq in sequences:
+            for clip in seq:
+                (clip.size, clip.mtime) = (0, 0)
+        storeClips(cache, [clip for seq in sequences for clip in seq])
+        target.flag_done_sequences(cache, sequences, [sequences[1]], target.parse_args([]))
+        indexed_clips = target.probe_cache.load_clips(cache)
+        self.assertEqual([indexed_clips[seq[0].file_path][1] for seq in sequences], [False, True, False])
+        cache.close()
+
 class TestDetectFolder(unittest.TestCase):
     def test_detect_folder_explicit_path_valid(self):
         """
@@ -541,18 +1349,53 @@ class TestDetectFolder(unittest.TestCase):
 
         # Run detect_folder()
         args = target.parse_args(['--folder', tempdir])
-        (folder, files) = target.detect_folder(args)
+        (folders, clips) = target.detect_folder(args)
 
         # Validate the return of detect_folder()
-        self.assertEqual(folder, tempdir)
+        self.assertEqual(folders, [tempdir])
+        files = [c.file_path for c in clips]
         self.assertEqual(len(files), 3)
         self.assertTrue(mov_file_1 in files)
         self.assertTrue(mov_file_2 in files)
         self.assertTrue(mov_file_3 in files)
+        self.assertEqual([c.device for c in clips], [None, None, None])
 
         # Delete the temporary folder and files
         shutil.rmtree(tempdir)
 
+    def test_detect_folder_multiple_devices(self):
+        """
+        Test the detect_folder() function, explicitly passing it several folders, with and without device id
+        """
+        (tempdir_1, mov_file_1, mov_file_2, mov_file_3) = createTempFolderWithDummyMOVFiles()
+        (tempdir_2, mov_file_4, mov_file_5, mov_file_6) = createTempFolderWithDummyMOVFiles()
+
+        args = target.parse_args(['--folder', "helmet=%s" % tempdir_1, tempdir_2])
+        (folders, clips) = target.detect_folder(args)
+        self.assertEqual(folders, [tempdir_1, tempdir_2])
+        devices = dict((c.file_path, c.device) for c in clips)
+        self.assertEqual(devices[mov_file_1], "helmet")
+        self.assertEqual(devices[mov_file_4], os.path.basename(tempdir_2))
+
+        # The folders whose path contains "=" are not labelled
+        tempdir_3 = tempfile.mkdtemp(suffix="=take2")
+        self.assertEqual(target.parse_folder_arguments(["helmet=%s" % tempdir_3, tempdir_3, "/media/a=b/DCIM"]),
+                         [("helmet", tempdir_3), (os.path.basename(tempdir_3), tempdir_3), ("DCIM", "/media/a=b/DCIM")])
+        self.assertEqual(target.parse_folder_arguments(["helmet=/media/a=b"]), [("helmet", "/media/a=b")])
+        shutil.rmtree(tempdir_3)
+
+        # The same device id can't be used twice
+        logger = logging.getLogger()
+        logger.disabled = True
+        args = target.parse_args(['--folder', "helmet=%s" % tempdir_1, "helmet=%s" % tempdir_2])
+        with self.assertRaises(SystemExit) as cm:
+            target.detect_folder(args)
+        self.assertEqual(cm.exception.code, 19)
+        logger.disabled = False
+
+        shutil.rmtree(tempdir_1)
+        shutil.rmtree(tempdir_2)
+
     def test_detect_folder_explicit_path_invalid(self):
         """
         Test the detect_folder() function, explicitly passing it a invalid path
@@ -568,7 +1411,7 @@ class TestDetectFolder(unittest.TestCase):
         # Pass that now non-existing path to detect_folder()
         args = target.parse_args(['--folder', tempdir])
         with self.assertRaises(SystemExit) as cm:
-            (folder, files) = target.detect_folder(args)
+            (folders, clips) = target.detect_folder(args)
         the_exception = cm.exception
         self.assertEqual(the_exception.code, 10)
         logger.disabled = False
@@ -588,7 +1431,7 @@ class TestDetectFolder(unittest.TestCase):
         # Pass that now non-existing path to detect_folder()
         args = target.parse_args(['--folder', tempdir])
         with self.assertRaises(SystemExit) as cm:
-            (folder, files) = target.detect_folder(args)
+            (folders, clips) = target.detect_folder(args)
         the_exception = cm.exception
         self.assertEqual(the_exception.code, 11)
         logger.disabled = False
@@ -607,11 +1450,1028 @@ class TestDetectFolder(unittest.TestCase):
         # Pass that now non-existing path to detect_folder()
         args = target.parse_args([])
         with self.assertRaises(SystemExit) as cm:
-            (folder, files) = target.detect_folder(args)
+            (folders, clips) = target.detect_folder(args)
         the_exception = cm.exception
         self.assertEqual(the_exception.code, 12)
         logger.disabled = False
 
+class TestDiscovery(unittest.TestCase):
+    def test_scan_video_files(self):
+        """
+        Test the scan_video_files() function recurses into subfolders, and returns the size and modification time of each file
+        """
+        tempdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tempdir, "DCIM", "100GOPRO"))
+        os.makedirs(os.path.join(tempdir, "DCIM", "101GOPRO"))
+        for name in ["GH010001.MP4", "GH010001.LRV", "GH010001.THM", "._GH010001.MP4", "GH010002.mp4"]:
+            with open(os.path.join(tempdir, "DCIM", "100GOPRO", name), "w") as f:
+                f.write("video")
+        with open(os.path.join(tempdir, "DCIM", "101GOPRO", "20190121_085007.MOV"), "w") as f:
+            f.write("longer video")
+
+        video_files = list(target.discovery.scan_video_files(tempdir, [".MOV", ".MP4"]))
+        self.assertEqual([f[0] for f in video_files], [
+            os.path.join(tempdir, "DCIM", "100GOPRO", "GH010001.MP4"),
+            os.path.join(tempdir, "DCIM", "101GOPRO", "20190121_085007.MOV")
+        ])
+        self.assertEqual([f[1] for f in video_files], [5, 12])
+        self.assertEqual(video_files[1][2], os.stat(video_files[1][0]).st_mtime)
+
+        # Extensions are case-sensitive, preview files are always ignored
+        video_files = list(target.discovery.scan_video_files(tempdir, [".mp4", ".LRV"]))
+        self.assertEqual([f[0] for f in video_files], [os.path.join(tempdir, "DCIM", "100GOPRO", "GH010002.mp4")])
+
+        # A symbolic link looping back to a parent folder isn't followed
+        os.symlink(os.path.join(tempdir, "DCIM"), os.path.join(tempdir, "DCIM", "101GOPRO", "loop"))
+        video_files = list(target.discovery.scan_video_files(tempdir, [".MOV", ".MP4"]))
+        self.assertEqual(len(video_files), 2)
+        shutil.rmtree(tempdir)
+
+    def test_analyze_folder_reuses_stat_data(self):
+        """
+        Test the analyze_folder() function fills in the size and modification time of the clips
+        """
+        (tempdir, mov_file_1, mov_file_2, mov_file_3) = createTempFolderWithDummyMOVFiles()
+        clips = target.analyze_folder(tempdir, "helmet")
+        self.assertEqual(sorted(c.file_path for c in clips), sorted([mov_file_1, mov_file_2, mov_file_3]))
+        for clip in clips:
+            self.assertEqual(clip.size, 0)
+            self.assertEqual(clip.mtime, os.stat(clip.file_path).st_mtime)
+            self.assertEqual(clip.device, "helmet")
+        shutil.rmtree(tempdir)
+
+class TestCameraDetection(unittest.TestCase):
+    def createMountedCards(self):
+        """
+        Create a root folder with two memory cards containing DCIM-style layouts, and a non-actioncam drive
+        """
+        root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(root, "CARD_A", "DCIM", "100MEDIA"))
+        os.makedirs(os.path.join(root, "CARD_A", "DCIM", "101MEDIA"))
+        tempfile.mkstemp(suffix=".MOV", dir=os.path.join(root, "CARD_A", "DCIM", "100MEDIA"))
+        tempfile.mkstemp(suffix=".MOV", dir=os.path.join(root, "CARD_A", "DCIM", "101MEDIA"))
+        os.makedirs(os.path.join(root, "CARD_B", "DCIM"))
+        tempfile.mkstemp(suffix=".MOV", dir=os.path.join(root, "CARD_B", "DCIM"))
+        os.makedirs(os.path.join(root, "USB_DRIVE", "Documents"))
+        return root
+
+    def test_detect_camera_folders_last_volume_first(self):
+        """
+        Test the detect_camera_folders() function checks the last detected volume first
+        """
+        root = self.createMountedCards()
+        last_volume_file = os.path.join(root, "last-volume.json")
+        folders = target.camera_detection.detect_camera_folders([root], last_volume_file)
+        self.assertEqual(folders, [os.path.join(root, "CARD_A", "DCIM")])
+        self.assertEqual(target.camera_detection.load_last_volume(last_volume_file)["label"], "CARD_A")
+
+        target.camera_detection.save_last_volume(last_volume_file, {"uuid": None, "label": "CARD_B", "mount_point": "/media/CARD_B"})
+        folders = target.camera_detection.detect_camera_folders([root], last_volume_file)
+        self.assertEqual(folders, [os.path.join(root, "CARD_B", "DCIM")])
+        shutil.rmtree(root)
+
+    def test_detect_camera_folders_nothing_found(self):
+        """
+        Test the detect_camera_folders() function when no actioncam is mounted
+        """
+        root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(root, "USB_DRIVE", "DCIM"))
+        self.assertEqual(target.camera_detection.detect_camera_folders([root], None), [])
+        shutil.rmtree(root)
+
+    def test_list_mounts(self):
+        """
+        Test the list_mounts() function, with escaped spaces in the mount points
+        """
+        (fd, mounts_file) = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write("/dev/sda2 / ext4 rw,relatime 0 0\n")
+            f.write("/dev/mmcblk0p1 /media/user/SD\\040CARD vfat rw,nosuid,nodev 0 0\n")
+        self.assertEqual(target.camera_detection.list_mounts(mounts_file), [
+            ("/dev/sda2", "/", "ext4"),
+            ("/dev/mmcblk0p1", "/media/user/SD CARD", "vfat")
+        ])
+        os.remove(mounts_file)
+
+    def test_detect_folder_automatic_detection(self):
+        """
+        Test the detect_folder() function, automatically detecting the actioncam in --detect-root
+        """
+        root = self.createMountedCards()
+        args = target.parse_args(['--detect-root', root, '--last-volume', os.path.join(root, "last-volume.json")])
+        (folders, clips) = target.detect_folder(args)
+        self.assertEqual(folders, [os.path.join(root, "CARD_A", "DCIM")])
+        self.assertEqual(len(clips), 2)
+        shutil.rmtree(root)
+
+    def test_detect_folder_automatic_detection_no_video_files(self):
+        """
+        Test the detect_folder() function, automatically detecting a folder which doesn't contain any video file
+        """
+        tempdir = tempfile.mkdtemp()
+        detect_camera_folders = target.camera_detection.detect_camera_folders
+        target.camera_detection.detect_camera_folders = lambda detect_root, last_volume, extensions: [tempdir]
+        try:
+            (folders, clips) = target.detect_folder(target.parse_args([]))
+        finally:
+            target.camera_detection.detect_camera_folders = detect_camera_folders
+            shutil.rmtree(tempdir)
+        self.assertEqual((folders, clips), ([tempdir], []))
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.processed = []
+        self.process_sequences = target.process_sequences
+        target.process_sequences = lambda sequences, youtube, args, index=None: self.processed.append(sequences) or sequences
+
+    def tearDown(self):
+        target.process_sequences = self.process_sequences
+        shutil.rmtree(self.tempdir)
+
+    def createClip(self, name, creation_time, duration):
+        file_path = os.path.join(self.tempdir, name)
+        createMOVFile(file_path, creation_time, duration)
+        return file_path
+
+    def test_watch_iteration(self):
+        """
+        Test the watch_iteration() function waits for the files to be settled and the sequences to be closed
+        """
+        args = target.parse_args(['--no-net', '--watch', '--settle-seconds', '10', '--gap-seconds', '30'])
+        sources = [(self.tempdir, None)]
+        cache = target.probe_cache.open_cache(":memory:")
+        index = target.sequence_index.open_index(":memory:")
+        state = target.create_watch_state([], [self.tempdir], cache, args, 0)
+        file_1 = self.createClip("GOPR0001.MOV", datetime.datetime(2019, 1, 21, 8, 0, 0), 300)
+
+        # The file has just been written
+        self.assertEqual(target.watch_iteration(state, sources, cache, index, None, args, 0), [])
+        self.assertIn(file_1, state["pending"])
+        # The file is settled, but the sequence could still be extended
+        self.assertEqual(target.watch_iteration(state, sources, cache, index, None, args, 10), [])
+        self.assertIn(file_1, state["clips"])
+        self.assertIn(file_1, target.probe_cache.load_clips(cache))
+
+        # A new recording starts: the first sequence is closed as soon as the new file is analyzed
+        file_2 = self.createClip("GOPR0002.MOV", datetime.datetime(2019, 1, 21, 10, 0, 0), 60)
+        self.assertEqual(target.watch_iteration(state, sources, cache, index, None, args, 15), [])
+        closed = target.watch_iteration(state, sources, cache, index, None, args, 25)
+        self.assertEqual([[c.file_path for c in seq] for seq in closed], [[file_1]])
+        self.assertEqual(self.processed, [closed])
+        self.assertEqual(list(state["clips"]), [file_2])
+
+        # The trailing sequence is closed once nothing has been written for --gap-seconds
+        self.assertEqual(target.watch_iteration(state, sources, cache, index, None, args, 50), [])
+        closed = target.watch_iteration(state, sources, cache, index, None, args, 55)
+        self.assertEqual([[c.file_path for c in seq] for seq in closed], [[file_2]])
+        self.assertEqual(state["clips"], {})
+        self.assertEqual(target.watch_iteration(state, sources, cache, index, None, args, 100), [])
+        self.assertEqual(len(self.processed), 2)
+        cache.close()
+        index.close()
+
+    def test_watch_iteration_file_being_written(self):
+        """
+        Test the watch_iteration() function waits while a file keeps changing
+        """
+        args = target.parse_args(['--no-net', '--watch', '--settle-seconds', '10'])
+        sources = [(self.tempdir, None)]
+        state = target.create_watch_state([], [self.tempdir], None, args, 0)
+        file_1 = self.createClip("GOPR0001.MOV", datetime.datetime(2019, 1, 21, 8, 0, 0), 300)
+        target.watch_iteration(state, sources, None, None, None, args, 0)
+        with open(file_1, "ab") as f:
+            f.write(b"\0" * 1024)
+        target.watch_iteration(state, sources, None, None, None, args, 10)
+        self.assertEqual(state["pending"][file_1][2], 10)
+        self.assertEqual(state["clips"], {})
+
+    def test_watch_iteration_invalid_file(self):
+        """
+        Test the watch_iteration() function skips the files that can't be analyzed, and keeps watching
+        """
+        args = target.parse_args(['--no-net', '--watch', '--settle-seconds', '10'])
+        sources = [(self.tempdir, None)]
+        state = target.create_watch_state([], [self.tempdir], None, args, 0)
+        file_1 = self.createClip("GOPR0001.MOV", datetime.datetime(2019, 1, 21, 8, 0, 0), 300)
+        file_2 = os.path.join(self.tempdir, "GOPR0002.MOV")
+        with open(file_2, "wb") as f:
+            f.write(b"not a video")
+        target.watch_iteration(state, sources, None, None, None, args, 0)
+        with self.assertLogs(level="WARNING"):
+            target.watch_iteration(state, sources, None, None, None, args, 10)
+        self.assertEqual(list(state["clips"]), [file_1])
+        self.assertIn(file_2, state["failed"])
+        # Not analyzed again, unless it changes
+        target.watch_iteration(state, sources, None, None, None, args, 20)
+        self.assertEqual(state["pending"], {})
+        with open(file_2, "ab") as f:
+            f.write(b"\0" * 1024)
+        target.watch_iteration(state, sources, None, None, None, args, 30)
+        self.assertIn(file_2, state["pending"])
+
+    def test_create_watch_state(self):
+        """
+        Test the create_watch_state() function skips the clips handled in previous runs
+        """
+        file_1 = self.createClip("GOPR0001.MOV", datetime.datetime(2019, 1, 21, 8, 0, 0), 300)
+        file_2 = self.createClip("GOPR0002.MOV", datetime.datetime(2019, 1, 21, 10, 0, 0), 60)
+        file_3 = self.createClip("GOPR0003.MOV", datetime.datetime(2019, 1, 21, 12, 0, 0), 60)
+        cache = target.probe_cache.open_cache(":memory:")
+        clips = target.scan_sources([(self.tempdir, None)], [".MOV"])
+        target.probe_clips(clips[:2], cache)
+        target.probe_cache.mark_done(cache, [Sequence([clips[0]])])
+
+        args = target.parse_args(['--no-net', '--watch'])
+        state = target.create_watch_state(target.scan_sources([(self.tempdir, None)], [".MOV"]), [self.tempdir], cache, args, 0)
+        self.assertEqual(state["handled"], set([file_1]))
+        self.assertEqual(list(state["clips"]), [file_2])
+        self.assertEqual(state["pending"], {})
+        cache.close()
+
+    def test_polling_watcher(self):
+        """
+        Test the polling watcher, and the inotify watcher when available
+        """
+        watcher = target.watch.create_watcher([self.tempdir], False)
+        self.assertIsInstance(watcher, target.watch.PollingWatcher)
+        self.assertFalse(watcher.wait(0))
+        watcher.close()
+
+    def test_inotify_watcher(self):
+        """
+        Test the inotify watcher is woken up by a new file
+        """
+        watcher = target.watch.create_watcher([self.tempdir])
+        if not isinstance(watcher, target.watch.InotifyWatcher):
+            self.skipTest("inotify is not available")
+        self.assertFalse(watcher.wait(0))
+        self.createClip("GOPR0001.MOV", datetime.datetime(2019, 1, 21, 8, 0, 0), 300)
+        self.assertTrue(watcher.wait(1))
+        self.assertFalse(watcher.wait(0))
+        watcher.close()
+
+class TestPipeline(unittest.TestCase):
+    def test_run_pipeline(self):
+        """
+        Test the run_pipeline() function passes all the items through all the stages
+        """
+        stages = [target.pipeline.Stage("double", lambda x: x * 2, 3),
+                  target.pipeline.Stage("increment", lambda x: x + 1, 2)]
+        results = list(target.pipeline.run_pipeline(range(20), stages))
+        self.assertEqual(sorted(results), [x * 2 + 1 for x in range(20)])
+
+    def test_run_pipeline_overlap(self):
+        """
+        Test the run_pipeline() function runs the stages at the same time
+        """
+        second_item_started = target.threading.Event()
+        def compress(x):
+            if x == 1:
+                second_item_started.set()
+            return x
+        def upload(x):
+            if x == 0:
+                # The second item gets compressed while the first one is uploaded
+                self.assertTrue(second_item_started.wait(5))
+            return x
+        stages = [target.pipeline.Stage("compress", compress), target.pipeline.Stage("upload", upload)]
+        self.assertEqual(list(target.pipeline.run_pipeline(range(3), stages)), [0, 1, 2])
+
+    def test_run_pipeline_max_pending(self):
+        """
+        Test the run_pipeline() function limits the number of items between two stages with a semaphore
+        """
+        pending = {"count": 0, "max": 0}
+        lock = target.threading.Lock()
+        def compress(x):
+            with lock:
+                pending["count"] += 1
+                pending["max"] = max(pending["max"], pending["count"])
+            return x
+        def upload(x):
+            time.sleep(0.01)
+            with lock:
+                pending["count"] -= 1
+            return x
+        semaphore = target.threading.BoundedSemaphore(2)
+        stages = [target.pipeline.Stage("compress", compress, 4, acquire=semaphore),
+                  target.pipeline.Stage("upload", upload, 1, release=semaphore)]
+        self.assertEqual(len(list(target.pipeline.run_pipeline(range(10), stages, queue_size=5))), 10)
+        self.assertEqual(pending["max"], 2)
+
+    def test_run_pipeline_failure(self):
+        """
+        Test the run_pipeline() function stops and raises the exception of a failed stage
+        """
+        processed = []
+        def compress(x):
+            if x == 2:
+                sys.exit(16)
+            return x
+        stages = [target.pipeline.Stage("compress", compress), target.pipeline.Stage("upload", processed.append)]
+        with self.assertRaises(SystemExit) as cm:
+            list(target.pipeline.run_pipeline(range(100), stages))
+        self.assertEqual(cm.exception.code, 16)
+        # The failed item and the next ones never reach the upload stage
+        self.assertLessEqual(len(processed), 2)
+
+    def test_compress_merge_and_upload_sequences(self):
+        """
+        Test the compress_merge_and_upload_sequences() function uploads the sequences and remembers their fingerprints
+        """
+        tempdir = tempfile.mkdtemp()
+        sequences = []
+        for idx in range(3):
+            file_path = os.path.join(tempdir, "GOPR%04d.MOV" % idx)
+            with open(file_path, "wb") as f:
+                f.write(os.urandom(1024))
+            sequences.append(Sequence([Clip(file_path, 300.0, datetime.datetime(2019, 1, 21 + idx, 8, 0, 0))]))
+        uploads = []
+        upload_sequence = target.upload_sequence
+        target.upload_sequence = lambda file_to_upload, sequence_title, youtube, args, media_body=None, description_note=None: uploads.append(file_to_upload) or {"id": sequence_title}
+        index = target.sequence_index.open_index(":memory:")
+        try:
+            args = target.parse_args(['--no-compression', '--pre-copy', '--copy-workers', '2', '--no-upload-ledger'])
+            target.compress_merge_and_upload_sequences(sequences, [], None, args, index)
+        finally:
+            target.upload_sequence = upload_sequence
+        # With several copy workers, the sequences can be uploaded in any order
+        self.assertEqual(sorted(os.path.basename(f) for f in uploads), ["GOPR0000.MOV", "GOPR0001.MOV", "GOPR0002.MOV"])
+        # The pre-copied files have been deleted
+        for f in uploads:
+            self.assertFalse(os.path.exists(f))
+        self.assertEqual(sorted(target.sequence_index.load_fingerprints(index).values()), ["2019-01-21 08:00:00", "2019-01-22 08:00:00", "2019-01-23 08:00:00"])
+        index.close()
+        shutil.rmtree(tempdir)
+
+class TestStreaming(unittest.TestCase):
+    def simulateResumableUpload(self, media, failed_chunks=()):
+        """
+        Upload the media the way googleapiclient does, without size, returns the received data
+        The chunks whose index is in failed_chunks are sent twice
+        """
+        received = b""
+        progress = 0
+        num_chunks = 0
+        while True:
+            size = media.size()
+            data = media.getbytes(progress, media.chunksize())
+            if len(data) < media.chunksize():
+                size = progress + len(data)
+            if num_chunks in failed_chunks:
+                # The upload of this chunk failed, it gets sent again
+                self.assertEqual(media.getbytes(progress, media.chunksize()), data)
+            num_chunks += 1
+            received += data
+            progress += len(data)
+            if size is not None and progress == size:
+                return received
+
+    def test_streaming_media_upload(self):
+        """
+        Test the StreamingMediaUpload class sends the whole stream, whatever its length
+        """
+        for length in [0, 1, 15, 16, 17, 100]:
+            data = os.urandom(length)
+            media = target.StreamingMediaUpload(io.BytesIO(data), "video/mp4", chunksize=4)
+            self.assertEqual(self.simulateResumableUpload(media, failed_chunks=(1, 3)), data)
+            self.assertEqual(media.size(), length)
+            # Only the current chunk is kept in memory
+            self.assertLessEqual(len(media._buffer), 2 * 4 + 1)
+
+    def test_streaming_media_upload_rewind(self):
+        """
+        Test the StreamingMediaUpload class can't go back before the current chunk
+        """
+        media = target.StreamingMediaUpload(io.BytesIO(os.urandom(100)), "video/mp4", chunksize=4)
+        media.getbytes(0, 4)
+        media.getbytes(4, 4)
+        with self.assertRaises(Exception):
+            media.getbytes(0, 4)
+
+    def test_streaming_media_upload_check_end(self):
+        """
+        Test the StreamingMediaUpload class aborts the upload if the producer of the stream failed
+        """
+        def check_end():
+            sys.exit(16)
+        media = target.StreamingMediaUpload(io.BytesIO(os.urandom(10)), "video/mp4", chunksize=4, check_end=check_end)
+        with self.assertRaises(SystemExit) as cm:
+            self.simulateResumableUpload(media)
+        self.assertEqual(cm.exception.code, 16)
+
+    def test_get_streaming_command(self):
+        """
+        Test the get_streaming_command() function writes fragmented MP4 to the standard output
+        """
+        command = target.get_streaming_command("/tmp/files.txt", target.parse_args(['--stream']))
+        self.assertEqual(command[command.index("-movflags") + 1], "frag_keyframe+empty_moov")
+        self.assertEqual(command[-1], "pipe:1")
+        self.assertIn("scale=iw/2:ih/2", command)
+        command = target.get_streaming_command("/tmp/files.txt", target.parse_args(['--stream', '--no-compression']))
+        self.assertEqual(command[command.index("-c") + 1], "copy")
+
+    def test_upload_streamed_sequence_dry_run(self):
+        """
+        Test the upload_streamed_sequence() function with --dry-run leaves no temporary files
+        """
+        tempdir = tempfile.mkdtemp()
+        file_path = os.path.join(tempdir, "GOPR0001.MOV")
+        open(file_path, "w").close()
+        job = Job(Sequence([Clip(file_path, 300.0, datetime.datetime(2019, 1, 21, 8, 0, 0))]), 0)
+        target.upload_streamed_sequence(job, 1, [], None, target.parse_args(['--stream', '--dry-run']))
+        self.assertFalse(os.path.exists(job.tempdir))
+        self.assertTrue(job.done)
+        shutil.rmtree(tempdir)
+
+class TestEncodeCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tempdir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def createFile(self, name, size):
+        file_path = os.path.join(self.tempdir, name)
+        with open(file_path, "wb") as f:
+            f.write(b"\0" * size)
+        return file_path
+
+    def test_store_and_lookup(self):
+        """
+        Test the store() and lookup() functions
+        """
+        self.assertIsNone(target.encode_cache.lookup(self.cache_dir, "abc"))
+        file_path = self.createFile("merged.MOV", 100)
+        cached_file = target.encode_cache.store(self.cache_dir, "abc", file_path, 1000)
+        self.assertEqual(cached_file, os.path.join(self.cache_dir, "abc.MOV"))
+        self.assertFalse(os.path.exists(file_path))
+        self.assertEqual(target.encode_cache.lookup(self.cache_dir, "abc"), cached_file)
+        target.encode_cache.remove(self.cache_dir, "abc")
+        self.assertIsNone(target.encode_cache.lookup(self.cache_dir, "abc"))
+
+    def test_store_too_large(self):
+        """
+        Test the store() function doesn't cache files larger than the cache
+        """
+        file_path = self.createFile("merged.MOV", 100)
+        self.assertEqual(target.encode_cache.store(self.cache_dir, "abc", file_path, 10), file_path)
+        self.assertTrue(os.path.exists(file_path))
+
+    def test_evict_least_recently_used(self):
+        """
+        Test the store() function evicts the least recently used files, except the ones in use
+        """
+        for (idx, key) in enumerate(["a", "b", "c"]):
+            cached_file = target.encode_cache.store(self.cache_dir, key, self.createFile("%s.MOV" % key, 100), 300)
+            os.utime(cached_file, (1000 + idx, 1000 + idx))
+        # "a" is used again, "b" becomes the least recently used file
+        target.encode_cache.lookup(self.cache_dir, "a")
+        target.encode_cache.store(self.cache_dir, "d", self.createFile("d.MOV", 100), 300)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["a.MOV", "c.MOV", "d.MOV"])
+        # "c" is waiting to be uploaded
+        target.encode_cache.store(self.cache_dir, "e", self.createFile("e.MOV", 150), 300, set(["c"]))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["c.MOV", "e.MOV"])
+
+    def test_prepare_sequence_encode_cache(self):
+        """
+        Test the prepare_sequence() function only merges a sequence once with the encode cache
+        """
+        seq = Sequence([Clip(self.createFile("GOPR%04d.MOV" % idx, 1000 + idx), 300.0, datetime.datetime(2019, 1, 21, 8, 5 * idx, 0)) for idx in range(2)])
+        merges = []
+        def mock_merge_sequence(seq, dry_run, logging_level, progress=None, tempdir=None):
+            merges.append(seq)
+            return self.createFile("merged.MOV", 10)
+        merge_sequence = target.merge_sequence
+        target.merge_sequence = mock_merge_sequence
+        args = target.parse_args(['--no-compression', '--encode-cache', self.cache_dir, '--no-upload-ledger'])
+        cache_in_use = set()
+        try:
+            job = target.prepare_sequence(Job(seq, 0), 1, args, cache_in_use)
+            job = target.prepare_sequence(Job(seq, 0), 1, args, cache_in_use)
+        finally:
+            target.merge_sequence = merge_sequence
+        self.assertEqual(len(merges), 1)
+        self.assertTrue(job.file_to_upload.startswith(self.cache_dir))
+        self.assertEqual(cache_in_use, set([job.cache_key]))
+
+        # The cached file is kept if the upload is aborted, and deleted once uploaded
+        upload_sequence = target.upload_sequence
+        try:
+            target.upload_sequence = lambda file_to_upload, sequence_title, youtube, args, media_body=None, description_note=None: None
+            target.upload_prepared_sequence(job, 1, [], None, args, cache_in_use)
+            self.assertTrue(os.path.exists(job.file_to_upload))
+            target.upload_sequence = lambda file_to_upload, sequence_title, youtube, args, media_body=None, description_note=None: {"id": "abc"}
+            target.upload_prepared_sequence(job, 1, [], None, args, cache_in_use)
+            self.assertFalse(os.path.exists(job.file_to_upload))
+        finally:
+            target.upload_sequence = upload_sequence
+        self.assertEqual(cache_in_use, set())
+
+    def test_prepare_sequence_encode_cache_note(self):
+        """
+        Test the prepare_sequence() function doesn't detect the dead spans of a cached sequence again, and keeps its description note
+        """
+        files = [self.createFile("GOPR%04d.MOV" % idx, 1000 + idx) for idx in range(2)]
+        detections = []
+        def mock_get_detect_command(file_path, min_seconds):
+            detections.append(file_path)
+            return [sys.executable, "-c", "import sys; sys.stderr.write('black_start:10 black_end:62.5 black_duration:52.5')"]
+        get_detect_command = target.dead_spans.get_detect_command
+        merge_sequence = target.merge_sequence
+        target.dead_spans.get_detect_command = mock_get_detect_command
+        target.merge_sequence = lambda seq, dry_run, logging_level, progress=None, tempdir=None: self.createFile("merged.MOV", 10)
+        args = target.parse_args(['--no-compression', '--drop-dead-spans', '--encode-cache', self.cache_dir, '--no-upload-ledger'])
+        jobs = []
+        try:
+            for run in range(2):
+                seq = Sequence([Clip(file_path, 300.0, datetime.datetime(2019, 1, 21, 8, 5 * idx, 0)) for (idx, file_path) in enumerate(files)])
+                jobs.append(target.prepare_sequence(Job(seq, 0), 1, args, set()))
+        finally:
+            target.dead_spans.get_detect_command = get_detect_command
+            target.merge_sequence = merge_sequence
+        self.assertEqual(detections, files)
+        self.assertEqual(jobs[1].file_to_upload, jobs[0].file_to_upload)
+        self.assertEqual(jobs[1].description_note, "Removed 2 static or black spans (0:01:45 in total): 0:00:10-0:01:02, 0:05:10-0:06:02.")
+        # The note goes away with its file
+        target.encode_cache.remove(self.cache_dir, jobs[0].cache_key)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+class TestFFmpegProgress(unittest.TestCase):
+    PROGRESS = ["frame=120", "fps=60.0", "total_size=2000000", "out_time_us=4000000", "speed=2.00x", "progress=continue",
+                "frame=240", "fps=60.0", "total_size=N/A", "out_time_us=8000000", "speed=N/A", "progress=end"]
+
+    def test_parse_progress(self):
+        """
+        Test the parse_progress() function splits the FFmpeg output into blocks
+        """
+        blocks = list(target.ffmpeg_progress.parse_progress([(line + "\n").encode("utf-8") for line in self.PROGRESS]))
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual(blocks[0]["frame"], "120")
+        self.assertEqual(blocks[1]["progress"], "end")
+
+    def test_get_status(self):
+        """
+        Test the get_status() function computes the ETA from the speed and the duration of the input
+        """
+        blocks = list(target.ffmpeg_progress.parse_progress(self.PROGRESS))
+        status = target.ffmpeg_progress.get_status(blocks[0], 10.0)
+        self.assertEqual((status["fps"], status["speed"], status["size"], status["out_time"]), (60.0, 2.0, 2000000.0, 4.0))
+        self.assertEqual(status["eta"], 3.0)
+        self.assertEqual(target.ffmpeg_progress.format_status("GOPR0001.MP4", status, 10.0), "GOPR0001.MP4: 40% 60.0 fps 2.00x 2.0 MB ETA 0:00:03")
+        # Values not available yet
+        status = target.ffmpeg_progress.get_status(blocks[1], 10.0)
+        self.assertEqual((status["size"], status["speed"], status["eta"]), (None, None, None))
+        self.assertEqual(target.ffmpeg_progress.get_status(blocks[0])["eta"], None)
+
+    def test_write_stats(self):
+        """
+        Test the write_stats() function appends one row per encode to the CSV file
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            stats_file = os.path.join(tempdir, "stats.csv")
+            command = ["ffmpeg", "-nostdin", "-i", "in.MOV", "-vf", "scale=iw/2:ih/2", "-r", "25", "out.MOV"]
+            status = {"frames": 240.0, "fps": 60.0, "speed": 2.0, "size": 4000000.0, "out_time": 8.0, "eta": 0.0}
+            target.ffmpeg_progress.write_stats(stats_file, command, status, 8.0, 4.0)
+            target.ffmpeg_progress.write_stats(stats_file, command, status, 8.0, 2.0)
+            with open(stats_file) as f:
+                rows = list(csv.DictReader(f))
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual((rows[0]["input"], rows[0]["output"], rows[0]["options"]), ("in.MOV", "out.MOV", "-vf scale=iw/2:ih/2 -r 25"))
+        self.assertEqual((rows[0]["fps"], rows[0]["speed"], rows[0]["size"]), ("60.00", "2.000", "4000000"))
+        self.assertEqual(rows[1]["speed"], "4.000")
+
+    def test_monitor(self):
+        """
+        Test the monitor() function reports the progress of a process, and warns when it stalls
+        """
+        script = "import sys, time\nprint('%s')\nsys.stdout.flush()\ntime.sleep(0.5)\nprint('%s')" % ("\\n".join(self.PROGRESS[:6]), "\\n".join(self.PROGRESS[6:]))
+        pipe = target.sp.Popen([sys.executable, "-c", script], stdout=target.sp.PIPE)
+        report_interval = target.ffmpeg_progress.REPORT_INTERVAL
+        target.ffmpeg_progress.REPORT_INTERVAL = 0.05
+        try:
+            with self.assertLogs(level="INFO") as logs:
+                (status, elapsed) = target.ffmpeg_progress.monitor(pipe, "GOPR0001.MP4", 10.0, 0.2)
+        finally:
+            target.ffmpeg_progress.REPORT_INTERVAL = report_interval
+            pipe.stdout.close()
+        self.assertEqual(status["out_time"], 8.0)
+        self.assertGreaterEqual(elapsed, 0.5)
+        self.assertTrue(any("GOPR0001.MP4: 40%" in line for line in logs.output))
+        self.assertEqual(len([line for line in logs.output if "stalled" in line]), 1)
+
+class TestEncodePlanner(unittest.TestCase):
+    def info(self, height, fps, bit_rate):
+        return {"width": height * 16 // 9, "height": height, "fps": fps, "bit_rate": bit_rate}
+
+    def plan(self, info, size=100000000, duration=100.0):
+        return target.encode_planner.plan_clip(info, size, duration, 720, 25, 4000)
+
+    def test_video_stream(self):
+        """
+        Test the video_stream() function reads the first video stream of the ffprobe json
+        """
+        metadata = {"format": {"bit_rate": "8000000"},
+                    "streams": [{"codec_type": "audio", "bit_rate": "128000"},
+                                {"codec_type": "video", "width": 1920, "height": 1080, "avg_frame_rate": "60000/1001"}]}
+        info = target.ffprobe.video_stream(metadata)
+        self.assertEqual((info["width"], info["height"], info["bit_rate"]), (1920, 1080, 8000000))
+        self.assertAlmostEqual(info["fps"], 59.94, places=2)
+        self.assertIsNone(target.ffprobe.video_stream({"streams": [{"codec_type": "audio"}]}))
+        self.assertIsNone(target.ffprobe.frame_rate("0/0"))
+
+    def test_plan_clip(self):
+        """
+        Test the plan_clip() function picks the cheapest encode meeting the targets
+        """
+        self.assertEqual(self.plan(self.info(720, 25, 3000000))["mode"], "copy")
+        self.assertEqual(self.plan(self.info(720, 25.02, 3000000))["mode"], "copy")
+        self.assertEqual(self.plan(self.info(720, 25, 3000000))["estimated_size"], 100000000)
+        plan = self.plan(self.info(1080, 25, 8000000))
+        self.assertEqual((plan["mode"], plan["scale"], plan["rate"]), ("scale", True, False))
+        # 8 Mbit/s * (720/1080)^2 = 3.56 Mbit/s during 100 seconds
+        self.assertEqual(plan["estimated_size"], 44444444)
+        self.assertEqual(self.plan(self.info(720, 25, 8000000))["mode"], "scale")
+        plan = self.plan(self.info(1080, 50, 20000000))
+        self.assertEqual((plan["mode"], plan["scale"], plan["rate"]), ("full", True, True))
+        # Capped to the target bitrate
+        self.assertEqual(plan["estimated_size"], 50000000)
+        # Bitrate computed from the size of the file
+        self.assertEqual(self.plan(self.info(480, 25, None), 200000000)["mode"], "scale")
+        self.assertEqual(self.plan(None)["mode"], "full")
+
+    def test_plan_sequence(self):
+        """
+        Test the plan_sequence() function gives all the clips of a sequence the most thorough plan
+        """
+        copy = self.plan(self.info(720, 25, 3000000))
+        scale = self.plan(self.info(1080, 25, 8000000))
+        full = self.plan(self.info(1080, 50, 20000000))
+        plan = target.encode_planner.plan_sequence([copy, copy], 720, 25, 4000)
+        self.assertEqual((plan["mode"], plan["options"]), ("copy", []))
+        plan = target.encode_planner.plan_sequence([copy, scale], 720, 25, 4000)
+        self.assertEqual(plan["mode"], "scale")
+        self.assertEqual(plan["options"], ["-vf", "scale=-2:'min(720,ih)'", "-maxrate", "4000k", "-bufsize", "8000k"])
+        self.assertEqual((plan["counts"]["copy"], plan["counts"]["scale"], plan["size"], plan["estimated_size"]), (1, 1, 200000000, 144444444))
+        plan = target.encode_planner.plan_sequence([copy, scale, full], 720, 25, 4000)
+        self.assertEqual(plan["mode"], "full")
+        self.assertEqual(plan["options"][plan["options"].index("-r") + 1], "25")
+        self.assertEqual(target.encode_planner.describe_plan(plan), "full (files: 1 copy, 1 scale, 1 full), 300.0 MB -> 194.4 MB")
+
+    def test_plan_sequence_encode(self):
+        """
+        Test the plan_sequence_encode() function plans from the video streams read when the clips were probed, without running ffprobe again
+        """
+        clips = [Clip("/tmp/GOPR%04d.MP4" % idx, 100.0, datetime.datetime(2019, 1, 21, 8, idx, 0), 100000000) for idx in range(2)]
+        (clips[0].video, clips[1].video) = (self.info(720, 25, 3000000), self.info(1080, 25, 8000000))
+        probe = target.ffprobe.probe
+        def mock_probe(vid_file_path):
+            raise Exception("ffprobe called on '%s'" % vid_file_path)
+        target.ffprobe.probe = mock_probe
+        try:
+            plan = target.plan_sequence_encode(Sequence(clips), target.parse_args(['--adaptive-encoding', '--target-height', '720', '--target-fps', '25', '--target-bitrate', '4000']))
+        finally:
+            target.ffprobe.probe = probe
+        self.assertEqual((plan["mode"], plan["counts"]["copy"], plan["counts"]["scale"]), ("scale", 1, 1))
+
+    def test_encode_sequence_plans(self):
+        """
+        Test the encode_sequence() function skips the compression of the sequences meeting the targets, and compresses the others with the planned options
+        """
+        compress_sequence = target.compress_sequence
+        calls = []
+        def mock_compress_sequence(seq, tempdir, dry_run, logging_level, id_sequence, num_sequences, encode_workers=1, encode_threads=0, split_segments=1, progress=None, options=None):
+            calls.append(options)
+            return seq
+        target.compress_sequence = mock_compress_sequence
+        args = target.parse_args(['--adaptive-encoding'])
+        seq = Sequence([Clip("/tmp/GOPR0001.MP4", 100.0, datetime.datetime(2019, 1, 21, 8, 0, 0))])
+        copy = target.encode_planner.plan_sequence([self.plan(self.info(720, 25, 3000000))], 720, 25, 4000)
+        scale = target.encode_planner.plan_sequence([self.plan(self.info(1080, 25, 8000000))], 720, 25, 4000)
+        try:
+            job = target.encode_sequence(Job(seq, 0, copy), 1, args)
+            self.assertEqual((calls, job.tempdir, job.file_to_upload), ([], None, "/tmp/GOPR0001.MP4"))
+            job = target.encode_sequence(Job(seq, 0, scale), 1, args)
+            self.assertEqual(calls, [scale["options"]])
+            shutil.rmtree(job.tempdir)
+        finally:
+            target.compress_sequence = compress_sequence
+        self.assertIn("adaptive", target.get_encode_settings(args))
+        self.assertEqual(target.get_compress_command("in.MOV", "out.MOV", 0, scale["options"]), ["ffmpeg", "-nostdin", "-i", "in.MOV"] + scale["options"] + ["out.MOV"])
+
+class TestUploadBudget(unittest.TestCase):
+    def test_allocate_bitrate(self):
+        """
+        Test the allocate_bitrate() function shares the budget left by the uncompressed sequences
+        """
+        # 8 hours at 10 Mbit/s
+        budget = target.upload_budget.get_budget(8 * 3600, 10000000)
+        self.assertEqual(budget, 32400000000)
+        # 2 hours of compressed video: (32.4 GB - 4.4 GB) * 8 / 7200 s = 31111 kbit/s, minus the audio
+        self.assertEqual(target.upload_budget.allocate_bitrate(budget, 4400000000, 7200), 31111 - target.upload_budget.AUDIO_BITRATE)
+        self.assertEqual(target.upload_budget.allocate_bitrate(budget, budget, 7200), target.upload_budget.MIN_VIDEO_BITRATE)
+        self.assertIsNone(target.upload_budget.allocate_bitrate(budget, 0, 0))
+        self.assertEqual(target.upload_budget.capped_size(872, 100), 12500000)
+
+    def test_cap_bitrate(self):
+        """
+        Test the cap_bitrate() function keeps the lowest cap
+        """
+        self.assertEqual(target.upload_budget.cap_bitrate(target.DEFAULT_COMPRESS_OPTIONS, 2000), target.DEFAULT_COMPRESS_OPTIONS + ["-maxrate", "2000k", "-bufsize", "4000k"])
+        options = ["-vf", "scale=-2:720", "-maxrate", "4000k", "-bufsize", "8000k"]
+        self.assertEqual(target.upload_budget.cap_bitrate(options, 2000), ["-vf", "scale=-2:720", "-maxrate", "2000k", "-bufsize", "4000k"])
+        self.assertEqual(target.upload_budget.cap_bitrate(options, 6000), options)
+
+    def test_completion_time(self):
+        """
+        Test the completion_time() and update_rate() functions
+        """
+        start = datetime.datetime(2019, 1, 21, 22, 0, 0)
+        self.assertEqual(target.upload_budget.completion_time(4050000000, 10000000, start), datetime.datetime(2019, 1, 21, 23, 0, 0))
+        self.assertEqual(target.upload_budget.update_rate(None, 1000000, 2), 4000000)
+        self.assertEqual(target.upload_budget.update_rate(2000000, 1000000, 2), 3000000)
+
+    def test_plan_upload_budget(self):
+        """
+        Test the plan_upload_budget() function caps the compressed sequences only, using the measured uplink rate
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            args = target.parse_args(['--upload-window', '1', '--upload-ledger', os.path.join(tempdir, "ledger.sqlite")])
+            self.assertIsNone(target.get_uplink_rate(args))
+            target.record_uplink_rate(args, 1250000, 2)
+            self.assertEqual(target.get_uplink_rate(args), 5000000)
+            clips = [Clip("/tmp/GOPR%04d.MP4" % idx, 600.0, datetime.datetime(2019, 1, 21, 8, 10 * idx, 0), 100000000) for idx in range(3)]
+            copy = {"mode": "copy", "options": [], "size": 100000000, "estimated_size": 100000000}
+            jobs = [Job(Sequence([clips[0]]), 0, copy), Job(Sequence(clips[1:]), 1)]
+            with self.assertLogs(level="INFO") as logs:
+                target.plan_upload_budget(jobs, args)
+        finally:
+            shutil.rmtree(tempdir)
+        # (1 hour at 5 Mbit/s * 0.9 = 2025 MB - 100 MB) over 1200 seconds
+        self.assertEqual(jobs[0].bitrate, None)
+        self.assertEqual(jobs[1].bitrate, 12833 - target.upload_budget.AUDIO_BITRATE)
+        self.assertTrue(any("should be done by" in line for line in logs.output))
+        self.assertEqual(target.get_compress_options(None, jobs[1].bitrate)[-4:], ["-maxrate", "12705k", "-bufsize", "25410k"])
+
+class TestEncoderProfiles(unittest.TestCase):
+    def test_profile_options(self):
+        """
+        Test the default profile keeps the historical compression options
+        """
+        self.assertEqual(target.DEFAULT_COMPRESS_OPTIONS, ["-vf", "scale=iw/2:ih/2", "-r", "25"])
+        self.assertEqual(target.encoder_profiles.profile_options(target.encoder_profiles.PROFILES["x264-fast"]),
+                         ["-vf", "scale=iw/2:ih/2", "-r", "25", "-c:v", "libx264", "-preset", "veryfast", "-crf", "23"])
+
+    def test_encoder_profile_args(self):
+        """
+        Test the --encoder-profile parameter sets the compress options, the encode cache settings and the threads
+        """
+        args = target.parse_args([])
+        self.assertEqual(target.get_compress_options(None, None, target.get_encoder_profile(args)), target.DEFAULT_COMPRESS_OPTIONS)
+        self.assertEqual(target.get_encode_settings(args), "-vf scale=iw/2:ih/2 -r 25")
+        args = target.parse_args(['--encoder-profile', 'x265-small'])
+        self.assertEqual(target.get_compress_options(None, 2000, target.get_encoder_profile(args)),
+                         ["-vf", "scale=iw/2:ih/2", "-r", "25", "-c:v", "libx265", "-preset", "medium", "-crf", "28", "-maxrate", "2000k", "-bufsize", "4000k"])
+        self.assertEqual(target.get_encode_settings(args), "-vf scale=iw/2:ih/2 -r 25 -c:v libx265 -preset medium -crf 28")
+        # The scaling and frame rate of the adaptive plan replace those of the profile
+        plan = {"mode": "scale", "options": ["-vf", "scale=-2:'min(720,ih)'"]}
+        self.assertEqual(target.get_compress_options(plan, None, target.get_encoder_profile(args)),
+                         ["-vf", "scale=-2:'min(720,ih)'", "-c:v", "libx265", "-preset", "medium", "-crf", "28"])
+        with self.assertRaises(SystemExit):
+            with contextlib.redirect_stderr(io.StringIO()):
+                target.parse_args(['--encoder-profile', 'unknown'])
+        target.encoder_profiles.PROFILES["test"] = dict(target.encoder_profiles.PROFILES["default"], threads=3)
+        try:
+            self.assertEqual(target.get_encode_threads(target.parse_args(['--encoder-profile', 'test', '--encode-workers', '4'])), 3)
+            self.assertEqual(target.get_encode_threads(target.parse_args(['--encoder-profile', 'test', '--encode-threads', '8', '--encode-workers', '4'])), 2)
+        finally:
+            del target.encoder_profiles.PROFILES["test"]
+
+    def test_run_benchmark(self):
+        """
+        Test the run_benchmark() function compresses a synthetic clip with each profile and reports their speed and size
+        """
+        run_ffmpeg_command = target.run_ffmpeg_command
+        start_ffmpeg_command = target.start_ffmpeg_command
+        commands = []
+        def mock_run_ffmpeg_command(command, logging_level, progress=None):
+            open(command[-1], "w").close()
+            return 0
+        def mock_start_ffmpeg_command(command, logging_level):
+            commands.append(command)
+            with open(command[-1], "wb") as f:
+                f.write(b"\0" * 3000000)
+            script = "print('frame=600\\nout_time_us=20000000\\nprogress=end')"
+            return target.sp.Popen([sys.executable, "-c", script], stdout=target.sp.PIPE)
+        target.run_ffmpeg_command = mock_run_ffmpeg_command
+        target.start_ffmpeg_command = mock_start_ffmpeg_command
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                target.run_benchmark(target.parse_args(['--benchmark', '--benchmark-profiles', 'default', 'x264-fast']))
+        finally:
+            target.run_ffmpeg_command = run_ffmpeg_command
+            target.start_ffmpeg_command = start_ffmpeg_command
+        self.assertEqual(len(commands), 2)
+        self.assertIn("libx264", commands[1])
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        # 3 MB for 20 seconds of synthetic clip
+        self.assertEqual(lines[1].split()[0], "default")
+        self.assertEqual(lines[2].split()[2], "9.0")
+
+class TestDeadSpans(unittest.TestCase):
+    OUTPUT = """[freezedetect @ 0x55d5] lavfi.freezedetect.freeze_start: 10.01
+[freezedetect @ 0x55d5] lavfi.freezedetect.freeze_duration: 40.5
+[freezedetect @ 0x55d5] lavfi.freezedetect.freeze_end: 50.51
+[blackdetect @ 0x55d6] black_start:45 black_end:62.5 black_duration:17.5
+[blackdetect @ 0x55d6] black_start:100 black_end:103 black_duration:3
+[freezedetect @ 0x55d5] lavfi.freezedetect.freeze_start: 250
+"""
+
+    def test_parse_spans(self):
+        """
+        Test the parse_spans() function merges the static and black spans
+        """
+        self.assertEqual(target.dead_spans.parse_spans(self.OUTPUT, 300.0, 10), [(10.01, 62.5), (250.0, 300.0)])
+        self.assertEqual(target.dead_spans.parse_spans(self.OUTPUT, 300.0), [(10.01, 62.5), (100.0, 103.0), (250.0, 300.0)])
+        self.assertEqual(target.dead_spans.parse_spans("", 300.0), [])
+
+    def test_kept_spans(self):
+        """
+        Test the kept_spans() function keeps the rest of the file, and a part of the files that are entirely dead
+        """
+        self.assertEqual(target.dead_spans.kept_spans([(10.0, 62.5), (250.0, 300.0)], 300.0), [(0.0, 10.0), (62.5, 250.0)])
+        self.assertEqual(target.dead_spans.kept_spans([(0.0, 20.0)], 60.0), [(20.0, 60.0)])
+        self.assertEqual(target.dead_spans.kept_spans([(0.0, 60.0)], 60.0), [(0.0, target.dead_spans.MIN_KEPT_SECONDS)])
+
+    def test_exclude_options(self):
+        """
+        Test the exclude_options() function selects the kept spans before the other filters
+        """
+        options = target.dead_spans.exclude_options(target.DEFAULT_COMPRESS_OPTIONS, [(0.0, 10.0), (62.5, 250.0)])
+        self.assertEqual(options[:2], ["-vf", "select='between(t,0.000,10.000)+between(t,62.500,250.000)',setpts=N/FRAME_RATE/TB,scale=iw/2:ih/2"])
+        self.assertEqual(options[-2:], ["-af", "aselect='between(t,0.000,10.000)+between(t,62.500,250.000)',asetpts=N/SR/TB"])
+        self.assertEqual(target.dead_spans.describe([(10.0, 62.5), (550.0, 600.0)]), "Removed 2 static or black spans (0:01:42 in total): 0:00:10-0:01:02, 0:09:10-0:10:00.")
+
+    def test_write_concat_list_spans(self):
+        """
+        Test the write_concat_list() function only keeps the spans of the files that have dead spans
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            list_file = os.path.join(tempdir, "files.txt")
+            target.write_concat_list(["/tmp/a.MOV", "/tmp/b.MOV"], list_file, [[(0.0, 10.0), (62.5, 250.0)], None])
+            with open(list_file) as f:
+                lines = f.read().splitlines()
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(lines, ["file '/tmp/a.MOV'", "inpoint 0.000", "outpoint 10.000",
+                                 "file '/tmp/a.MOV'", "inpoint 62.500", "outpoint 250.000",
+                                 "file '/tmp/b.MOV'"])
+
+    def test_detect_and_drop_dead_spans(self):
+        """
+        Test the detect_dead_spans() function notes the spans in the sequence, and compress_sequence() drops them
+        """
+        get_detect_command = target.dead_spans.get_detect_command
+        run_compress_command = target.run_compress_command
+        output = self.OUTPUT
+        target.dead_spans.get_detect_command = lambda file_path, min_seconds: [sys.executable, "-c", "import sys; sys.stderr.write(%r)" % output]
+        commands = []
+        def mock_run_compress_command(command, logging_level, running, progress=None):
+            commands.append(command)
+            return 0
+        target.run_compress_command = mock_run_compress_command
+        tempdir = tempfile.mkdtemp()
+        outdir = tempfile.mkdtemp()
+        try:
+            seq = TestCompressSequence.createSequence(None, tempdir, 2)
+            job = target.detect_dead_spans(Job(seq, 0), 1, target.parse_args(['--drop-dead-spans']))
+            target.compress_sequence(seq, outdir, False, "INFO", 1, 1, 1, 0, 4)
+        finally:
+            target.dead_spans.get_detect_command = get_detect_command
+            target.run_compress_command = run_compress_command
+            shutil.rmtree(tempdir)
+            shutil.rmtree(outdir)
+        # The spans of the second file start 300 seconds later in the sequence
+        self.assertEqual(job.description_note, "Removed 4 static or black spans (0:03:24 in total): 0:00:10-0:01:02, 0:04:10-0:05:00, 0:05:10-0:06:02, 0:09:10-0:10:00.")
+        # Not split, since the files have dead spans
+        self.assertEqual(len(commands), 2)
+        self.assertTrue(commands[0][commands[0].index("-vf") + 1].startswith("select='between(t,0.000,10.010)+between(t,62.500,250.000)'"))
+        self.assertEqual([f.dead_spans for f in seq], [None, None])
+
+class TestWorkspace(unittest.TestCase):
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        target.workspace.close_workspace()
+        shutil.rmtree(self.scratch_dir)
+
+    def test_open_close_workspace(self):
+        """
+        Test each run gets a workspace of its own, holding its temporary folders, deleted at the end of the run
+        """
+        path = target.workspace.open_workspace(self.scratch_dir)
+        self.assertEqual(os.path.dirname(path), self.scratch_dir)
+        self.assertTrue(os.path.basename(path).startswith("%s%d-" % (target.workspace.PREFIX, os.getpid())))
+        folder = target.workspace.make_dir()
+        self.assertEqual(os.path.dirname(folder), path)
+        # Another run at the same time
+        other_run = tempfile.mkdtemp(prefix="%s%d-" % (target.workspace.PREFIX, os.getppid()), dir=self.scratch_dir)
+        target.workspace.close_workspace()
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(target.workspace.current)
+        self.assertTrue(os.path.isdir(other_run))
+
+    def test_remove_stale_workspaces(self):
+        """
+        Test the workspaces of the runs that are not running anymore get deleted
+        """
+        pipe = target.sp.Popen([sys.executable, "-c", "pass"])
+        pipe.wait()
+        stale = tempfile.mkdtemp(prefix="%s%d-" % (target.workspace.PREFIX, pipe.pid), dir=self.scratch_dir)
+        running = tempfile.mkdtemp(prefix="%s%d-" % (target.workspace.PREFIX, os.getppid()), dir=self.scratch_dir)
+        other = tempfile.mkdtemp(prefix="other-", dir=self.scratch_dir)
+        self.assertEqual(target.workspace.remove_stale_workspaces(self.scratch_dir), 1)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.isdir(running))
+        self.assertTrue(os.path.isdir(other))
+
+    def test_reserve_space(self):
+        """
+        Test the space reserved by the sequences counts as used, and the run exits when a sequence doesn't fit
+        """
+        target.workspace.open_workspace(self.scratch_dir)
+        free_space = target.workspace.free_space()
+        self.assertTrue(target.workspace.reserve(free_space // 2))
+        self.assertFalse(target.workspace.reserve(free_space // 2 + 1000000000))
+        target.workspace.release(free_space // 2)
+        args = target.parse_args(['--scratch-reserve', '1'])
+        job = Job(Sequence(), 0)
+        target.reserve_space(job, 1000, 1, args, "compress and merge")
+        self.assertEqual(job.reserved, 1000)
+        target.release_space(job)
+        self.assertEqual(target.workspace.reservations["reserved"], 0)
+        with self.assertRaises(SystemExit) as cm:
+            with self.assertLogs(level="ERROR"):
+                target.reserve_space(job, free_space, 1, args, "compress and merge")
+        self.assertEqual(cm.exception.code, 22)
+
+    def test_reserve_written_files(self):
+        """
+        Test the files written by the sequences holding a reservation don't count twice against the free space
+        """
+        target.workspace.open_workspace(self.scratch_dir)
+        # A 10 MB volume, holding the files of the workspace
+        def free_space():
+            return 10000000 - sum(os.path.getsize(os.path.join(target.workspace.current, name)) for name in os.listdir(target.workspace.current))
+        free_space_function = target.workspace.free_space
+        target.workspace.free_space = free_space
+        try:
+            # Two sequences being processed at the same time, each of them writing its files
+            self.assertTrue(target.workspace.reserve(4000000))
+            with open(os.path.join(target.workspace.current, "sequence_1.mp4"), "wb") as f:
+                f.write(b"\0" * 3000000)
+            self.assertTrue(target.workspace.reserve(4000000))
+            with open(os.path.join(target.workspace.current, "sequence_2.mp4"), "wb") as f:
+                f.write(b"\0" * 4000000)
+            self.assertEqual(target.workspace.available_space(), 2000000)
+            self.assertTrue(target.workspace.reserve(1000000, 1000000))
+            self.assertFalse(target.workspace.reserve(1000000, 1))
+            # Another program fills the volume
+            with open(os.path.join(target.workspace.current, "other.bin"), "wb") as f:
+                f.write(b"\0" * 2500000)
+            self.assertEqual(target.workspace.available_space(), 500000)
+            # Once everything is released, the free space is measured again
+            os.remove(os.path.join(target.workspace.current, "sequence_1.mp4"))
+            os.remove(os.path.join(target.workspace.current, "sequence_2.mp4"))
+            target.workspace.release(9000000)
+            self.assertEqual(target.workspace.available_space(), 7500000)
+        finally:
+            target.workspace.free_space = free_space_function
+
+    def test_get_encode_space(self):
+        """
+        Test the get_encode_space() function estimates the space needed by the files of a sequence
+        """
+        clips = [Clip("/tmp/GOPR%04d.MP4" % idx, 600.0, datetime.datetime(2019, 1, 21, 8, 10 * idx, 0), 1000000000) for idx in range(2)]
+        seq = Sequence(clips)
+        single = Sequence(clips[:1])
+        self.assertEqual(target.get_encode_space(seq, target.parse_args([])), 2000000000)
+        self.assertEqual(target.get_encode_space(single, target.parse_args([])), 500000000)
+        self.assertEqual(target.get_encode_space(seq, target.parse_args(['--single-pass'])), 1000000000)
+        self.assertEqual(target.get_encode_space(seq, target.parse_args(['--no-compression'])), 2000000000)
+        self.assertEqual(target.get_encode_space(single, target.parse_args(['--no-compression'])), 0)
+        self.assertEqual(target.get_encode_space(seq, target.parse_args([]), {"mode": "scale", "estimated_size": 300000000}), 600000000)
+
 class TestDeleteTemporaryFiles(unittest.TestCase):
     def test_delete_temporary_files_compressed_files(self):
         """
@@ -654,6 +2514,8 @@ class TestGetSequenceTitle(unittest.TestCase):
         creation_time = datetime.datetime(2019, 1, 25, 16, 42, 21)
         sequence_title = target.get_sequence_title(creation_time)
         self.assertEqual(sequence_title, "2019-01-25 16:42:21")
+        sequence_title = target.get_sequence_title(creation_time, "helmet")
+        self.assertEqual(sequence_title, "2019-01-25 16:42:21 helmet")
 
 class TestParseArgs(unittest.TestCase):
     def test_parse_args_dry_run(self):
@@ -737,6 +2599,55 @@ class TestParseArgs(unittest.TestCase):
         parser = target.parse_args(['--max-length', '48'])
         self.assertEqual(parser.max_length, 48)
 
+    def test_parse_args_probe_cache(self):
+        """
+        Test the --probe-cache, --no-probe-cache and --rebuild-probe-cache arguments
+        """
+        parser = target.parse_args([])
+        self.assertEqual(parser.probe_cache, "actioncam-upload-cache.sqlite")
+        self.assertFalse(parser.no_probe_cache)
+        self.assertFalse(parser.rebuild_probe_cache)
+        parser = target.parse_args(['--probe-cache', '/tmp/cache.sqlite', '--no-probe-cache', '--rebuild-probe-cache'])
+        self.assertEqual(parser.probe_cache, "/tmp/cache.sqlite")
+        self.assertTrue(parser.no_probe_cache)
+        self.assertTrue(parser.rebuild_probe_cache)
+
+    def test_parse_args_probe_workers(self):
+        """
+        Test the --probe-workers argument
+        """
+        parser = target.parse_args(['--probe-workers', '8'])
+        self.assertEqual(parser.probe_workers, 8)
+
+    def test_parse_args_probe_workers_invalid(self):
+        """
+        Test the --probe-workers argument with an invalid value
+        """
+        with self.assertRaises(SystemExit) as cm:
+            with contextlib.redirect_stderr(io.StringIO()):
+                target.parse_args(['--probe-workers', '0'])
+        self.assertEqual(cm.exception.code, 2)
+
+    def test_parse_args_gap_seconds(self):
+        """
+        Test the --gap-seconds argument
+        """
+        self.assertEqual(target.parse_args([]).gap_seconds, 30)
+        self.assertEqual(target.parse_args(['--gap-seconds', '2.5']).gap_seconds, 2.5)
+
+    def test_parse_args_watch(self):
+        """
+        Test the --watch argument, which can't be combined with --interactive
+        """
+        parser = target.parse_args(['--watch'])
+        self.assertTrue(parser.watch)
+        self.assertEqual(parser.settle_seconds, 10)
+        self.assertEqual(parser.poll_interval, 5)
+        with self.assertRaises(SystemExit) as cm:
+            with contextlib.redirect_stderr(io.StringIO()):
+                target.parse_args(['--watch', '--interactive'])
+        self.assertEqual(cm.exception.code, 2)
+
 class TestInitMain(unittest.TestCase):
     def test_init_main_no_arguments(self):
         """
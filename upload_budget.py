@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Byte budget of the --upload-window mode, so that the uploads of a run fit
+# in a time window over a constrained uplink (e.g. overnight).
+#
+# The budget is the number of bytes the uplink can send during the window.
+# The sequences uploaded as they are (--no-compression, or meeting the
+# targets of --adaptive-encoding) use their size of the budget, the rest is
+# shared by the compressed sequences in proportion of their duration, as a
+# maximum video bitrate (capped CRF: -maxrate/-bufsize).
+#
+# The uplink rate is either configured, or measured on the previous uploads
+# and kept in the upload ledger.
+#
+
+import datetime
+
+# Share of the uplink rate actually available to the uploads (protocol overhead, other traffic)
+HEADROOM = 0.9
+# Bitrate left for the audio stream, in kbit/s
+AUDIO_BITRATE = 128
+# Below this video bitrate (in kbit/s), the videos aren't worth watching anymore
+MIN_VIDEO_BITRATE = 300
+# Weight of the latest upload in the measured uplink rate
+MEASURE_WEIGHT = 0.5
+
+
+def get_budget(window_seconds, uplink_rate):
+    ''' Number of bytes that can be uploaded during the window
+
+    @uplink_rate : The uplink rate, in bits/s.
+    '''
+    return int(window_seconds * uplink_rate * HEADROOM / 8)
+
+
+def allocate_bitrate(budget, fixed_bytes, encoded_duration):
+    ''' Maximum video bitrate (kbit/s) of the compressed sequences, to fit the budget
+
+    Returns None if there is no compressed sequence. The bitrate isn't lower
+    than MIN_VIDEO_BITRATE, even if the budget can't be met.
+
+    @fixed_bytes : The size of the sequences uploaded without compressing them.
+    @encoded_duration : The total duration of the compressed sequences, in seconds.
+    '''
+    if not encoded_duration:
+        return None
+    bitrate = (budget - fixed_bytes) * 8 / encoded_duration / 1000 - AUDIO_BITRATE
+    return max(MIN_VIDEO_BITRATE, int(bitrate))
+
+
+def capped_size(bitrate, duration):
+    ''' Maximum size (bytes) of a sequence compressed with this maximum video bitrate (kbit/s)
+    '''
+    return int((bitrate + AUDIO_BITRATE) * 1000 * duration / 8)
+
+
+def cap_bitrate(options, bitrate):
+    ''' FFmpeg compress options, with the video bitrate capped to bitrate (kbit/s)
+
+    A lower cap already present in the options is kept.
+    '''
+    options = list(options)
+    if "-maxrate" in options:
+        index = options.index("-maxrate")
+        bitrate = min(bitrate, int(options[index + 1].rstrip("k")))
+        del options[index:index + 2]
+        if "-bufsize" in options:
+            index = options.index("-bufsize")
+            del options[index:index + 2]
+    return options + ["-maxrate", "%dk" % bitrate,
+                      "-bufsize", "%dk" % (2 * bitrate)]
+
+
+def completion_time(total_bytes, uplink_rate, start=None):
+    ''' Time at which the upload of total_bytes should be done, datetime
+    '''
+    start = start or datetime.datetime.now()
+    return start + datetime.timedelta(seconds=total_bytes * 8 / (uplink_rate * HEADROOM))
+
+
+def update_rate(previous_rate, num_bytes, seconds):
+    ''' Measured uplink rate (bits/s), updated with an upload of num_bytes in seconds
+    '''
+    rate = num_bytes * 8 / seconds
+    if not previous_rate:
+        return rate
+    return MEASURE_WEIGHT * rate + (1 - MEASURE_WEIGHT) * previous_rate
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Persistent ledger of the videos uploaded to the YouTube channel.
+#
+# The uploads playlist of the channel lists the most recent videos first, so
+# each run only needs to fetch the pages newer than the most recent video
+# seen by the previous run (the sync mark), instead of paging through the
+# entire playlist. The videos uploaded by actioncam-upload are recorded as
+# soon as their upload completes, but they don't move the sync mark: other
+# videos could have been uploaded to the channel in the meantime.
+#
+
+import sqlite3
+import logging
+
+
+def open_ledger(db_path):
+    ''' Open (and create if needed) the ledger database, return a connection
+
+    @db_path : The path of the SQLite database file, string.
+    '''
+    conn = sqlite3.connect(db_path)
+    conn.execute("""CREATE TABLE IF NOT EXISTS uploads (
+                        video_id TEXT PRIMARY KEY,
+                        title TEXT NOT NULL,
+                        description TEXT,
+                        published_at TEXT,
+                        etag TEXT
+                    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS settings (
+                        name TEXT PRIMARY KEY,
+                        value TEXT NOT NULL
+                    )""")
+    conn.commit()
+    logging.debug("Opened the upload ledger '%s'." % db_path)
+    return conn
+
+
+def get_setting(conn, name):
+    row = conn.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def set_setting(conn, name, value):
+    conn.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", (name, value))
+    conn.commit()
+
+
+def load_videos(conn):
+    ''' (title, description) of the videos in the ledger
+    '''
+    return conn.execute("SELECT title, description FROM uploads").fetchall()
+
+
+def store_uploads(conn, uploads):
+    ''' Add videos to the ledger
+
+    @uploads : List of dicts (video_id, title, description, published_at, etag).
+    '''
+    conn.executemany("INSERT OR REPLACE INTO uploads (video_id, title, description, published_at, etag) VALUES (?, ?, ?, ?, ?)",
+                     [(u["video_id"], u["title"], u.get("description"), u.get("published_at"), u.get("etag")) for u in uploads])
+    conn.commit()
+
+
+def clear_ledger(conn):
+    ''' Forget about all the videos, the next sync fetches the entire uploads playlist again
+    '''
+    conn.execute("DELETE FROM uploads")
+    conn.execute("DELETE FROM settings")
+    conn.commit()
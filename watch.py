@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Wait for changes in the folders containing the video files, used by the
+# --watch mode.
+#
+# On Linux, inotify (through ctypes, no extra dependency) wakes the watch
+# loop up as soon as a file is created, written or moved in one of the
+# folders. Elsewhere, or if inotify is not available, the folders are simply
+# scanned again at a regular interval.
+#
+
+import os
+import time
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+# Not watching IN_MODIFY, which would wake the loop up for every write while a clip is being recorded
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# struct inotify_event: int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingWatcher(object):
+    ''' Wake up at a regular interval
+    '''
+    def __init__(self, folders):
+        self.folders = folders
+
+    def wait(self, timeout):
+        ''' Wait until timeout (in seconds), return True if changes were detected
+        '''
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    ''' Wake up as soon as something changes in the folders (or their subfolders)
+    '''
+    def __init__(self, folders):
+        self.folders = folders
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.add_watches()
+
+    def add_watches(self):
+        # inotify isn't recursive, watch each subfolder (watching a folder twice is harmless)
+        for folder in self.folders:
+            for (dirpath, dirnames, filenames) in os.walk(folder):
+                if self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK) < 0:
+                    logging.debug("Unable to watch folder '%s' (errno %d)." % (dirpath, ctypes.get_errno()))
+
+    def wait(self, timeout):
+        ''' Wait until changes are detected or until timeout (in seconds), return True if changes were detected
+        '''
+        (readable, writable, exceptional) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # Drain the pending events, the folders get scanned again anyway
+        while True:
+            try:
+                data = os.read(self.fd, 64 * (EVENT_HEADER.size + 256))
+            except BlockingIOError:
+                break
+            if not data:
+                break
+        # Watch the newly created subfolders
+        self.add_watches()
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(folders, use_inotify=True):
+    ''' An inotify watcher if available, otherwise a polling watcher
+    '''
+    if use_inotify:
+        try:
+            watcher = InotifyWatcher(folders)
+            logging.info("Watching folders %s using inotify." % folders)
+            return watcher
+        except (OSError, AttributeError) as e:
+            # AttributeError: the C library doesn't provide inotify (not Linux)
+            logging.info("inotify is not available (%s), falling back to polling." % e)
+    logging.info("Watching folders %s by polling." % folders)
+    return PollingWatcher(folders)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Scratch workspace of a run, holding all its temporary files and folders
+# (pre-copied, compressed and merged files).
+#
+# Each run gets its own folder in the scratch folder (--scratch-dir, e.g. on
+# a fast NVMe drive or a tmpfs), so that several runs (e.g. one per
+# actioncam) can go on at the same time without overwriting each other's
+# files. The folder is deleted at the end of the run, and the folders left
+# behind by the runs that crashed are deleted by the next run.
+#
+# Before writing the files of a sequence, the space they need is reserved:
+# the reservation fails if the free space of the scratch folder, minus the
+# space already reserved by this run, would go below a minimum. The free
+# space is measured when nothing is reserved, so that the files already
+# written by the sequences being processed don't count twice (once as
+# reserved, once as used).
+#
+
+import os
+import re
+import shutil
+import logging
+import tempfile
+import threading
+
+PREFIX = "actioncam-upload-run-"
+# actioncam-upload-run-<process id>-<random suffix>
+WORKSPACE_PATTERN = re.compile(r"^%s(\d+)-" % re.escape(PREFIX))
+
+# Folder of the current run, None until open_workspace() (the temporary files then go to the system temporary folder)
+current = None
+# Bytes reserved by the sequences being processed, and free bytes measured before the first of these reservations
+reservations = {"lock": threading.Lock(), "reserved": 0, "free": None}
+
+
+def is_running(pid):
+    ''' Whether a process is running
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, as another user
+        return True
+    return True
+
+
+def remove_stale_workspaces(scratch_dir):
+    ''' Delete the workspaces of the runs that are not running anymore, return their number
+    '''
+    removed = 0
+    for name in os.listdir(scratch_dir):
+        match = WORKSPACE_PATTERN.match(name)
+        path = os.path.join(scratch_dir, name)
+        if match and os.path.isdir(path) and not is_running(int(match.group(1))):
+            logging.info("Deleting the workspace '%s' left behind by a previous run." % path)
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def open_workspace(scratch_dir=None):
+    ''' Create the workspace of this run, return its path
+
+    @scratch_dir : The folder in which to create the workspace, by default the system temporary folder.
+    '''
+    global current
+    scratch_dir = scratch_dir or tempfile.gettempdir()
+    if not os.path.isdir(scratch_dir):
+        os.makedirs(scratch_dir)
+    remove_stale_workspaces(scratch_dir)
+    current = tempfile.mkdtemp(prefix="%s%d-" % (PREFIX, os.getpid()), dir=scratch_dir)
+    logging.debug("Created the workspace '%s'." % current)
+    return current
+
+
+def close_workspace():
+    ''' Delete the workspace of this run, and everything left in it
+    '''
+    global current
+    if current:
+        shutil.rmtree(current, ignore_errors=True)
+        logging.debug("Deleted the workspace '%s'." % current)
+    current = None
+    with reservations["lock"]:
+        reservations["reserved"] = 0
+        reservations["free"] = None
+
+
+def make_dir(prefix="tmp"):
+    ''' Create a new temporary folder in the workspace, return its path
+    '''
+    return tempfile.mkdtemp(prefix=prefix, dir=current)
+
+
+def free_space():
+    ''' Free space of the volume of the workspace, in bytes
+    '''
+    return shutil.disk_usage(current or tempfile.gettempdir()).free
+
+
+def unreserved_space():
+    ''' Free bytes of the workspace not reserved yet, must be called with the lock held
+    '''
+    if not reservations["reserved"] or reservations["free"] is None:
+        reservations["free"] = free_space()
+        return reservations["free"] - reservations["reserved"]
+    # The files written since the measure are part of the reservations, the space used by other programs isn't
+    return min(reservations["free"] - reservations["reserved"], free_space())
+
+
+def available_space():
+    ''' Free bytes of the workspace not reserved yet
+    '''
+    with reservations["lock"]:
+        return unreserved_space()
+
+
+def reserve(size, min_free=0):
+    ''' Reserve size bytes of the workspace, return False if that would leave less than min_free bytes free
+    '''
+    with reservations["lock"]:
+        if unreserved_space() - size < min_free:
+            return False
+        reservations["reserved"] += size
+        return True
+
+
+def release(size):
+    ''' Release the bytes reserved by reserve(), once the files have been deleted
+    '''
+    with reservations["lock"]:
+        reservations["reserved"] = max(0, reservations["reserved"] - size)
@@ -8,8 +8,11 @@
 import httplib2
 import os
 import logging
+import random
+import time
 
 from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaUpload
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from oauth2client.file import Storage
@@ -58,6 +61,9 @@ API_VERSION = 'v3'
 
 VALID_PRIVACY_STATUSES = ('public', 'private', 'unlisted')
 
+# Size of the chunks of streamed uploads, must be a multiple of 256 KiB
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+
 # This variable defines a message to display if the CLIENT_SECRETS_FILE is
 # missing.
 MISSING_CLIENT_SECRETS_MESSAGE = """
@@ -73,6 +79,71 @@ For more information about the client_secrets.json file format, please visit:
 https://developers.google.com/api-client-library/python/guide/aaa_client_secrets
 """ % os.path.abspath(os.path.join(os.path.dirname(__file__), CLIENT_SECRETS_FILE))
 
+class StreamingMediaUpload(MediaUpload):
+    ''' Resumable upload of a stream of unknown length (e.g. the output of FFmpeg on a pipe)
+
+    The data is read from the stream as the upload progresses, only the
+    current chunk is kept in memory, to be sent again if its upload fails.
+    '''
+
+    def __init__(self, fd, mimetype, chunksize=STREAM_CHUNK_SIZE, check_end=None):
+        self._fd = fd
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        # Called when the end of the stream is reached, can raise an exception to abort the upload
+        self._check_end = check_end
+        # Data of the stream from offset _buffer_start, not received by YouTube yet
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        # Offset of the next chunk, if the upload of the current chunk succeeds
+        self._next_begin = 0
+        self._total_size = None
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        # Unknown (None) until the end of the stream is reached
+        # Reading one byte past the next chunk tells whether it's the last one, which then gets sent with the total size
+        self._fill(self._next_begin + self._chunksize + 1)
+        return self._total_size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        # The data is provided by getbytes()
+        return False
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_start:
+            raise Exception('The stream can not be rewound to offset %d (current chunk starts at %d)' % (begin, self._buffer_start))
+        # The data before begin has been received by YouTube
+        del self._buffer[:begin - self._buffer_start]
+        self._buffer_start = begin
+        self._fill(begin + length)
+        data = bytes(self._buffer[:length])
+        self._next_begin = begin + len(data)
+        return data
+
+    def to_json(self):
+        raise NotImplementedError('A streamed upload can not be serialized')
+
+    def _fill(self, end):
+        # Read from the stream until the buffer reaches offset end, or the end of the stream
+        while self._total_size is None and self._buffer_start + len(self._buffer) < end:
+            data = self._fd.read(end - self._buffer_start - len(self._buffer))
+            if not data:
+                if self._check_end:
+                    self._check_end()
+                self._total_size = self._buffer_start + len(self._buffer)
+                logging.debug('End of the stream, %d bytes.' % self._total_size)
+                break
+            self._buffer.extend(data)
+
 # Authorize the request and store authorization credentials.
 def yt_get_authenticated_service(args):
     flow = flow_from_clientsecrets(CLIENT_SECRETS_FILE, scope=SCOPES, message=MISSING_CLIENT_SECRETS_MESSAGE)
@@ -96,38 +167,57 @@ def yt_get_my_uploads_list(youtube):
         return channel['contentDetails']['relatedPlaylists']['uploads']
     return None
 
-def yt_list_my_uploaded_videos(uploads_playlist_id, youtube):
+def yt_list_my_uploaded_videos(uploads_playlist_id, youtube, sync_mark=None):
+    # Retrieve the videos uploaded to the authenticated user's channel, most recent first.
+    # Paging stops at sync_mark, the id of the most recent video seen by the previous listing: the older ones are known as well.
     uploaded_videos = []
-    # Retrieve the list of videos uploaded to the authenticated user's channel.
     playlistitems_list_request = youtube.playlistItems().list(
         playlistId=uploads_playlist_id,
-        part='snippet'
+        part='snippet',
+        maxResults=50,
+        # Partial response, only the fields stored in the upload ledger
+        fields='nextPageToken,items(etag,snippet(publishedAt,title,description,resourceId/videoId))'
     )
 
     logging.debug('Videos in list %s' % uploads_playlist_id)
+    num_pages = 0
     while playlistitems_list_request:
         playlistitems_list_response = playlistitems_list_request.execute()
+        num_pages += 1
 
-        # Print information about each video.
-        for playlist_item in playlistitems_list_response['items']:
+        reached_sync_mark = False
+        for playlist_item in playlistitems_list_response.get('items', []):
             title = playlist_item['snippet']['title']
             video_id = playlist_item['snippet']['resourceId']['videoId']
-            uploaded_videos.append(title)
+            if video_id == sync_mark:
+                reached_sync_mark = True
+                break
+            uploaded_videos.append({"video_id": video_id, "title": title,
+                                    "description": playlist_item['snippet'].get('description'),
+                                    "published_at": playlist_item['snippet'].get('publishedAt'),
+                                    "etag": playlist_item.get('etag')})
             logging.debug("Title: '%s' (ID: %s)" % (title, video_id))
+        if reached_sync_mark:
+            break
 
         playlistitems_list_request = youtube.playlistItems().list_next(playlistitems_list_request, playlistitems_list_response)
-    logging.info("There are %d already uploaded videos." % len(uploaded_videos))
+    logging.info("There are %d newly found uploaded videos (%d pages fetched)." % (len(uploaded_videos), num_pages))
     return uploaded_videos
 
-def yt_initialize_upload(file_to_upload, sequence_title, youtube, options):
+def yt_initialize_upload(file_to_upload, sequence_title, youtube, options, media_body=None, description_note=None):
     tags = None
     if options.keywords:
         tags = options.keywords.split(',')
 
+    description = "%s %s" % (options.description, sequence_title) if options.description else sequence_title
+    if description_note:
+        # The sequence title stays at the end of the description, identifying the sequence
+        description = "%s\n%s" % (description_note, description)
+
     body=dict(
         snippet=dict(
             title="%s %s" % (options.title, sequence_title) if options.title else sequence_title,
-            description="%s %s" % (options.description, sequence_title) if options.description else sequence_title,
+            description=description,
             tags=tags,
             categoryId=options.category
         ),
@@ -151,10 +241,10 @@ def yt_initialize_upload(file_to_upload, sequence_title, youtube, options):
         # practice, but if you're using Python older than 2.6 or if you're
         # running on App Engine, you should set the chunksize to something like
         # 1024 * 1024 (1 megabyte).
-        media_body=MediaFileUpload(file_to_upload, chunksize=-1, resumable=True)
+        media_body=media_body or MediaFileUpload(file_to_upload, chunksize=-1, resumable=True)
     )
 
-    yt_resumable_upload(insert_request)
+    return yt_resumable_upload(insert_request)
 
 # This method implements an exponential backoff strategy to resume a failed upload.
 def yt_resumable_upload(request):
@@ -188,3 +278,5 @@ def yt_resumable_upload(request):
             sleep_seconds = random.random() * max_sleep
             logging.info('Sleeping %f seconds and then retrying...' % sleep_seconds)
             time.sleep(sleep_seconds)
+            error = None
+    return response